@@ -1,158 +1,1151 @@
-from flask import Flask, jsonify, request, send_from_directory, g, render_template
+from flask import Flask, Response, jsonify, request, send_from_directory, g, render_template, stream_with_context
 from flask_cors import CORS
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import secrets
 import sqlite3
 from contextlib import closing
 import hashlib
+import hmac
+import functools
 import json
+import base64
+import bisect
+import csv
+import io
+import threading
+import time
+import atexit
+import heapq
+import math
+import click
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 
 app = Flask(__name__)
 CORS(app)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
+if 'SECRET_KEY' not in os.environ:
+    print("⚠️ SECRET_KEY not set: session tokens will not survive restarts or work across workers")
 
 # ========== DATABASE SETUP ==========
 DATABASE = 'kaamkaro.db'
 
+# How long a connection waits for another writer's lock before giving up
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+
+# Applied to every new connection. WAL lets readers run alongside the single
+# writer, NORMAL sync is durable across app crashes in WAL mode, and the
+# negative cache_size is in KiB (64 MB page cache per connection).
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', int(os.environ.get('SQLITE_CACHE_SIZE', -64000))),
+    ('mmap_size', int(os.environ.get('SQLITE_MMAP_SIZE', 268435456))),
+    ('temp_store', 'MEMORY'),
+]
+
+class ConnectionPool:
+    """One long-lived SQLite connection per worker thread.
+
+    Connections are opened lazily, tuned with SQLITE_PRAGMAS and handed back
+    to the same thread on every request instead of being reconnected. A
+    connection inherited across fork (gunicorn --preload) is never reused.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {"opened": 0, "reused": 0, "released": 0, "rollbacks": 0, "discarded": 0}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _open(self):
+        conn = sqlite3.connect(self.database, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+        conn.row_factory = sqlite3.Row
+        for name, value in SQLITE_PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        self._count("opened")
+        return conn
+
+    def acquire(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            self._count("reused")
+            return conn
+        conn = self._local.conn = self._open()
+        self._local.pid = os.getpid()
+        return conn
+
+    def release(self, conn):
+        # Never hand a half-finished transaction to the next request
+        if conn.in_transaction:
+            conn.rollback()
+            self._count("rollbacks")
+        self._count("released")
+
+    def discard(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            self._local.conn = None
+            if self._local.pid == os.getpid():
+                conn.close()
+            self._count("discarded")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["database"] = self.database
+        stats["pragmas"] = {name: value for name, value in SQLITE_PRAGMAS}
+        return stats
+
+db_pool = ConnectionPool(DATABASE)
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
+        db = g._database = db_pool.acquire()
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        try:
+            db_pool.release(db)
+        except sqlite3.Error:
+            db_pool.discard()
+
+# ========== DATABASE SETUP ==========
+# Schema creation, migrations and demo data run from `flask --app app db ...`
+# (once per deploy, before workers start), never at import: workers only
+# check the schema version in create_app().
+def create_schema(db):
+    """Base tables; everything added since lives in MIGRATIONS."""
+    # Users table
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            name TEXT,
+            balance REAL DEFAULT 0.0,
+            tasks_done INTEGER DEFAULT 0,
+            total_earned REAL DEFAULT 0.0,
+            joined DATE DEFAULT CURRENT_DATE,
+            referral_code TEXT UNIQUE,
+            referrals_count INTEGER DEFAULT 0,
+            referral_earnings REAL DEFAULT 0.0,
+            is_admin BOOLEAN DEFAULT 0,
+            phone TEXT,
+            status TEXT DEFAULT 'active',
+            last_login TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Tasks table
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            description TEXT,
+            reward REAL NOT NULL,
+            type TEXT,
+            duration INTEGER,
+            status TEXT DEFAULT 'active',
+            category TEXT,
+            daily_limit INTEGER DEFAULT 1,
+            total_completions INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    
+    # Transactions table
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            task_id INTEGER,
+            task_title TEXT,
+            amount REAL NOT NULL,
+            type TEXT NOT NULL,
+            description TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            balance_after REAL,
+            withdrawal_id INTEGER,
+            status TEXT DEFAULT 'completed',
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Withdrawals table
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            user_email TEXT,
+            user_name TEXT,
+            amount REAL NOT NULL,
+            upi_id TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP,
+            transaction_id TEXT UNIQUE,
+            rejection_reason TEXT,
+            method TEXT DEFAULT 'upi',
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Referrals table
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS referrals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            referrer_id INTEGER,
+            referred_id INTEGER,
+            referral_code TEXT,
+            earned_amount REAL DEFAULT 0.0,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (referrer_id) REFERENCES users (id),
+            FOREIGN KEY (referred_id) REFERENCES users (id)
+        )
+    ''')
+    
+    # Daily login bonus
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS daily_logins (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            login_date DATE,
+            streak_count INTEGER DEFAULT 1,
+            bonus_amount REAL DEFAULT 0.0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(user_id, login_date)
+        )
+    ''')
+
+    db.commit()
+    print("✅ Database tables created")
+
+def seed_demo_data(db):
+    """Insert demo users and tasks into whichever of the two tables is empty."""
+    if db.execute('SELECT 1 FROM users LIMIT 1').fetchone() is None:
+        insert_demo_data(db)
+    if db.execute('SELECT 1 FROM tasks LIMIT 1').fetchone() is None:
+        insert_demo_tasks(db)
 
-def init_db():
+def init_db(seed=True):
+    """Create or upgrade the schema, then seed demo data if the database is empty."""
     with app.app_context():
         db = get_db()
-        
-        # Users table
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                name TEXT,
-                balance REAL DEFAULT 0.0,
-                tasks_done INTEGER DEFAULT 0,
-                total_earned REAL DEFAULT 0.0,
-                joined DATE DEFAULT CURRENT_DATE,
-                referral_code TEXT UNIQUE,
-                referrals_count INTEGER DEFAULT 0,
-                referral_earnings REAL DEFAULT 0.0,
-                is_admin BOOLEAN DEFAULT 0,
-                phone TEXT,
-                status TEXT DEFAULT 'active',
-                last_login TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tasks table
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS tasks (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                description TEXT,
-                reward REAL NOT NULL,
-                type TEXT,
-                duration INTEGER,
-                status TEXT DEFAULT 'active',
-                category TEXT,
-                daily_limit INTEGER DEFAULT 1,
-                total_completions INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Transactions table
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS transactions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                task_id INTEGER,
-                task_title TEXT,
-                amount REAL NOT NULL,
-                type TEXT NOT NULL,
-                description TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                balance_after REAL,
-                withdrawal_id INTEGER,
-                status TEXT DEFAULT 'completed',
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Withdrawals table
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS withdrawals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                user_email TEXT,
-                user_name TEXT,
-                amount REAL NOT NULL,
-                upi_id TEXT NOT NULL,
-                status TEXT DEFAULT 'pending',
-                requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                processed_at TIMESTAMP,
-                transaction_id TEXT UNIQUE,
-                rejection_reason TEXT,
-                method TEXT DEFAULT 'upi',
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Referrals table
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS referrals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                referrer_id INTEGER,
-                referred_id INTEGER,
-                referral_code TEXT,
-                earned_amount REAL DEFAULT 0.0,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (referrer_id) REFERENCES users (id),
-                FOREIGN KEY (referred_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Daily login bonus
-        db.execute('''
-            CREATE TABLE IF NOT EXISTS daily_logins (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                login_date DATE,
-                streak_count INTEGER DEFAULT 1,
-                bonus_amount REAL DEFAULT 0.0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                UNIQUE(user_id, login_date)
-            )
-        ''')
-        
+        create_schema(db)
+        run_migrations(db)
+        if seed:
+            seed_demo_data(db)
+
+def check_schema(database=DATABASE):
+    """Raise RuntimeError unless the database exists and every migration is applied.
+
+    One read on a throwaway connection, so calling it before fork leaves
+    nothing behind for workers to inherit.
+    """
+    latest = MIGRATIONS[-1][0]
+    current = 0
+    if os.path.exists(database):
+        with closing(sqlite3.connect(database, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)) as conn:
+            try:
+                current = conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+            except sqlite3.OperationalError:
+                pass
+    if current < latest:
+        raise RuntimeError(f"Database {database} is at schema version {current}, this code needs {latest}: "
+                           f"run `flask --app app db init` (or `db migrate`) before starting workers")
+    return current
+
+def create_app():
+    """WSGI entry point (`gunicorn 'app:create_app()'`); safe to call before fork with --preload."""
+    check_schema()
+    return app
+
+@app.cli.group('db')
+def db_command():
+    """Create, migrate and seed the database."""
+
+@db_command.command('init')
+@click.option('--seed', is_flag=True, help='Also insert demo users and tasks if the tables are empty.')
+def db_init_command(seed):
+    """Create all tables and apply every migration."""
+    init_db(seed=seed)
+    print(f"✅ Schema at version {check_schema()}")
+
+@db_command.command('migrate')
+def db_migrate_command():
+    """Apply pending migrations to an existing database."""
+    db = get_db()
+    if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone() is None:
+        raise click.ClickException("No schema yet: run `flask --app app db init` first")
+    run_migrations(db)
+    print(f"✅ Schema at version {check_schema()}")
+
+@db_command.command('seed')
+def db_seed_command():
+    """Insert demo users and tasks into empty tables."""
+    seed_demo_data(get_db())
+
+@db_command.command('status')
+def db_status_command():
+    """Show applied and pending migrations."""
+    db = get_db()
+    applied = {row[0] for row in db.execute('SELECT version FROM schema_version')} \
+        if db.execute("SELECT 1 FROM sqlite_master WHERE name = 'schema_version'").fetchone() else set()
+    for version, description, _ in MIGRATIONS:
+        print(f"{'✅' if version in applied else '⏳'} {version:>3} {description}")
+
+# ========== SCHEMA MIGRATIONS ==========
+# Ordered (version, description, steps). Steps are SQL strings or callables
+# taking the connection. Append new entries; never edit an applied one.
+MIGRATIONS = [
+    (1, 'Indexes for hot query paths', [
+        'CREATE INDEX IF NOT EXISTS idx_transactions_user_task_time ON transactions (user_id, task_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_user_time ON transactions (user_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_type_time ON transactions (type, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_time ON transactions (timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_transactions_withdrawal ON transactions (withdrawal_id)',
+        'CREATE INDEX IF NOT EXISTS idx_withdrawals_status_time ON withdrawals (status, requested_at)',
+        'CREATE INDEX IF NOT EXISTS idx_withdrawals_user_time ON withdrawals (user_id, requested_at)',
+        'CREATE INDEX IF NOT EXISTS idx_withdrawals_time ON withdrawals (requested_at)',
+        'CREATE INDEX IF NOT EXISTS idx_referrals_referrer_time ON referrals (referrer_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)',
+    ]),
+    (2, 'Per-user daily task completion counters', [
+        '''
+        CREATE TABLE IF NOT EXISTS task_daily_counts (
+            user_id INTEGER NOT NULL,
+            task_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, task_id, day)
+        ) WITHOUT ROWID
+        ''',
+        lambda db: db.execute('''
+            INSERT OR REPLACE INTO task_daily_counts (user_id, task_id, day, count)
+            SELECT user_id, task_id, DATE(timestamp, ?), COUNT(*)
+            FROM transactions
+            WHERE type = 'task_completion' AND task_id IS NOT NULL
+            GROUP BY user_id, task_id, DATE(timestamp, ?)
+        ''', (utc_offset_modifier(), utc_offset_modifier())),
+    ]),
+    (3, 'Daily rollups and platform totals', [
+        lambda db: rebuild_rollups(db),
+    ]),
+    (4, 'Indexes for admin list filters', [
+        'CREATE INDEX IF NOT EXISTS idx_users_status_created ON users (status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_referrals_time ON referrals (created_at)',
+    ]),
+    (5, 'Index for the earnings leaderboard', [
+        'CREATE INDEX IF NOT EXISTS idx_users_total_earned ON users (total_earned)',
+    ]),
+    (6, 'Per-user profile version stamps', [
+        '''
+        CREATE TABLE IF NOT EXISTS user_versions (
+            user_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        lambda db: create_profile_version_triggers(db),
+    ]),
+    (7, 'Login streak on users; referral earnings on referrals', [
+        'ALTER TABLE users ADD COLUMN current_streak INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE users ADD COLUMN last_login_date DATE',
+        # Every referral has always been credited REFERRAL_BONUS
+        lambda db: db.execute('UPDATE referrals SET earned_amount = ? WHERE earned_amount = 0', (REFERRAL_BONUS,)),
+        lambda db: db.execute(USER_STREAK_REBUILD),
+    ]),
+    (8, 'Payout batches and withdrawal settlement state', [
+        '''
+        CREATE TABLE IF NOT EXISTS payout_batches (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL DEFAULT 'sent',
+            item_count INTEGER NOT NULL DEFAULT 0,
+            total_amount REAL NOT NULL DEFAULT 0,
+            paid_count INTEGER NOT NULL DEFAULT 0,
+            paid_amount REAL NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            failed_amount REAL NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            settled_at TIMESTAMP
+        )
+        ''',
+        'ALTER TABLE withdrawals ADD COLUMN payout_batch_id INTEGER REFERENCES payout_batches (id)',
+        'ALTER TABLE withdrawals ADD COLUMN payout_status TEXT',
+        'ALTER TABLE withdrawals ADD COLUMN payout_reference TEXT',
+        'ALTER TABLE withdrawals ADD COLUMN payout_note TEXT',
+        'ALTER TABLE withdrawals ADD COLUMN settled_at TIMESTAMP',
+        'CREATE INDEX IF NOT EXISTS idx_withdrawals_payout_queue ON withdrawals (status, payout_status, id)',
+        'CREATE INDEX IF NOT EXISTS idx_withdrawals_payout_batch ON withdrawals (payout_batch_id, id)',
+        'CREATE INDEX IF NOT EXISTS idx_payout_batches_time ON payout_batches (created_at)',
+    ]),
+    (9, 'Append-only wallet ledger with balance snapshots', [
+        '''
+        CREATE TABLE IF NOT EXISTS ledger_entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            seq INTEGER NOT NULL,
+            account TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            reference TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (user_id, seq)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ledger_snapshots (
+            user_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            balance INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, seq)
+        ) WITHOUT ROWID
+        ''',
+        lambda db: db.execute(LEDGER_OPENING_BALANCES),
+        lambda db: create_ledger_triggers(db),
+    ]),
+    (10, 'Idempotency keys for money-moving endpoints', [
+        '''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            status INTEGER,
+            body TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, key)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)',
+    ]),
+    (11, 'Risk scores, shared identities and scoring cursors', [
+        '''
+        CREATE TABLE IF NOT EXISTS risk_scores (
+            user_id INTEGER PRIMARY KEY,
+            score INTEGER NOT NULL DEFAULT 0,
+            flagged INTEGER NOT NULL DEFAULT 0,
+            reasons TEXT NOT NULL DEFAULT '[]',
+            cleared_score INTEGER NOT NULL DEFAULT 0,
+            completions INTEGER NOT NULL DEFAULT 0,
+            peak_completions_per_minute INTEGER NOT NULL DEFAULT 0,
+            completion_window TEXT NOT NULL DEFAULT '',
+            referrals INTEGER NOT NULL DEFAULT 0,
+            peak_referrals_per_day INTEGER NOT NULL DEFAULT 0,
+            referral_window TEXT NOT NULL DEFAULT '',
+            shared_phone_accounts INTEGER NOT NULL DEFAULT 0,
+            shared_upi_accounts INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_risk_scores_flagged ON risk_scores (flagged, score, user_id)',
+        '''
+        CREATE TABLE IF NOT EXISTS risk_identities (
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (kind, value, user_id)
+        ) WITHOUT ROWID
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_risk_identities_user ON risk_identities (user_id, kind, value)',
+        '''
+        CREATE TABLE IF NOT EXISTS risk_cursors (
+            stream TEXT PRIMARY KEY,
+            last_id INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+    ]),
+]
+
+def schema_version(db):
+    return db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+def run_migrations(db):
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    db.commit()
+
+    for version, description, steps in MIGRATIONS:
+        if version <= schema_version(db):
+            continue
+        # Take the write lock before re-checking so concurrent workers
+        # booting against a fresh database apply each step exactly once
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if version <= schema_version(db):
+                db.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(db)
+                else:
+                    db.execute(step)
+            db.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                       (version, description))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        print(f"✅ Migration {version} applied: {description}")
+
+# user_versions.version changes whenever anything /api/user/<id> returns may
+# have changed. Every balance-changing write updates the users row, and a
+# withdrawal approval changes its status, so two triggers cover them all.
+def create_profile_version_triggers(db):
+    bump = '''
+        INSERT INTO user_versions (user_id, version) VALUES ({row}, 1)
+        ON CONFLICT (user_id) DO UPDATE SET version = version + 1;
+    '''
+    triggers = {
+        'trg_profile_version_users': ('AFTER UPDATE ON users', bump.format(row='NEW.id')),
+        'trg_profile_version_withdrawals': ('AFTER UPDATE OF status ON withdrawals', bump.format(row='NEW.user_id')),
+    }
+    for name, (event, body) in triggers.items():
+        db.execute(f'DROP TRIGGER IF EXISTS {name}')
+        db.execute(f'CREATE TRIGGER {name} {event} BEGIN {body} END')
+
+# ========== USER AGGREGATES ==========
+# users.current_streak / last_login_date and users.referrals_count /
+# referral_earnings are maintained by login and register in the same
+# transaction as the rows they summarise, so profile and login read them with
+# a primary-key lookup. 'flask user-stats-rebuild' recomputes them.
+REFERRAL_BONUS = 50.0
+DAILY_BONUS_STEP = 10
+DAILY_BONUS_MAX = 70
+
+USER_STREAK_REBUILD = '''
+    UPDATE users SET
+    current_streak = COALESCE((SELECT streak_count FROM daily_logins d WHERE d.user_id = users.id
+                               ORDER BY login_date DESC LIMIT 1), 0),
+    last_login_date = (SELECT MAX(login_date) FROM daily_logins d WHERE d.user_id = users.id)
+'''
+
+USER_REFERRALS_REBUILD = '''
+    UPDATE users SET
+    referrals_count = (SELECT COUNT(*) FROM referrals r WHERE r.referrer_id = users.id),
+    referral_earnings = (SELECT COALESCE(SUM(earned_amount), 0) FROM referrals r WHERE r.referrer_id = users.id)
+'''
+
+def daily_bonus_for(streak):
+    return min(streak * DAILY_BONUS_STEP, DAILY_BONUS_MAX)
+
+@app.cli.command('user-stats-rebuild')
+def user_stats_rebuild_command():
+    """Recompute login streaks and referral totals on users from daily_logins and referrals."""
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    db.execute(USER_STREAK_REBUILD)
+    db.execute(USER_REFERRALS_REBUILD)
+    db.commit()
+    print("✅ User streaks and referral totals rebuilt")
+
+# The user row and its version stamp in one round trip
+PROFILE_QUERY = '''
+    SELECT u.*, COALESCE(v.version, 0) AS profile_version
+    FROM users u
+    LEFT JOIN user_versions v ON v.user_id = u.id
+    WHERE u.id = ?
+'''
+
+# ========== LEDGER ==========
+# ledger_entries is the book of record for wallet balances. Every credit or
+# debit is appended with the user's next seq and names the platform account
+# on the other side (task_completion, withdrawal, ...), so wallets and
+# platform accounts always sum to zero. Amounts are integer paise. Entries
+# are never updated or deleted; a refund is a new entry. Every
+# LEDGER_SNAPSHOT_INTERVAL entries a trigger stores the running balance in
+# ledger_snapshots, so any balance is one snapshot plus a short tail.
+# users.balance stays the read path; 'flask ledger-reconcile' checks it.
+LEDGER_SNAPSHOT_INTERVAL = 64
+LEDGER_RECONCILE_SAMPLE = 100
+LEDGER_PAGE_SIZE = 50
+
+LEDGER_POST = '''
+    INSERT INTO ledger_entries (user_id, seq, account, amount, reference)
+    VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM ledger_entries WHERE user_id = ?), ?, ?, ?)
+'''
+
+# The latest snapshot plus the entries after it. With MAX(), SQLite takes
+# the bare balance column from the row holding the maximum seq.
+LEDGER_BALANCE = '''
+    SELECT COALESCE(s.seq, 0) AS snapshot_seq,
+           COALESCE(s.balance, 0) + COALESCE(SUM(e.amount), 0) AS balance,
+           COALESCE(MAX(e.seq), s.seq, 0) AS seq,
+           COUNT(e.seq) AS tail
+    FROM (SELECT MAX(seq) AS seq, balance FROM ledger_snapshots WHERE user_id = {user}) s
+    LEFT JOIN ledger_entries e ON e.user_id = {user} AND e.seq > COALESCE(s.seq, 0)
+'''
+
+# An opening entry for every user the ledger has not seen yet
+LEDGER_OPENING_BALANCES = '''
+    INSERT INTO ledger_entries (user_id, seq, account, amount, reference)
+    SELECT id, 1, 'opening_balance', CAST(ROUND(balance * 100) AS INTEGER), 'users.balance'
+    FROM users
+    WHERE CAST(ROUND(balance * 100) AS INTEGER) != 0
+    AND NOT EXISTS (SELECT 1 FROM ledger_entries e WHERE e.user_id = users.id)
+'''
+
+def create_ledger_triggers(db):
+    append_only = "SELECT RAISE(ABORT, '{table} is append-only');"
+    triggers = {
+        'trg_ledger_snapshot': (
+            f'AFTER INSERT ON ledger_entries WHEN NEW.seq % {LEDGER_SNAPSHOT_INTERVAL} = 0',
+            f'''
+            INSERT OR IGNORE INTO ledger_snapshots (user_id, seq, balance)
+            SELECT NEW.user_id, NEW.seq, balance FROM ({LEDGER_BALANCE.format(user='NEW.user_id')});
+            '''),
+    }
+    for table in ('ledger_entries', 'ledger_snapshots'):
+        for event in ('UPDATE', 'DELETE'):
+            triggers[f'trg_{table}_no_{event.lower()}'] = (f'BEFORE {event} ON {table}', append_only.format(table=table))
+    for name, (event, body) in triggers.items():
+        db.execute(f'DROP TRIGGER IF EXISTS {name}')
+        db.execute(f'CREATE TRIGGER {name} {event} BEGIN {body} END')
+
+def to_paise(amount):
+    return int(round(float(amount) * 100))
+
+def post_ledger(db, postings):
+    """Append (user_id, amount, account, reference) postings, amounts in rupees.
+
+    Call inside the write transaction that moves users.balance by the same
+    amounts. Zero amounts are skipped.
+    """
+    db.executemany(LEDGER_POST, [
+        (user_id, user_id, account, to_paise(amount), reference)
+        for user_id, amount, account, reference in postings if to_paise(amount)
+    ])
+
+def ledger_balance(db, user_id):
+    """{"balance", "seq", "snapshot_seq", "tail"} for user_id, read from the ledger."""
+    row = row_to_dict(db.execute(LEDGER_BALANCE.format(user='?'), (user_id, user_id)).fetchone())
+    row['balance'] /= 100
+    return row
+
+def reconcile_ledger(db, snapshot=False, sample=LEDGER_RECONCILE_SAMPLE):
+    """Check every user's balance against the ledger in one ordered pass.
+
+    users, ledger_entries and ledger_snapshots are each read once, merged on
+    (user_id, seq) inside one read transaction, so memory does not grow with
+    the ledger. Reports seq gaps, snapshots that differ from the running sum
+    at their seq, entries without a user, and users whose balance differs
+    from the ledger by a paisa or more. With snapshot=True, users that
+    reconciled cleanly get a snapshot at their head, written after the pass.
+    """
+    started = time.perf_counter()
+    issues, samples, accounts = {}, [], {}
+    users_checked = entries_checked = snapshots_checked = wallets = 0
+    heads = []
+
+    def issue(kind, **detail):
+        issues[kind] = issues.get(kind, 0) + 1
+        if len(samples) < sample:
+            samples.append({"kind": kind, **detail})
+
+    def rows(query):
+        cursor = db.cursor()
+        cursor.row_factory = None
+        return cursor.execute(query)
+
+    db.execute('BEGIN')
+    try:
+        entries = rows('SELECT user_id, seq, amount, account FROM ledger_entries ORDER BY user_id, seq')
+        snapshots = rows('SELECT user_id, seq, balance FROM ledger_snapshots ORDER BY user_id, seq')
+        entry, snap = next(entries, None), next(snapshots, None)
+
+        for user_id, balance in rows('SELECT id, CAST(ROUND(balance * 100) AS INTEGER) FROM users ORDER BY id'):
+            users_checked += 1
+            while entry is not None and entry[0] < user_id:
+                issue('orphan', user_id=entry[0], seq=entry[1])
+                entry = next(entries, None)
+            while snap is not None and snap[0] < user_id:
+                issue('snapshot', user_id=snap[0], seq=snap[1], error="No entries for this snapshot")
+                snap = next(snapshots, None)
+            known = sum(issues.values())
+
+            total = seq = snapshot_seq = 0
+            while entry is not None and entry[0] == user_id:
+                seq += 1
+                if entry[1] != seq:
+                    issue('sequence', user_id=user_id, expected=seq, found=entry[1])
+                    seq = entry[1]
+                total += entry[2]
+                accounts[entry[3]] = accounts.get(entry[3], 0) - entry[2]
+                entries_checked += 1
+                while snap is not None and snap[0] == user_id and snap[1] <= seq:
+                    if snap[1] < seq or snap[2] != total:
+                        issue('snapshot', user_id=user_id, seq=snap[1], snapshot=snap[2] / 100, ledger=total / 100)
+                    snapshots_checked += 1
+                    snapshot_seq = snap[1]
+                    snap = next(snapshots, None)
+                entry = next(entries, None)
+            while snap is not None and snap[0] == user_id:
+                issue('snapshot', user_id=user_id, seq=snap[1], error="Snapshot is past the last entry")
+                snap = next(snapshots, None)
+
+            wallets += total
+            if total != balance:
+                issue('balance', user_id=user_id, balance=balance / 100, ledger=total / 100)
+            elif snapshot and seq > snapshot_seq and sum(issues.values()) == known:
+                heads.append((user_id, seq, total))
+
+        while entry is not None:
+            issue('orphan', user_id=entry[0], seq=entry[1])
+            entry = next(entries, None)
+    finally:
+        db.rollback()
+
+    if heads:
+        db.execute('BEGIN IMMEDIATE')
+        db.executemany('INSERT OR IGNORE INTO ledger_snapshots (user_id, seq, balance) VALUES (?, ?, ?)', heads)
         db.commit()
-        print("✅ Database tables created")
-        
-        # Insert demo data if empty
-        cursor = db.execute('SELECT COUNT(*) FROM users')
-        if cursor.fetchone()[0] == 0:
-            insert_demo_data(db)
-        
-        cursor = db.execute('SELECT COUNT(*) FROM tasks')
-        if cursor.fetchone()[0] == 0:
-            insert_demo_tasks(db)
+
+    elapsed = time.perf_counter() - started
+    return {
+        "ok": not issues,
+        "users": users_checked,
+        "entries": entries_checked,
+        "snapshots_checked": snapshots_checked,
+        "snapshots_written": len(heads),
+        "issues": issues,
+        "samples": samples,
+        # Wallets plus platform accounts always net to zero
+        "wallets": wallets / 100,
+        "accounts": {account: amount / 100 for account, amount in sorted(accounts.items())},
+        "seconds": round(elapsed, 3),
+        "entries_per_minute": int(entries_checked / elapsed * 60) if elapsed else 0,
+    }
+
+@app.cli.command('ledger-reconcile')
+@click.option('--snapshot', is_flag=True, help='Snapshot every cleanly reconciled user at their latest entry.')
+def ledger_reconcile_command(snapshot):
+    """Check users.balance for every user against the ledger."""
+    report = reconcile_ledger(get_db(), snapshot=snapshot)
+    for sample in report['samples']:
+        print(f"❌ {sample}")
+    print(f"{'✅' if report['ok'] else '❌'} {report['users']} users, {report['entries']} entries, "
+          f"{report['snapshots_checked']} snapshots checked in {report['seconds']}s "
+          f"({report['entries_per_minute']} entries/min); issues: {report['issues'] or 'none'}")
+    if report['snapshots_written']:
+        print(f"✅ {report['snapshots_written']} snapshots written")
+
+# Representative hot-path queries; each must be answered through an index.
+# Checked with EXPLAIN QUERY PLAN by tests/test_query_plans.py, and against
+# the live database by /api/admin/db/query-plans.
+HOT_QUERIES = {
+    'complete_task_daily_limit': (
+        'SELECT count FROM task_daily_counts WHERE user_id = ? AND task_id = ? AND day = ?',
+        (1, 1, '2024-01-01')),
+    'user_transactions': (
+        'SELECT * FROM transactions WHERE user_id = ? ORDER BY timestamp DESC LIMIT 20',
+        (1,)),
+    'user_withdrawals': (
+        'SELECT * FROM withdrawals WHERE user_id = ? ORDER BY requested_at DESC LIMIT 10',
+        (1,)),
+    'withdraw_daily_limit': (
+        "SELECT SUM(amount) FROM withdrawals WHERE user_id = ? AND requested_at >= ? AND requested_at < ? AND status IN ('pending', 'approved')",
+        (1, '2024-01-01', '2024-01-02')),
+    'pending_withdrawals': (
+        "SELECT * FROM withdrawals WHERE status = 'pending' ORDER BY requested_at DESC",
+        ()),
+    'today_task_earnings': (
+        "SELECT SUM(amount) FROM transactions WHERE timestamp >= ? AND timestamp < ? AND type = 'task_completion'",
+        ('2024-01-01', '2024-01-02')),
+    'bulk_pending_withdrawals': (
+        "SELECT id, user_id, amount, status FROM withdrawals WHERE status = 'pending' AND amount <= ? ORDER BY requested_at, id LIMIT ?",
+        (500, 10000)),
+    'payout_queue': (
+        "SELECT id FROM withdrawals WHERE status = 'approved' AND payout_status IS NULL ORDER BY id LIMIT ?",
+        (5000,)),
+    'payout_batch_file': (
+        'SELECT id, transaction_id, upi_id, amount FROM withdrawals WHERE payout_batch_id = ? ORDER BY id',
+        (1,)),
+    'settlement_lookup': (
+        'SELECT id, user_id, amount, transaction_id, payout_batch_id, payout_status FROM withdrawals WHERE transaction_id IN (?, ?)',
+        ('WT1', 'WT2')),
+    'ledger_balance': (
+        LEDGER_BALANCE.format(user='?'),
+        (1, 1)),
+    'ledger_next_seq': (
+        'SELECT COALESCE(MAX(seq), 0) + 1 FROM ledger_entries WHERE user_id = ?',
+        (1,)),
+    'ledger_page': (
+        'SELECT * FROM ledger_entries WHERE user_id = ? AND seq < ? ORDER BY seq DESC LIMIT ?',
+        (1, 100, 50)),
+    'idempotency_claim': (
+        'SELECT fingerprint, status, body FROM idempotency_keys WHERE user_id = ? AND key = ?',
+        (1, 'key')),
+    'idempotency_prune': (
+        'SELECT user_id, key FROM idempotency_keys WHERE created_at < ? ORDER BY created_at LIMIT ?',
+        ('2024-01-01 00:00:00', 1000)),
+    'risk_lookup': (
+        'SELECT score, flagged FROM risk_scores WHERE user_id = ?',
+        (1,)),
+    'risk_flagged_page': (
+        'SELECT user_id, score FROM risk_scores WHERE flagged = 1 AND (score, user_id) < (?, ?) ORDER BY score DESC, user_id DESC LIMIT 51',
+        (100, 1)),
+    'risk_shared_accounts': (
+        "SELECT i.user_id, MAX((SELECT COUNT(*) FROM risk_identities o WHERE o.kind = i.kind AND o.value = i.value)) - 1 FROM risk_identities i WHERE i.kind = 'upi' AND i.user_id IN (?, ?) GROUP BY i.user_id",
+        (1, 2)),
+    'risk_completion_stream': (
+        "SELECT id, user_id, timestamp FROM transactions WHERE id > ? AND id <= ? AND +type = 'task_completion' ORDER BY id LIMIT ?",
+        (0, 1000, 5000)),
+    'referral_list': (
+        'SELECT * FROM referrals WHERE referrer_id = ? ORDER BY created_at DESC',
+        (1,)),
+    'withdrawal_transactions': (
+        'SELECT * FROM transactions WHERE withdrawal_id = ?',
+        (1,)),
+    'admin_transactions_page': (
+        'SELECT * FROM transactions WHERE type = ? AND (timestamp, id) < (?, ?) ORDER BY timestamp DESC, id DESC LIMIT 51',
+        ('task_completion', '2024-01-01 00:00:00', 1)),
+    'admin_withdrawals_page': (
+        'SELECT * FROM withdrawals WHERE status = ? AND (requested_at, id) < (?, ?) ORDER BY requested_at DESC, id DESC LIMIT 51',
+        ('pending', '2024-01-01 00:00:00', 1)),
+    'leaderboard_all_time': (
+        'SELECT id, total_earned FROM users ORDER BY total_earned DESC, id LIMIT 10',
+        ()),
+    'profile_stats': (
+        PROFILE_QUERY,
+        (1,)),
+    'leaderboard_window': (
+        "SELECT user_id, SUM(amount) FROM transactions WHERE type IN ('task_completion', 'referral_bonus', 'daily_bonus') AND timestamp >= ? AND timestamp < ? GROUP BY user_id",
+        ('2024-01-01', '2024-01-08')),
+}
+
+def explain_hot_queries(db):
+    """Return {name: {"plan": [...], "uses_index": bool}} for HOT_QUERIES."""
+    report = {}
+    for name, (query, params) in HOT_QUERIES.items():
+        plan = [row[3] for row in db.execute(f'EXPLAIN QUERY PLAN {query}', params).fetchall()]
+        # Scanning a subquery's own result rows is not a table scan
+        subqueries = {step.split(' ', 1)[1] for step in plan if step.startswith(('CO-ROUTINE ', 'MATERIALIZE '))}
+        scans = [step for step in plan if step.startswith('SCAN') and 'USING' not in step
+                 and step.split(' ')[1] not in subqueries]
+        report[name] = {"plan": plan, "uses_index": not scans}
+    return report
+
+# ========== DAILY ROLLUPS ==========
+# daily_stats holds one row per business day and platform_totals a single row
+# of running totals. Both are kept current by triggers on users, transactions
+# and withdrawals, so dashboards read a handful of rows instead of scanning.
+# Withdrawal figures are attributed to the day the request was made.
+DAILY_STATS_COLUMNS = [
+    'signups', 'task_completions', 'task_earnings', 'signup_bonus', 'referral_bonus', 'daily_bonus',
+    'withdrawal_count', 'withdrawal_amount', 'approved_count', 'approved_amount',
+    'rejected_count', 'rejected_amount',
+]
+PLATFORM_TOTALS_COLUMNS = ['users', 'active_users', 'total_balance', 'total_earned']
+
+DAILY_STATS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        day DATE PRIMARY KEY,
+        signups INTEGER NOT NULL DEFAULT 0,
+        task_completions INTEGER NOT NULL DEFAULT 0,
+        task_earnings REAL NOT NULL DEFAULT 0,
+        signup_bonus REAL NOT NULL DEFAULT 0,
+        referral_bonus REAL NOT NULL DEFAULT 0,
+        daily_bonus REAL NOT NULL DEFAULT 0,
+        withdrawal_count INTEGER NOT NULL DEFAULT 0,
+        withdrawal_amount REAL NOT NULL DEFAULT 0,
+        approved_count INTEGER NOT NULL DEFAULT 0,
+        approved_amount REAL NOT NULL DEFAULT 0,
+        rejected_count INTEGER NOT NULL DEFAULT 0,
+        rejected_amount REAL NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+'''
+
+def create_rollup_tables(db):
+    db.execute(DAILY_STATS_SCHEMA.format(table='daily_stats'))
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS platform_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            users INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0,
+            total_balance REAL NOT NULL DEFAULT 0,
+            total_earned REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    db.execute('INSERT OR IGNORE INTO platform_totals (id) VALUES (1)')
+
+def create_rollup_triggers(db):
+    """(Re)create the rollup triggers with the current business-day offset."""
+    day = f"DATE({{}}, '{utc_offset_modifier()}')"
+    bump = '''
+        INSERT INTO daily_stats (day) VALUES ({day}) ON CONFLICT (day) DO NOTHING;
+        UPDATE daily_stats SET {changes} WHERE day = {day};
+    '''
+    withdrawal_changes = '''
+        withdrawal_count = withdrawal_count {op} 1,
+        withdrawal_amount = withdrawal_amount {op} {row}.amount,
+        approved_count = approved_count {op} ({row}.status = 'approved'),
+        approved_amount = approved_amount {op} CASE WHEN {row}.status = 'approved' THEN {row}.amount ELSE 0 END,
+        rejected_count = rejected_count {op} ({row}.status = 'rejected'),
+        rejected_amount = rejected_amount {op} CASE WHEN {row}.status = 'rejected' THEN {row}.amount ELSE 0 END
+    '''
+    transaction_changes = '''
+        task_completions = task_completions + (NEW.type = 'task_completion'),
+        task_earnings = task_earnings + CASE WHEN NEW.type = 'task_completion' THEN NEW.amount ELSE 0 END,
+        signup_bonus = signup_bonus + CASE WHEN NEW.type = 'signup_bonus' THEN NEW.amount ELSE 0 END,
+        referral_bonus = referral_bonus + CASE WHEN NEW.type = 'referral_bonus' THEN NEW.amount ELSE 0 END,
+        daily_bonus = daily_bonus + CASE WHEN NEW.type = 'daily_bonus' THEN NEW.amount ELSE 0 END
+    '''
+    totals_changes = '''
+        UPDATE platform_totals SET
+        users = users {op} 1,
+        active_users = active_users {op} ({row}.status = 'active'),
+        total_balance = total_balance {op} COALESCE({row}.balance, 0),
+        total_earned = total_earned {op} COALESCE({row}.total_earned, 0)
+        WHERE id = 1;
+    '''
+    triggers = {
+        'trg_rollup_users_insert': (
+            'AFTER INSERT ON users',
+            bump.format(day=day.format('NEW.created_at'), changes='signups = signups + 1')
+            + totals_changes.format(op='+', row='NEW')),
+        'trg_rollup_users_update': (
+            'AFTER UPDATE OF balance, total_earned, status ON users',
+            '''
+            UPDATE platform_totals SET
+            active_users = active_users + (NEW.status = 'active') - (OLD.status = 'active'),
+            total_balance = total_balance + COALESCE(NEW.balance, 0) - COALESCE(OLD.balance, 0),
+            total_earned = total_earned + COALESCE(NEW.total_earned, 0) - COALESCE(OLD.total_earned, 0)
+            WHERE id = 1;
+            '''),
+        'trg_rollup_users_signup_day': (
+            'AFTER UPDATE OF created_at ON users WHEN OLD.created_at IS NOT NEW.created_at',
+            bump.format(day=day.format('OLD.created_at'), changes='signups = signups - 1')
+            + bump.format(day=day.format('NEW.created_at'), changes='signups = signups + 1')),
+        'trg_rollup_users_delete': (
+            'AFTER DELETE ON users',
+            bump.format(day=day.format('OLD.created_at'), changes='signups = signups - 1')
+            + totals_changes.format(op='-', row='OLD')),
+        'trg_rollup_transactions_insert': (
+            "AFTER INSERT ON transactions WHEN NEW.type IN ('task_completion', 'signup_bonus', 'referral_bonus', 'daily_bonus')",
+            bump.format(day=day.format('NEW.timestamp'), changes=transaction_changes)),
+        'trg_rollup_withdrawals_insert': (
+            'AFTER INSERT ON withdrawals',
+            bump.format(day=day.format('NEW.requested_at'),
+                        changes=withdrawal_changes.format(op='+', row='NEW'))),
+        'trg_rollup_withdrawals_update': (
+            'AFTER UPDATE OF status, amount, requested_at ON withdrawals',
+            bump.format(day=day.format('OLD.requested_at'),
+                        changes=withdrawal_changes.format(op='-', row='OLD'))
+            + bump.format(day=day.format('NEW.requested_at'),
+                          changes=withdrawal_changes.format(op='+', row='NEW'))),
+    }
+    for name, (event, body) in triggers.items():
+        db.execute(f'DROP TRIGGER IF EXISTS {name}')
+        db.execute(f'CREATE TRIGGER {name} {event} BEGIN {body} END')
+
+def _rollup_source_statements(target):
+    """Statements aggregating the raw tables into `target` (a daily_stats-shaped table)."""
+    day = f"DATE({{}}, '{utc_offset_modifier()}')"
+    return [
+        f'''
+        INSERT INTO {target} (day, signups)
+        SELECT {day.format('created_at')}, COUNT(*) FROM users WHERE true GROUP BY 1
+        ON CONFLICT (day) DO UPDATE SET signups = excluded.signups
+        ''',
+        f'''
+        INSERT INTO {target} (day, task_completions, task_earnings, signup_bonus, referral_bonus, daily_bonus)
+        SELECT {day.format('timestamp')},
+            SUM(type = 'task_completion'),
+            SUM(CASE WHEN type = 'task_completion' THEN amount ELSE 0 END),
+            SUM(CASE WHEN type = 'signup_bonus' THEN amount ELSE 0 END),
+            SUM(CASE WHEN type = 'referral_bonus' THEN amount ELSE 0 END),
+            SUM(CASE WHEN type = 'daily_bonus' THEN amount ELSE 0 END)
+        FROM transactions
+        WHERE type IN ('task_completion', 'signup_bonus', 'referral_bonus', 'daily_bonus')
+        GROUP BY 1
+        ON CONFLICT (day) DO UPDATE SET
+            task_completions = excluded.task_completions,
+            task_earnings = excluded.task_earnings,
+            signup_bonus = excluded.signup_bonus,
+            referral_bonus = excluded.referral_bonus,
+            daily_bonus = excluded.daily_bonus
+        ''',
+        f'''
+        INSERT INTO {target} (day, withdrawal_count, withdrawal_amount, approved_count,
+                              approved_amount, rejected_count, rejected_amount)
+        SELECT {day.format('requested_at')},
+            COUNT(*),
+            SUM(amount),
+            SUM(status = 'approved'),
+            SUM(CASE WHEN status = 'approved' THEN amount ELSE 0 END),
+            SUM(status = 'rejected'),
+            SUM(CASE WHEN status = 'rejected' THEN amount ELSE 0 END)
+        FROM withdrawals WHERE true GROUP BY 1
+        ON CONFLICT (day) DO UPDATE SET
+            withdrawal_count = excluded.withdrawal_count,
+            withdrawal_amount = excluded.withdrawal_amount,
+            approved_count = excluded.approved_count,
+            approved_amount = excluded.approved_amount,
+            rejected_count = excluded.rejected_count,
+            rejected_amount = excluded.rejected_amount
+        ''',
+    ]
+
+PLATFORM_TOTALS_SOURCE = '''
+    SELECT COUNT(*), COALESCE(SUM(status = 'active'), 0),
+           COALESCE(SUM(balance), 0), COALESCE(SUM(total_earned), 0)
+    FROM users
+'''
+
+def rebuild_rollups(db):
+    """Recompute daily_stats and platform_totals from the raw tables."""
+    create_rollup_tables(db)
+    create_rollup_triggers(db)
+    db.execute('DELETE FROM daily_stats')
+    for statement in _rollup_source_statements('daily_stats'):
+        db.execute(statement)
+    totals = db.execute(PLATFORM_TOTALS_SOURCE).fetchone()
+    db.execute('UPDATE platform_totals SET users = ?, active_users = ?, total_balance = ?, total_earned = ? WHERE id = 1',
+               tuple(totals))
+
+def check_rollups(db):
+    """Compare rollups against the raw tables; returns a list of mismatches."""
+    db.execute('DROP TABLE IF EXISTS temp.daily_stats_expected')
+    db.execute(DAILY_STATS_SCHEMA.format(table='temp.daily_stats_expected'))
+    for statement in _rollup_source_statements('temp.daily_stats_expected'):
+        db.execute(statement)
+
+    # Amounts are rounded to paise so float drift between incremental and
+    # bulk sums is not reported; all-zero rollup days are ignored.
+    columns = ', '.join(f'ROUND({c}, 2) AS {c}' for c in DAILY_STATS_COLUMNS)
+    nonzero = ' OR '.join(f'{c} != 0' for c in DAILY_STATS_COLUMNS)
+    rollup = f'SELECT day, {columns} FROM daily_stats WHERE {nonzero}'
+    raw = f'SELECT day, {columns} FROM temp.daily_stats_expected'
+    mismatches = [dict(row_to_dict(row), source='rollup') for row in db.execute(f'{rollup} EXCEPT {raw}')]
+    mismatches += [dict(row_to_dict(row), source='raw') for row in db.execute(f'{raw} EXCEPT {rollup}')]
+    db.execute('DROP TABLE temp.daily_stats_expected')
+
+    stored = db.execute(f'SELECT {", ".join(PLATFORM_TOTALS_COLUMNS)} FROM platform_totals WHERE id = 1').fetchone()
+    expected = db.execute(PLATFORM_TOTALS_SOURCE).fetchone()
+    for column, have, want in zip(PLATFORM_TOTALS_COLUMNS, stored, expected):
+        if round(have or 0, 2) != round(want or 0, 2):
+            mismatches.append({"source": "platform_totals", "column": column, "rollup": have, "raw": want})
+    return mismatches
+
+def get_daily_stats(db, day):
+    row = db.execute('SELECT * FROM daily_stats WHERE day = ?', (day.isoformat(),)).fetchone()
+    stats = row_to_dict(row) or {column: 0 for column in DAILY_STATS_COLUMNS}
+    stats['day'] = day.isoformat()
+    return stats
+
+def pending_amount(stats):
+    return stats['withdrawal_amount'] - stats['approved_amount'] - stats['rejected_amount']
+
+def get_platform_totals(db):
+    row = db.execute('SELECT * FROM platform_totals WHERE id = 1').fetchone()
+    return row_to_dict(row)
+
+def sum_daily_stats(db, start=None, end=None):
+    """Sum daily_stats columns over business days start <= day < end (either open)."""
+    columns = ', '.join(f'COALESCE(SUM({c}), 0) AS {c}' for c in DAILY_STATS_COLUMNS)
+    query = f'SELECT {columns} FROM daily_stats WHERE day >= ? AND day < ?'
+    bounds = (start.isoformat() if start else '0000-00-00', end.isoformat() if end else '9999-99-99')
+    return row_to_dict(db.execute(query, bounds).fetchone())
+
+MAX_REPORT_DAYS = 731
+
+def parse_report_range(default_days):
+    """Read ?days=N or ?from=YYYY-MM-DD&to=YYYY-MM-DD (inclusive) from the request.
+
+    Returns (start, end) business dates with `end` exclusive, or raises
+    ValueError with a user-facing message.
+    """
+    date_from = request.args.get('from')
+    date_to = request.args.get('to')
+    if date_from or date_to:
+        try:
+            end = (datetime.strptime(date_to, '%Y-%m-%d').date() if date_to else business_today()) + timedelta(days=1)
+            start = datetime.strptime(date_from, '%Y-%m-%d').date() if date_from else end - timedelta(days=default_days)
+        except ValueError:
+            raise ValueError("Dates must be in YYYY-MM-DD format")
+    else:
+        days = int_arg('days') if request.args.get('days') else default_days
+        if days < 1:
+            raise ValueError("'days' must be at least 1")
+        end = business_today() + timedelta(days=1)
+        start = end - timedelta(days=days)
+    if start >= end:
+        raise ValueError("'from' must not be after 'to'")
+    if (end - start).days > MAX_REPORT_DAYS:
+        raise ValueError(f"Range too large (Max: {MAX_REPORT_DAYS} days)")
+    return start, end
+
+def daily_series(db, start, end):
+    """One daily_stats entry per business day in [start, end), gaps filled with zeros.
+
+    Each entry also carries `total_users`, the cumulative signup count at the
+    end of that day, computed with a running-sum window in the same query.
+    """
+    columns = ', '.join(DAILY_STATS_COLUMNS)
+    cursor = db.execute(f'''
+        SELECT day, {columns}, SUM(signups) OVER (ORDER BY day) AS total_users
+        FROM daily_stats
+        WHERE day < ?
+        ORDER BY day
+    ''', (end.isoformat(),))
+
+    by_day = {}
+    total_users = 0
+    for row in cursor:
+        if row['day'] < start.isoformat():
+            total_users = row['total_users']
+        else:
+            by_day[row['day']] = row_to_dict(row)
+
+    series = []
+    day = start
+    while day < end:
+        entry = by_day.get(day.isoformat())
+        if entry is None:
+            entry = {column: 0 for column in DAILY_STATS_COLUMNS}
+            entry['day'] = day.isoformat()
+            entry['total_users'] = total_users
+        total_users = entry['total_users']
+        series.append(entry)
+        day += timedelta(days=1)
+    return series
+
+@app.cli.command('rollups-rebuild')
+def rollups_rebuild_command():
+    """Rebuild daily_stats and platform_totals from the raw tables."""
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    rebuild_rollups(db)
+    db.commit()
+    print("✅ Rollups rebuilt")
+
+@app.cli.command('rollups-check')
+def rollups_check_command():
+    """Compare rollups against the raw tables."""
+    mismatches = check_rollups(get_db())
+    for mismatch in mismatches:
+        print(f"❌ {mismatch}")
+    print("✅ Rollups consistent" if not mismatches else f"❌ {len(mismatches)} mismatches")
 
 def insert_demo_data(db):
-    # Hash passwords for security
-    def hash_password(password):
-        return hashlib.sha256(password.encode()).hexdigest()
+    # Hash passwords for security (inline: startup must not spin up the worker pool)
+    hash_password = password_hasher.hash
     
     demo_users = [
         ('admin@kaamkaro.com', hash_password('admin123'), 'Admin User', 1000.0, 25, 1250.0, 
@@ -172,6 +1165,7 @@ def insert_demo_data(db):
              joined, referral_code, referrals_count, referral_earnings, is_admin, phone, status)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', user)
+    db.execute(LEDGER_OPENING_BALANCES)
     
     db.commit()
     print("✅ Demo users inserted")
@@ -206,19 +1200,1518 @@ def insert_demo_tasks(db):
     db.commit()
     print("✅ Demo tasks inserted")
 
-# Initialize database on startup
-with app.app_context():
-    init_db()
-
 # ========== HELPER FUNCTIONS ==========
 def row_to_dict(row):
     return dict(zip(row.keys(), row)) if row else None
 
+# ========== PASSWORD HASHING ==========
+# Stored hashes are self-describing: '<scheme>$<params...>$<salt>$<hash>'.
+# Bare 64-character hex digests are legacy unsalted SHA-256 and are upgraded
+# on the next successful login.
+def _b64(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+def _unb64(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+class Pbkdf2Hasher:
+    scheme = 'pbkdf2_sha256'
+
+    def __init__(self, iterations):
+        self.iterations = iterations
+
+    def _derive(self, password, salt, iterations):
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+
+    def hash(self, password):
+        salt = secrets.token_bytes(16)
+        return f'{self.scheme}${self.iterations}${_b64(salt)}${_b64(self._derive(password, salt, self.iterations))}'
+
+    def verify(self, stored, password):
+        _, iterations, salt, expected = stored.split('$')
+        return hmac.compare_digest(self._derive(password, _unb64(salt), int(iterations)), _unb64(expected))
+
+    def needs_rehash(self, stored):
+        return stored.split('$')[1] != str(self.iterations)
+
+class ScryptHasher:
+    scheme = 'scrypt'
+
+    def __init__(self, n, r, p):
+        self.n, self.r, self.p = n, r, p
+
+    def _derive(self, password, salt, n, r, p):
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+    def hash(self, password):
+        salt = secrets.token_bytes(16)
+        digest = self._derive(password, salt, self.n, self.r, self.p)
+        return f'{self.scheme}${self.n}${self.r}${self.p}${_b64(salt)}${_b64(digest)}'
+
+    def verify(self, stored, password):
+        _, n, r, p, salt, expected = stored.split('$')
+        digest = self._derive(password, _unb64(salt), int(n), int(r), int(p))
+        return hmac.compare_digest(digest, _unb64(expected))
+
+    def needs_rehash(self, stored):
+        return stored.split('$')[1:4] != [str(self.n), str(self.r), str(self.p)]
+
+class LegacySha256Hasher:
+    scheme = 'sha256'
+
+    def verify(self, stored, password):
+        return hmac.compare_digest(stored, hashlib.sha256(password.encode()).hexdigest())
+
+    def needs_rehash(self, stored):
+        return True
+
+PASSWORD_HASHERS = {
+    'pbkdf2_sha256': Pbkdf2Hasher(int(os.environ.get('PASSWORD_PBKDF2_ITERATIONS', 260000))),
+    'scrypt': ScryptHasher(int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14)),
+                           int(os.environ.get('PASSWORD_SCRYPT_R', 8)),
+                           int(os.environ.get('PASSWORD_SCRYPT_P', 1))),
+}
+password_hasher = PASSWORD_HASHERS[os.environ.get('PASSWORD_HASHER', 'scrypt')]
+legacy_hasher = LegacySha256Hasher()
+
+def hasher_for(stored):
+    scheme = stored.split('$', 1)[0] if '$' in stored else 'sha256'
+    return PASSWORD_HASHERS[scheme] if scheme in PASSWORD_HASHERS else legacy_hasher
+
+class PasswordPoolBusy(Exception):
+    pass
+
+class PasswordWorkPool:
+    """Bounded thread pool for KDF work.
+
+    At most `workers` hashes run at once (the KDFs release the GIL), and at
+    most `max_pending` requests may wait for a slot; beyond that callers get
+    PasswordPoolBusy instead of piling up behind a login storm.
+    """
+
+    def __init__(self, workers, max_pending, wait_timeout):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.wait_timeout = wait_timeout
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._stats = {"completed": 0, "rejected": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+
+    def _get_executor(self):
+        # Executor threads do not survive fork; build a fresh pool per process
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password')
+                self._pid = os.getpid()
+            return self._executor
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            with self._lock:
+                self._stats["rejected"] += 1
+            raise PasswordPoolBusy()
+        started = time.perf_counter()
+        try:
+            return self._get_executor().submit(fn, *args).result()
+        finally:
+            self._slots.release()
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._stats["completed"] += 1
+                self._stats["total_seconds"] += elapsed
+                self._stats["max_seconds"] = max(self._stats["max_seconds"], elapsed)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(workers=self.workers, max_pending=self.max_pending, scheme=password_hasher.scheme)
+        return stats
+
+password_pool = PasswordWorkPool(int(os.environ.get('PASSWORD_HASH_WORKERS', 4)),
+                                 int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 64)),
+                                 float(os.environ.get('PASSWORD_HASH_WAIT_SECONDS', 5)))
+
 def hash_password(password):
-    return hashlib.sha256(password.encode()).hexdigest()
+    return password_pool.run(password_hasher.hash, password)
 
 def verify_password(stored_password, provided_password):
-    return stored_password == hash_password(provided_password)
+    if not stored_password:
+        return False
+    return password_pool.run(hasher_for(stored_password).verify, stored_password, provided_password)
+
+def password_needs_rehash(stored_password):
+    hasher = hasher_for(stored_password)
+    return hasher is not password_hasher or hasher.needs_rehash(stored_password)
+
+# ========== SESSION TOKENS ==========
+# Tokens are '<base64url(claims)>.<base64url(HMAC-SHA256)>' keyed on
+# app.secret_key, so verifying one needs no database access. Set SECRET_KEY
+# in production: the random fallback differs per process and across restarts.
+TOKEN_TTL_SECONDS = int(os.environ.get('TOKEN_TTL_SECONDS', 7 * 24 * 3600))
+
+class TokenError(Exception):
+    pass
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+def _unb64url(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+_signing_keys = {}
+
+def _signing_key():
+    secret = app.secret_key
+    key = _signing_keys.get(secret)
+    if key is None:
+        key = _signing_keys[secret] = hmac.new(str(secret).encode(), b'kaamkaro-session-token', hashlib.sha256).digest()
+    return key
+
+def _sign(body):
+    return _b64url(hmac.new(_signing_key(), body.encode(), hashlib.sha256).digest())
+
+def issue_token(user_id, is_admin=False):
+    claims = {"uid": user_id, "exp": int(time.time()) + TOKEN_TTL_SECONDS, "jti": secrets.token_hex(8)}
+    if is_admin:
+        claims["adm"] = 1
+    body = _b64url(json.dumps(claims, separators=(',', ':')).encode())
+    return f'{body}.{_sign(body)}'
+
+class TokenCache:
+    """LRU of already-verified tokens plus a bounded revocation list.
+
+    A cache hit skips the HMAC and JSON decode, leaving a dict lookup and an
+    expiry check. Revocations are per process and expire with the token.
+    """
+
+    def __init__(self, max_entries=10000, max_revoked=10000):
+        self.max_entries = max_entries
+        self.max_revoked = max_revoked
+        self._verified = OrderedDict()
+        self._revoked = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "rejected": 0, "revoked": 0}
+
+    def verify(self, token):
+        now = time.time()
+        with self._lock:
+            claims = self._verified.get(token)
+            if claims is not None:
+                self._verified.move_to_end(token)
+                self._stats["hits"] += 1
+        if claims is None:
+            claims = self._decode(token)
+            with self._lock:
+                self._stats["misses"] += 1
+                self._verified[token] = claims
+                while len(self._verified) > self.max_entries:
+                    self._verified.popitem(last=False)
+        if claims["exp"] <= now:
+            self._reject()
+            raise TokenError("Session expired, please log in again")
+        if claims["jti"] in self._revoked:
+            self._reject()
+            raise TokenError("Session has been logged out")
+        return claims
+
+    def _decode(self, token):
+        body, _, signature = token.partition('.')
+        # Compare bytes: compare_digest raises TypeError on non-ASCII str
+        if not signature or not hmac.compare_digest(signature.encode(), _sign(body).encode()):
+            self._reject()
+            raise TokenError("Invalid token")
+        try:
+            claims = json.loads(_unb64url(body))
+        except ValueError:
+            self._reject()
+            raise TokenError("Invalid token")
+        return claims
+
+    def _reject(self):
+        with self._lock:
+            self._stats["rejected"] += 1
+
+    def revoke(self, claims):
+        with self._lock:
+            now = time.time()
+            self._revoked[claims["jti"]] = claims["exp"]
+            # Drop revocations whose tokens have expired anyway, then bound size
+            while self._revoked and next(iter(self._revoked.values())) <= now:
+                self._revoked.popitem(last=False)
+            while len(self._revoked) > self.max_revoked:
+                self._revoked.popitem(last=False)
+            self._stats["revoked"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(cached=len(self._verified), revocations=len(self._revoked))
+        return stats
+
+token_cache = TokenCache(int(os.environ.get('TOKEN_CACHE_SIZE', 10000)))
+
+def require_auth(view):
+    """Authenticate the Bearer token and expose its claims as g.auth_user_id / g.auth_is_admin."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        header = request.headers.get('Authorization', '')
+        if not header.startswith('Bearer '):
+            return jsonify({"success": False, "error": "Authentication required"}), 401
+        try:
+            claims = token_cache.verify(header[7:].strip())
+        except TokenError as e:
+            return jsonify({"success": False, "error": str(e)}), 401
+        g.auth_claims = claims
+        g.auth_user_id = claims["uid"]
+        g.auth_is_admin = bool(claims.get("adm"))
+        return view(*args, **kwargs)
+    return wrapper
+
+def can_access_user(user_id):
+    try:
+        return g.auth_is_admin or int(user_id) == g.auth_user_id
+    except (TypeError, ValueError):
+        return False
+
+# Business days follow Indian Standard Time, while SQLite's CURRENT_TIMESTAMP
+# stores naive UTC 'YYYY-MM-DD HH:MM:SS'. Day filters are converted to UTC
+# bounds in that format so they compare directly against indexed columns.
+APP_TIMEZONE = timezone(timedelta(minutes=int(os.environ.get('APP_UTC_OFFSET_MINUTES', 330))))
+SQLITE_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def utc_offset_modifier():
+    """SQLite date modifier shifting a stored UTC timestamp to business time."""
+    return f"{int(APP_TIMEZONE.utcoffset(None).total_seconds() // 60):+d} minutes"
+
+def business_today():
+    return datetime.now(APP_TIMEZONE).date()
+
+def day_window(day=None, days=1):
+    """Half-open UTC (start, end) bounds covering `days` business days from `day`.
+
+    Use as `column >= ? AND column < ?` instead of `DATE(column) = ?`.
+    """
+    if day is None:
+        day = business_today()
+    elif isinstance(day, str):
+        day = datetime.strptime(day, '%Y-%m-%d').date()
+    start = datetime(day.year, day.month, day.day, tzinfo=APP_TIMEZONE)
+    end = start + timedelta(days=days)
+    return (start.astimezone(timezone.utc).strftime(SQLITE_TIMESTAMP_FORMAT),
+            end.astimezone(timezone.utc).strftime(SQLITE_TIMESTAMP_FORMAT))
+
+# ========== PAGINATION ==========
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+APPROX_TOTAL_CAP = 10000
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("Invalid cursor")
+    return values
+
+def date_range_filter(column):
+    """WHERE clauses and params for ?from=YYYY-MM-DD&to=YYYY-MM-DD (inclusive business days)."""
+    where, params = [], []
+    try:
+        if request.args.get('from'):
+            where.append(f'{column} >= ?')
+            params.append(day_window(request.args['from'])[0])
+        if request.args.get('to'):
+            where.append(f'{column} < ?')
+            params.append(day_window(request.args['to'])[1])
+    except ValueError:
+        raise ValueError("Dates must be in YYYY-MM-DD format")
+    return where, params
+
+def int_arg(name):
+    """request.args[name] as an int; raises ValueError for anything else."""
+    try:
+        return int(request.args[name])
+    except ValueError:
+        raise ValueError(f"'{name}' must be an integer")
+
+def user_filters():
+    where, params = date_range_filter('created_at')
+    if request.args.get('status'):
+        where.append('status = ?')
+        params.append(request.args['status'])
+    return where, params
+
+def withdrawal_filters():
+    where, params = date_range_filter('w.requested_at')
+    if request.args.get('status'):
+        where.append('w.status = ?')
+        params.append(request.args['status'])
+    if request.args.get('user_id'):
+        where.append('w.user_id = ?')
+        params.append(int_arg('user_id'))
+    if request.args.get('flagged') in ('0', '1'):
+        negate = '' if request.args['flagged'] == '1' else 'NOT '
+        where.append(f'w.user_id {negate}IN (SELECT user_id FROM risk_scores WHERE flagged = 1)')
+    return where, params
+
+def transaction_filters():
+    where, params = date_range_filter('t.timestamp')
+    if request.args.get('user_id'):
+        where.append('t.user_id = ?')
+        params.append(int_arg('user_id'))
+    if request.args.get('type'):
+        where.append('t.type = ?')
+        params.append(request.args['type'])
+    return where, params
+
+def keyset_page(db, columns, from_sql, where, params, time_column, id_column):
+    """Fetch one newest-first page of `SELECT columns FROM from_sql WHERE where`.
+
+    Rows are ordered by (time_column, id_column) descending and resumed with
+    ?after=<cursor>, so every page is an index range scan regardless of
+    depth. ?total=exact counts all matches; ?total=approx stops counting at
+    APPROX_TOTAL_CAP. Raises ValueError for malformed parameters.
+    """
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    where, params = list(where), list(params)
+    page = {}
+
+    total_mode = request.args.get('total')
+    if total_mode:
+        page.update(count_matches(db, from_sql, where, params, id_column, total_mode))
+
+    if request.args.get('after'):
+        where.append(f'({time_column}, {id_column}) < (?, ?)')
+        params.extend(decode_cursor(request.args['after']))
+
+    query = f'SELECT {columns} FROM {from_sql}'
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += f' ORDER BY {time_column} DESC, {id_column} DESC LIMIT ?'
+    rows = db.execute(query, params + [limit + 1]).fetchall()
+
+    items = [row_to_dict(row) for row in rows[:limit]]
+    has_more = len(rows) > limit
+    last = items[-1] if has_more else None
+    page.update({
+        "items": items,
+        "count": len(items),
+        "limit": limit,
+        "has_more": has_more,
+        "next_cursor": encode_cursor(last[time_column.split('.')[-1]], last[id_column.split('.')[-1]]) if last else None
+    })
+    return page
+
+def count_matches(db, from_sql, where, params, id_column, mode):
+    if mode not in ('exact', 'approx'):
+        raise ValueError("'total' must be 'exact' or 'approx'")
+    clause = ' WHERE ' + ' AND '.join(where) if where else ''
+    if mode == 'exact':
+        total = db.execute(f'SELECT COUNT(*) FROM {from_sql}{clause}', params).fetchone()[0]
+        return {"total": total, "total_is_estimate": False}
+    if not where:
+        # Ids are never reused, so the highest id is a constant-time upper bound.
+        # Read it from the base table (the first in from_sql, which owns
+        # id_column): MAX over a join would visit every joined row.
+        base_table, id_name = from_sql.split()[0], id_column.split('.')[-1]
+        total = db.execute(f'SELECT COALESCE(MAX({id_name}), 0) FROM {base_table}').fetchone()[0]
+        return {"total": total, "total_is_estimate": True}
+    total = db.execute(f'SELECT COUNT(*) FROM (SELECT 1 FROM {from_sql}{clause} LIMIT ?)',
+                       params + [APPROX_TOTAL_CAP + 1]).fetchone()[0]
+    return {"total": min(total, APPROX_TOTAL_CAP), "total_is_estimate": total > APPROX_TOTAL_CAP}
+
+# ========== STREAMING EXPORTS ==========
+EXPORT_BATCH_SIZE = 1000
+
+# kind -> (columns, from, filter builder, order by)
+EXPORTS = {
+    'transactions': ('t.*, u.name as user_name, u.email as user_email',
+                     'transactions t JOIN users u ON t.user_id = u.id',
+                     transaction_filters, 't.timestamp, t.id'),
+    'withdrawals': ('w.*', 'withdrawals w', withdrawal_filters, 'w.requested_at, w.id'),
+    'users': ('*', 'users', user_filters, 'created_at, id'),
+}
+EXPORT_EXCLUDED_COLUMNS = {'password'}
+
+def iter_export_rows(db, query, params):
+    """Yield (columns, batch) pairs straight off the SQLite cursor, at least once."""
+    cursor = db.execute(query, params)
+    columns = [column[0] for column in cursor.description]
+    keep = [i for i, column in enumerate(columns) if column not in EXPORT_EXCLUDED_COLUMNS]
+    columns = [columns[i] for i in keep]
+    while True:
+        batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        yield columns, [[row[i] for i in keep] for row in batch]
+        if len(batch) < EXPORT_BATCH_SIZE:
+            break
+
+def csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    header_written = False
+    for columns, batch in rows:
+        if not header_written:
+            writer.writerow(columns)
+            header_written = True
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+def ndjson_chunks(rows):
+    for columns, batch in rows:
+        yield ''.join(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in batch)
+
+EXPORT_FORMATS = {
+    'csv': (csv_chunks, 'text/csv'),
+    'ndjson': (ndjson_chunks, 'application/x-ndjson'),
+}
+
+# ========== RESPONSE CACHE ==========
+CacheEntry = namedtuple('CacheEntry', ['body', 'etag', 'expires_at'])
+
+class ResponseCache:
+    """Bounded LRU of pre-serialised JSON bodies with per-entry TTL.
+
+    The cache is per process, so writes in one gunicorn worker only
+    invalidate that worker's entries; the TTL bounds staleness elsewhere.
+    """
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if entry.expires_at <= time.monotonic():
+                del self._entries[key]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry
+
+    def set(self, key, body, ttl):
+        entry = CacheEntry(body, hashlib.sha1(body).hexdigest(), time.monotonic() + ttl)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+        return entry
+
+    def invalidate(self, prefix=''):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+                self._stats["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        stats["max_entries"] = self.max_entries
+        return stats
+
+response_cache = ResponseCache(int(os.environ.get('RESPONSE_CACHE_SIZE', 512)))
+TASKS_CACHE_TTL = float(os.environ.get('TASKS_CACHE_TTL', 30))
+HEALTH_CACHE_TTL = float(os.environ.get('HEALTH_CACHE_TTL', 5))
+
+def cached_json_response(key, ttl, build):
+    """Serve build()'s payload from response_cache, answering If-None-Match with 304.
+
+    build() runs only on a miss; returning None skips caching and yields None.
+    """
+    entry = response_cache.get(key)
+    if entry is None:
+        payload = build()
+        if payload is None:
+            return None
+        entry = response_cache.set(key, app.json.dumps(payload).encode() + b'\n', ttl)
+    response = Response(entry.body, mimetype='application/json')
+    response.set_etag(entry.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+def invalidate_task_cache():
+    response_cache.invalidate('tasks:')
+    response_cache.invalidate('health')
+
+# ========== IDEMPOTENCY KEYS ==========
+# Money-moving endpoints accept an Idempotency-Key header. The first request
+# with a key claims a row in idempotency_keys; its response (anything below
+# 500) is stored there and in a per-process LRU, and a retry with the same
+# key and body is answered from that copy without running the view again.
+# Views that move money call idempotency.stage() inside their own write
+# transaction, so the stored response commits or rolls back with the money;
+# writes that commit later (group commit) store it once their future
+# resolves. A claim still unanswered after IDEMPOTENCY_STALE_SECONDS
+# belongs to a request that died and may be taken over. Rows expire after
+# IDEMPOTENCY_TTL_SECONDS and are pruned in small batches.
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', 24 * 3600))
+IDEMPOTENCY_STALE_SECONDS = int(os.environ.get('IDEMPOTENCY_STALE_SECONDS', 60))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+IDEMPOTENCY_PRUNE_SECONDS = 60
+IDEMPOTENCY_PRUNE_BATCH = 1000
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+class IdempotencyStore:
+    def __init__(self, ttl, stale, max_entries):
+        self.ttl = ttl
+        self.stale = stale
+        self.cache = ResponseCache(max_entries)
+        self._lock = threading.Lock()
+        self._next_prune = 0.0
+        self._stats = {"executed": 0, "replayed": 0, "in_progress": 0, "mismatched": 0, "released": 0, "pruned": 0}
+
+    def count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def cutoff(self, seconds=None):
+        seconds = self.ttl if seconds is None else seconds
+        return (datetime.now(timezone.utc) - timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+    def claim(self, db, user_id, key, fingerprint):
+        """Claim (user_id, key) for this request; returns None, or the live row that holds it."""
+        entry = self.cache.get(f'{user_id}:{key}')
+        if entry is not None:
+            return json.loads(entry.body)
+        # An expired row, or a claim whose request died before answering, is
+        # taken over as if it were absent
+        cursor = db.execute('''
+            INSERT INTO idempotency_keys (user_id, key, fingerprint) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, key) DO UPDATE SET
+            fingerprint = excluded.fingerprint, status = NULL, body = NULL, created_at = CURRENT_TIMESTAMP
+            WHERE idempotency_keys.created_at < ?
+            OR (idempotency_keys.status IS NULL AND idempotency_keys.created_at < ?)
+        ''', (user_id, key, fingerprint, self.cutoff(), self.cutoff(self.stale)))
+        claimed = cursor.rowcount == 1
+        db.commit()
+        if claimed:
+            return None
+        row = db.execute('SELECT fingerprint, status, body FROM idempotency_keys WHERE user_id = ? AND key = ?',
+                         (user_id, key)).fetchone()
+        return row_to_dict(row)
+
+    def stage(self, db, build_response):
+        """Store this request's response inside the caller's open write transaction.
+
+        Call just before committing the money movement; build_response() is
+        only called when the request holds an Idempotency-Key claim. Returns
+        the response, or None without a claim.
+        """
+        claim = g.get('idempotency_claim')
+        if claim is None:
+            return None
+        response = app.make_response(build_response())
+        db.execute('UPDATE idempotency_keys SET status = ?, body = ? WHERE user_id = ? AND key = ?',
+                   (response.status_code, response.get_data(as_text=True), claim[0], claim[1]))
+        g.idempotency_staged = response
+        return response
+
+    def store(self, db, user_id, key, fingerprint, response):
+        db.execute('UPDATE idempotency_keys SET status = ?, body = ? WHERE user_id = ? AND key = ?',
+                   (response.status_code, response.get_data(as_text=True), user_id, key))
+        db.commit()
+        self.remember(user_id, key, fingerprint, response)
+
+    def remember(self, user_id, key, fingerprint, response):
+        record = {"fingerprint": fingerprint, "status": response.status_code, "body": response.get_data(as_text=True)}
+        self.cache.set(f'{user_id}:{key}', json.dumps(record).encode(), self.ttl)
+        self.count("executed")
+
+    def after(self, future):
+        """Store the response only once future (a deferred write) succeeds; release the key if it fails."""
+        if g.get('idempotency_claim') is not None:
+            g.idempotency_after = future
+
+    def settle(self, user_id, key, fingerprint, response, future):
+        # Runs on whichever thread resolved the future, outside any transaction
+        db = db_pool.acquire()
+        if future.exception() is None:
+            self.store(db, user_id, key, fingerprint, response)
+        else:
+            self.release(db, user_id, key)
+
+    def release(self, db, user_id, key):
+        """Drop an unanswered claim so the client can retry with the same key."""
+        if db.in_transaction:
+            db.rollback()
+        db.execute('DELETE FROM idempotency_keys WHERE user_id = ? AND key = ? AND status IS NULL', (user_id, key))
+        db.commit()
+        self.count("released")
+
+    def maybe_prune(self, db):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_prune:
+                return
+            self._next_prune = now + IDEMPOTENCY_PRUNE_SECONDS
+        self.prune(db, IDEMPOTENCY_PRUNE_BATCH)
+
+    def prune(self, db, limit=None):
+        """Delete expired keys oldest first, at most `limit` of them; returns the count."""
+        cursor = db.execute('''
+            DELETE FROM idempotency_keys WHERE (user_id, key) IN (
+                SELECT user_id, key FROM idempotency_keys WHERE created_at < ? ORDER BY created_at LIMIT ?
+            )
+        ''', (self.cutoff(), -1 if limit is None else limit))
+        db.commit()
+        self.count("pruned", cursor.rowcount)
+        return cursor.rowcount
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(ttl_seconds=self.ttl, cache=self.cache.stats())
+        return stats
+
+idempotency = IdempotencyStore(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_STALE_SECONDS, IDEMPOTENCY_CACHE_SIZE)
+
+def idempotent(view):
+    """Replay the stored response for a repeated Idempotency-Key; use inside require_auth.
+
+    Keys are per user. Reusing a key with a different body or endpoint is a
+    422, and a retry that arrives while the first request is still running
+    gets a 409. Requests without the header run as usual.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return view(*args, **kwargs)
+        key = key.strip()
+        if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return jsonify({"success": False, "error": f"Idempotency-Key must be 1-{IDEMPOTENCY_KEY_MAX_LENGTH} characters"}), 400
+
+        user_id = g.auth_user_id
+        fingerprint = hashlib.sha256(f'{request.method} {request.path}\n'.encode() + request.get_data()).hexdigest()
+        db = get_db()
+        stored = idempotency.claim(db, user_id, key, fingerprint)
+        if stored is not None:
+            if stored['fingerprint'] != fingerprint:
+                idempotency.count("mismatched")
+                return jsonify({"success": False, "error": "Idempotency-Key was already used for a different request"}), 422
+            if stored['status'] is None:
+                idempotency.count("in_progress")
+                response = jsonify({"success": False, "error": "A request with this Idempotency-Key is still in progress"})
+                response.status_code = 409
+                response.headers['Retry-After'] = '1'
+                return response
+            idempotency.count("replayed")
+            response = Response(stored['body'], status=stored['status'], mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        g.idempotency_claim = (user_id, key)
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            idempotency.release(db, user_id, key)
+            raise
+        finally:
+            g.idempotency_claim = None
+        staged = g.pop('idempotency_staged', None)
+        deferred = g.pop('idempotency_after', None)
+        if staged is not None and staged.status_code == response.status_code:
+            # Committed together with the view's write
+            idempotency.remember(user_id, key, fingerprint, staged)
+        elif response.status_code >= 500:
+            idempotency.release(db, user_id, key)
+        elif deferred is not None:
+            deferred.add_done_callback(lambda future: idempotency.settle(user_id, key, fingerprint, response, future))
+        else:
+            idempotency.store(db, user_id, key, fingerprint, response)
+        idempotency.maybe_prune(db)
+        return response
+    return wrapper
+
+@app.cli.command('idempotency-prune')
+def idempotency_prune_command():
+    """Delete expired idempotency keys."""
+    print(f"✅ {idempotency.prune(get_db())} expired idempotency keys deleted")
+
+# ========== RATE LIMITS ==========
+# Token buckets checked in before_request, ahead of any database work.
+# Each rule is '<count>/<second|minute|hour|day>' per client IP or per
+# authenticated user: the bucket holds <count> tokens and refills at that
+# rate. Override a rule with RATE_LIMIT_<ENDPOINT>_<SCOPE> (e.g.
+# RATE_LIMIT_LOGIN_IP=10/minute, or 'off'). Buckets live in this process
+# unless RATE_LIMIT_BACKEND=sqlite, which shares them between the workers on
+# one host through a small SQLite file, written every RATE_LIMIT_SYNC_MS
+# (0 writes on every request). Behind a proxy, set
+# TRUSTED_PROXY_HOPS so the client address is read from X-Forwarded-For.
+DEFAULT_RATE_LIMITS = {
+    'register': {'ip': '20/hour'},
+    'login': {'ip': '30/minute'},
+    'complete_task': {'user': '60/minute', 'ip': '1200/minute'},
+}
+RATE_PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+RATE_LIMIT_DB = os.environ.get('RATE_LIMIT_DB', 'ratelimit.db')
+RATE_LIMIT_SYNC_MS = int(os.environ.get('RATE_LIMIT_SYNC_MS', 20))
+RATE_LIMIT_PRUNE_SECONDS = 60
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+
+RateRule = namedtuple('RateRule', ['scope', 'capacity', 'rate'])
+
+def parse_rate(spec):
+    """'<count>/<period>' -> (capacity, tokens per second); raises ValueError."""
+    count, _, period = spec.partition('/')
+    if not count.isdigit() or int(count) <= 0 or period not in RATE_PERIODS:
+        raise ValueError(f"Rate must look like 30/minute, got {spec!r}")
+    return int(count), int(count) / RATE_PERIODS[period]
+
+def load_rate_rules():
+    rules = {}
+    for endpoint, scopes in DEFAULT_RATE_LIMITS.items():
+        for scope, spec in scopes.items():
+            spec = os.environ.get(f'RATE_LIMIT_{endpoint.upper()}_{scope.upper()}', spec)
+            if spec != 'off':
+                rules.setdefault(endpoint, []).append(RateRule(scope, *parse_rate(spec)))
+    return rules
+
+class LocalBuckets:
+    """Token buckets for this process, least recently used evicted first."""
+
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """Take a token; returns 0 if one was available, else seconds until one is."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [capacity, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "local", "keys": len(self._buckets), "max_keys": self.max_keys}
+
+class SqliteBuckets:
+    """Token buckets in a SQLite file shared by every worker process on the host.
+
+    Each take is one upsert that refills and debits the bucket atomically.
+    The file holds nothing worth keeping, so it is written without fsync.
+    Rows idle long enough to have refilled completely are pruned.
+    """
+
+    def __init__(self, path, idle_seconds):
+        self.path = path
+        self.idle_seconds = idle_seconds
+        self._local = threading.local()
+        self._next_prune = 0.0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=0.05, isolation_level=None)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS rate_buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_rate_buckets_updated ON rate_buckets (updated)')
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def take(self, key, capacity, rate):
+        conn, now = self._conn(), time.time()
+        refilled = 'MIN(?, tokens + (excluded.updated - updated) * ?)'
+        taken = conn.execute(f'''
+            INSERT INTO rate_buckets (key, tokens, updated) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET tokens = {refilled} - 1, updated = excluded.updated
+            WHERE {refilled} >= 1
+            RETURNING tokens
+        ''', (key, capacity - 1, now, capacity, rate, capacity, rate)).fetchall()
+        if now >= self._next_prune:
+            self._next_prune = now + RATE_LIMIT_PRUNE_SECONDS
+            conn.execute('DELETE FROM rate_buckets WHERE updated < ?', (now - self.idle_seconds,))
+        if taken:
+            return 0
+        tokens, updated = conn.execute('SELECT tokens, updated FROM rate_buckets WHERE key = ?', (key,)).fetchone()
+        return max(1 - min(capacity, tokens + (now - updated) * rate), 0) / rate
+
+    def debit(self, taken):
+        """Take {key: [count, capacity, rate]} tokens in one transaction.
+
+        Buckets may go negative: tokens already handed out by a worker are
+        owed and refill before the bucket allows anything again. Returns
+        {key: (tokens, updated)} as written.
+        """
+        conn, now = self._conn(), time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('''
+                INSERT INTO rate_buckets (key, tokens, updated) VALUES (?, ? - ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                tokens = MIN(?, tokens + (excluded.updated - updated) * ?) - ?, updated = excluded.updated
+            ''', [(key, capacity, count, now, capacity, rate, count)
+                  for key, (count, capacity, rate) in taken.items()])
+            cursor = conn.execute('SELECT key, tokens, updated FROM rate_buckets WHERE key IN (SELECT value FROM json_each(?))',
+                                  (json.dumps(list(taken)),))
+            levels = {key: (tokens, updated) for key, tokens, updated in cursor}
+            if now >= self._next_prune:
+                self._next_prune = now + RATE_LIMIT_PRUNE_SECONDS
+                conn.execute('DELETE FROM rate_buckets WHERE updated < ?', (now - self.idle_seconds,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return levels
+
+    def stats(self):
+        keys = self._conn().execute('SELECT COUNT(*) FROM rate_buckets').fetchone()[0]
+        return {"backend": "sqlite", "path": self.path, "keys": keys}
+
+class SyncedBuckets:
+    """Per-process buckets in front of SqliteBuckets, written back in batches.
+
+    take() works on this process's copy of each bucket and counts what it
+    hands out. Once every `interval` seconds the calling request writes the
+    counts to the shared file in one transaction and reads back each
+    bucket's level, which includes every other worker's takes. Between syncs
+    a worker can spend tokens another worker already spent; the shared
+    bucket goes negative by that much and refills before allowing more, so
+    the rate holds over time while a burst can reach workers x capacity.
+    """
+
+    def __init__(self, shared, interval, max_keys):
+        self.shared = shared
+        self.interval = interval
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._taken = {}
+        self._lock = threading.Lock()
+        self._next_sync = time.time() + interval
+        self._stats = {"syncs": 0, "sync_errors": 0}
+
+    def take(self, key, capacity, rate):
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [capacity, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                taken = self._taken.setdefault(key, [0, capacity, rate])
+                taken[0] += 1
+                wait = 0
+            else:
+                wait = (1 - bucket[0]) / rate
+            sync = now >= self._next_sync
+            if sync:
+                self._next_sync = now + self.interval
+        if sync:
+            self.sync()
+        return wait
+
+    def sync(self):
+        """Write this process's takes to the shared buckets and adopt their levels."""
+        with self._lock:
+            taken, self._taken = self._taken, {}
+        if not taken:
+            return
+        try:
+            levels = self.shared.debit(taken)
+        except sqlite3.Error:
+            # Keep the counts for the next sync rather than losing them
+            with self._lock:
+                for key, (count, capacity, rate) in taken.items():
+                    self._taken.setdefault(key, [0, capacity, rate])[0] += count
+                self._stats["sync_errors"] += 1
+            return
+        with self._lock:
+            self._stats["syncs"] += 1
+            for key, (tokens, updated) in levels.items():
+                bucket = self._buckets.get(key)
+                if bucket is not None:
+                    # Takes made while the batch was written are not in the shared level yet
+                    pending = self._taken.get(key, (0,))[0]
+                    bucket[0], bucket[1] = tokens - pending, updated
+
+    def stats(self):
+        with self._lock:
+            local = {"local_keys": len(self._buckets), "sync_seconds": self.interval, **self._stats}
+        return {**self.shared.stats(), **local}
+
+class RateLimiter:
+    def __init__(self, rules, backend, enabled=True):
+        self.rules = rules if enabled else {}
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._counts = {(endpoint, rule.scope): {"allowed": 0, "denied": 0, "errors": 0}
+                        for endpoint, rules in self.rules.items() for rule in rules}
+
+    def _count(self, endpoint, scope, outcome):
+        with self._lock:
+            self._counts[endpoint, scope][outcome] += 1
+
+    def check(self, endpoint, identities):
+        """Apply endpoint's rules to {scope: identity}; returns 0 or seconds to wait.
+
+        A backend that cannot answer (a locked shared file) lets the request through.
+        """
+        for rule in self.rules.get(endpoint, ()):
+            identity = identities.get(rule.scope)
+            if identity is None:
+                continue
+            try:
+                wait = self.backend.take(f'{endpoint}:{rule.scope}:{identity}', rule.capacity, rule.rate)
+            except sqlite3.Error:
+                self._count(endpoint, rule.scope, "errors")
+                continue
+            if wait:
+                self._count(endpoint, rule.scope, "denied")
+                return wait
+            self._count(endpoint, rule.scope, "allowed")
+        return 0
+
+    def stats(self):
+        with self._lock:
+            counts = {f'{endpoint}:{scope}': dict(value) for (endpoint, scope), value in self._counts.items()}
+        rules = {endpoint: {rule.scope: f"{rule.capacity} per {rule.capacity / rule.rate:g}s" for rule in rules}
+                 for endpoint, rules in self.rules.items()}
+        return {"enabled": bool(self.rules), "rules": rules, "counts": counts, **self.backend.stats()}
+
+def create_rate_limiter():
+    rules = load_rate_rules()
+    if os.environ.get('RATE_LIMIT_BACKEND', 'local') == 'sqlite':
+        # A bucket idle for its full refill time is the same as a missing one
+        idle = max((rule.capacity / rule.rate for rules in rules.values() for rule in rules), default=0)
+        backend = SqliteBuckets(RATE_LIMIT_DB, idle)
+        if RATE_LIMIT_SYNC_MS:
+            backend = SyncedBuckets(backend, RATE_LIMIT_SYNC_MS / 1000, RATE_LIMIT_MAX_KEYS)
+    else:
+        backend = LocalBuckets(RATE_LIMIT_MAX_KEYS)
+    return RateLimiter(rules, backend, RATE_LIMIT_ENABLED)
+
+rate_limiter = create_rate_limiter()
+
+def client_ip(environ):
+    if TRUSTED_PROXY_HOPS:
+        forwarded = [addr.strip() for addr in environ.get('HTTP_X_FORWARDED_FOR', '').split(',') if addr.strip()]
+        if forwarded:
+            return forwarded[-min(TRUSTED_PROXY_HOPS, len(forwarded))]
+    return environ.get('REMOTE_ADDR')
+
+@app.before_request
+def enforce_rate_limits():
+    # Every request passes through here: read the WSGI environ directly
+    # rather than paying for request-proxy and header lookups each time
+    req = request._get_current_object()
+    if req.endpoint not in rate_limiter.rules or req.method == 'OPTIONS':
+        return None
+    environ = req.environ
+    identities = {"ip": client_ip(environ)}
+    header = environ.get('HTTP_AUTHORIZATION', '')
+    if header.startswith('Bearer '):
+        try:
+            identities["user"] = token_cache.verify(header[7:].strip())["uid"]
+        except Exception:
+            pass  # Any bad token means no user identity; require_auth rejects it, the IP bucket still applies
+    wait = rate_limiter.check(request.endpoint, identities)
+    if not wait:
+        return None
+    response = jsonify({"success": False, "error": "Too many requests, please slow down"})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(math.ceil(wait))
+    return response
+
+# ========== HOT COUNTERS ==========
+class StripedCounter:
+    """In-process counters for hot rows, folded into the database periodically.
+
+    add() touches one of `stripes` dicts chosen by thread id, so request
+    threads rarely share a lock and never write the hot row themselves; a
+    background thread applies the summed deltas with fold(db, deltas) every
+    `interval` seconds. Readers add pending() to the stored value. Deltas
+    not yet folded are lost if the process is killed; the rebuild command
+    recomputes the stored totals.
+    """
+
+    def __init__(self, name, fold, stripes, interval):
+        self.name = name
+        self._fold = fold
+        self.interval = interval
+        self._stripes = [({}, threading.Lock()) for _ in range(stripes)]
+        self._lock = threading.Lock()
+        self._folding = {}
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stats = {"added": 0, "folds": 0, "folded_rows": 0, "fold_errors": 0}
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Deltas inherited across fork belong to the parent
+                for deltas, _ in self._stripes:
+                    deltas.clear()
+                self._folding = {}
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'{self.name}-fold', daemon=True)
+                self._thread.start()
+
+    def add(self, key, amount=1):
+        if self._thread is None or self._pid != os.getpid():
+            self._ensure_thread()
+        deltas, lock = self._stripes[threading.get_native_id() % len(self._stripes)]
+        with lock:
+            deltas[key] = deltas.get(key, 0) + amount
+
+    def pending(self):
+        with self._lock:
+            merged = dict(self._folding)
+        for deltas, lock in self._stripes:
+            with lock:
+                for key, amount in deltas.items():
+                    merged[key] = merged.get(key, 0) + amount
+        return merged
+
+    def fold(self):
+        """Apply all accumulated deltas in one write transaction."""
+        with self._lock:
+            for deltas, lock in self._stripes:
+                with lock:
+                    for key, amount in deltas.items():
+                        self._folding[key] = self._folding.get(key, 0) + amount
+                    self._stats["added"] += sum(deltas.values())
+                    deltas.clear()
+            folding = dict(self._folding)
+        if not folding:
+            return 0
+        db = db_pool.acquire()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            self._fold(db, folding)
+            with self._lock:
+                db.commit()
+                self._folding = {}
+                self._stats["folds"] += 1
+                self._stats["folded_rows"] += len(folding)
+        except Exception as e:
+            # Keep the deltas in _folding for the next attempt
+            if db.in_transaction:
+                db.rollback()
+            with self._lock:
+                self._stats["fold_errors"] += 1
+            print(f"❌ Could not fold {self.name} counters: {e}")
+            return 0
+        return len(folding)
+
+    def _run(self):
+        while not self._wake.wait(self.interval):
+            self.fold()
+
+    def close(self):
+        self._wake.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(self.interval + 5)
+            self.fold()
+
+    def stats(self):
+        pending = self.pending()
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(pending_keys=len(pending), pending_total=sum(pending.values()),
+                     stripes=len(self._stripes), fold_seconds=self.interval)
+        return stats
+
+def fold_task_completions(db, deltas):
+    db.executemany('UPDATE tasks SET total_completions = total_completions + ? WHERE id = ?',
+                   [(amount, task_id) for task_id, amount in deltas.items()])
+
+task_completion_counter = StripedCounter('task_completions', fold_task_completions,
+                                         int(os.environ.get('TASK_COUNTER_STRIPES', 16)),
+                                         float(os.environ.get('TASK_COUNTER_FOLD_SECONDS', 2)))
+atexit.register(task_completion_counter.close)
+
+def with_pending_completions(tasks):
+    """Add not-yet-folded completions to task dicts read from the tasks table."""
+    pending = task_completion_counter.pending()
+    for task in tasks:
+        if task and task['id'] in pending:
+            task['total_completions'] = (task.get('total_completions') or 0) + pending[task['id']]
+    return tasks
+
+@app.cli.command('counters-rebuild')
+def counters_rebuild_command():
+    """Recompute tasks.total_completions from the transaction ledger."""
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    db.execute('''
+        UPDATE tasks SET total_completions = (
+            SELECT COUNT(*) FROM transactions t
+            WHERE t.task_id = tasks.id AND t.type = 'task_completion'
+        )
+    ''')
+    db.commit()
+    print("✅ Task completion counters rebuilt")
+
+# ========== LEADERBOARDS ==========
+LEADERBOARD_K = int(os.environ.get('LEADERBOARD_K', 10))
+LEADERBOARD_REFRESH_SECONDS = float(os.environ.get('LEADERBOARD_REFRESH_SECONDS', 60))
+LEADERBOARD_EARNING_TYPES = ('task_completion', 'referral_bonus', 'daily_bonus')
+
+class TopK:
+    """The k highest-scoring members, for scores that only ever grow.
+
+    Because a member's score never drops, a member outside the board can only
+    enter by beating the current lowest entry, so offer() is O(k) and the
+    full population never needs re-sorting. Ties rank the lower id first.
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.top = {}
+
+    def offer(self, member, score):
+        if member in self.top or len(self.top) < self.k:
+            self.top[member] = score
+            return
+        lowest = min(self.top, key=lambda m: (self.top[m], -m))
+        if (score, -member) > (self.top[lowest], -lowest):
+            del self.top[lowest]
+            self.top[member] = score
+
+    def ranked(self):
+        return sorted(self.top.items(), key=lambda item: (-item[1], item[0]))
+
+class WindowBoard:
+    """Earnings per user inside one business period (a day or a week)."""
+
+    def __init__(self, k):
+        self.k = k
+        self.reset(None, {})
+
+    def reset(self, period, scores):
+        self.period = period
+        self.scores = scores
+        self.top = TopK(self.k)
+        for member, score in heapq.nlargest(self.k, scores.items(), key=lambda item: (item[1], -item[0])):
+            self.top.offer(member, score)
+
+    def add(self, period, member, amount):
+        if period != self.period:
+            self.reset(period, {})
+        self.scores[member] = self.scores.get(member, 0) + amount
+        self.top.offer(member, self.scores[member])
+
+class Leaderboards:
+    """In-memory boards: all-time total_earned plus today's and this week's earnings.
+
+    Balance-changing writes call record() after they commit. Every worker only
+    sees its own writes, so boards are reloaded from the database (a LIMIT k
+    index read and a GROUP BY over the current week's earning rows) at most
+    every refresh_seconds, which also corrects any double count from a write
+    racing a reload.
+    """
+
+    BOARDS = ('today', 'week', 'all_time')
+
+    def __init__(self, k, refresh_seconds):
+        self.k = k
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._all_time = TopK(k)
+        self._windows = {'today': WindowBoard(k), 'week': WindowBoard(k)}
+        self._loaded_at = None
+        self._stats = {"loads": 0, "records": 0, "reads": 0}
+
+    def periods(self):
+        today = business_today()
+        return {'today': (today, 1), 'week': (today - timedelta(days=today.weekday()), 7)}
+
+    def load(self, db):
+        all_time = TopK(self.k)
+        for user_id, total in db.execute(
+                'SELECT id, total_earned FROM users ORDER BY total_earned DESC, id LIMIT ?', (self.k,)):
+            all_time.offer(user_id, total or 0)
+
+        periods = self.periods()
+        start, end = day_window(*periods['week'])
+        today_start, _ = day_window(*periods['today'])
+        type_placeholders = ','.join('?' * len(LEADERBOARD_EARNING_TYPES))
+        week, today = {}, {}
+        for user_id, amount, today_amount in db.execute(f'''
+            SELECT user_id, SUM(amount), SUM(CASE WHEN timestamp >= ? THEN amount ELSE 0 END)
+            FROM transactions
+            WHERE type IN ({type_placeholders}) AND timestamp >= ? AND timestamp < ?
+            GROUP BY user_id
+        ''', (today_start, *LEADERBOARD_EARNING_TYPES, start, end)):
+            week[user_id] = amount
+            if today_amount:
+                today[user_id] = today_amount
+
+        with self._lock:
+            self._all_time = all_time
+            self._windows['week'].reset(periods['week'][0], week)
+            self._windows['today'].reset(periods['today'][0], today)
+            self._loaded_at = time.monotonic()
+            self._stats["loads"] += 1
+
+    def record(self, user_id, amount, total_earned=None):
+        """Apply a committed credit of `amount`; pass total_earned when it changed."""
+        periods = self.periods()
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            self._stats["records"] += 1
+            for name, board in self._windows.items():
+                board.add(periods[name][0], user_id, amount)
+            if total_earned is not None:
+                self._all_time.offer(user_id, total_earned)
+
+    def top(self, db, board, limit=None):
+        """Return (period_start, [(user_id, score), ...]) for one board."""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_seconds:
+            self.load(db)
+        limit = min(limit or self.k, self.k)
+        periods = self.periods()
+        with self._lock:
+            self._stats["reads"] += 1
+            if board == 'all_time':
+                return None, self._all_time.ranked()[:limit]
+            window = self._windows[board]
+            if window.period != periods[board][0]:
+                window.reset(periods[board][0], {})
+            return window.period, window.top.ranked()[:limit]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(k=self.k, refresh_seconds=self.refresh_seconds,
+                         tracked_users={name: len(board.scores) for name, board in self._windows.items()})
+        return stats
+
+leaderboards = Leaderboards(LEADERBOARD_K, LEADERBOARD_REFRESH_SECONDS)
+
+# ========== EVENT STREAM ==========
+# Server-sent events for /api/stream/*. Writes publish small deltas to
+# in-process topics ('user:<id>' and 'admin') after they commit; each open
+# stream holds a bounded queue of pre-encoded frames and never touches the
+# database. Events only reach streams served by the same worker process.
+SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE', 64))
+SSE_MAX_SUBSCRIBERS = int(os.environ.get('SSE_MAX_SUBSCRIBERS', 10000))
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+SSE_MAX_SECONDS = float(os.environ.get('SSE_MAX_SECONDS', 600))
+SSE_RETRY_MS = int(os.environ.get('SSE_RETRY_MS', 3000))
+SSE_HEADERS = {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no',
+}
+SSE_KEEPALIVE_FRAME = b': keepalive\n\n'
+
+class StreamError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def sse_frame(event, data, event_id=None):
+    payload = json.dumps(data, separators=(',', ':'), ensure_ascii=False, default=str)
+    head = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{head}event: {event}\ndata: {payload}\n\n'.encode()
+
+class Subscription:
+    __slots__ = ('topic', 'events', 'overflowed', 'wakeup')
+
+    def __init__(self, topic, size, wakeup):
+        self.topic = topic
+        self.events = deque(maxlen=size)
+        self.overflowed = False
+        self.wakeup = wakeup
+
+class EventBus:
+    """Topic-based pub/sub for live updates.
+
+    publish() encodes an event once and appends the frame to every
+    subscriber's queue, then calls the subscriber's wakeup() (an Event.set
+    for a streaming thread, call_soon_threadsafe for the ASGI loop). Queues
+    hold at most queue_size frames; when a slow reader falls behind, the
+    oldest frames are dropped and the stream tells the client to resync.
+    """
+
+    def __init__(self, queue_size, max_subscribers):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self._topics = {}
+        self._count = 0
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._stats = {"published": 0, "delivered": 0, "overflows": 0, "rejected": 0}
+
+    def subscribe(self, topic, wakeup):
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                self._stats["rejected"] += 1
+                raise StreamError("Too many open streams, try again later", 503)
+            subscription = Subscription(topic, self.queue_size, wakeup)
+            self._topics.setdefault(topic, set()).add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._topics.get(subscription.topic)
+            if subscribers is None or subscription not in subscribers:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._topics[subscription.topic]
+            self._count -= 1
+
+    def listening(self, topic):
+        return topic in self._topics
+
+    def publish(self, topic, event, data):
+        # Cheap exit for the common case of nobody listening
+        if topic not in self._topics:
+            return
+        with self._lock:
+            subscribers = list(self._topics.get(topic, ()))
+            if not subscribers:
+                return
+            self._seq += 1
+            frame = sse_frame(event, data, self._seq)
+            for subscription in subscribers:
+                if len(subscription.events) == self.queue_size:
+                    subscription.overflowed = True
+                    self._stats["overflows"] += 1
+                subscription.events.append(frame)
+            self._stats["published"] += 1
+            self._stats["delivered"] += len(subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.wakeup()
+            except RuntimeError:
+                # The subscriber's event loop has already shut down
+                pass
+
+    def drain(self, subscription):
+        """Return the next chunk to send: queued frames, a resync notice or a keepalive."""
+        with self._lock:
+            frames = list(subscription.events)
+            subscription.events.clear()
+            overflowed, subscription.overflowed = subscription.overflowed, False
+        if overflowed:
+            frames.insert(0, sse_frame('resync', {"reason": "overflow"}))
+        return b''.join(frames) if frames else SSE_KEEPALIVE_FRAME
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(subscribers=self._count, topics=len(self._topics))
+        stats.update(queue_size=self.queue_size, max_subscribers=self.max_subscribers)
+        return stats
+
+event_bus = EventBus(SSE_QUEUE_SIZE, SSE_MAX_SUBSCRIBERS)
+
+def publish_user_event(user_id, event, data):
+    event_bus.publish(f'user:{user_id}', event, data)
+
+def publish_admin_event(event, data):
+    event_bus.publish('admin', event, data)
+
+def publish_withdrawal_event(withdrawal):
+    """Send a withdrawal's current status to its owner and to the admin stream."""
+    update = {key: withdrawal[key] for key in
+              ('id', 'user_id', 'amount', 'status', 'method', 'requested_at', 'processed_at', 'rejection_reason')}
+    publish_user_event(withdrawal['user_id'], 'withdrawal', update)
+    publish_admin_event('withdrawal', update)
+
+def stream_topic(kind, user_id=None, token=None):
+    """Resolve an /api/stream/<kind> request to a bus topic or raise StreamError.
+
+    The admin stream is open like the other admin endpoints; user streams need
+    a session token for that user (or an admin), passed as a Bearer header or,
+    since EventSource cannot set headers, as ?token=.
+    """
+    if kind == 'admin':
+        return 'admin'
+    if not token:
+        raise StreamError("Authentication required", 401)
+    try:
+        claims = token_cache.verify(token)
+    except TokenError as e:
+        raise StreamError(str(e), 401)
+    if not claims.get("adm") and claims["uid"] != user_id:
+        raise StreamError("Not allowed for this user", 403)
+    return f'user:{user_id}'
+
+def bearer_token(header):
+    return header[7:].strip() if header and header.startswith('Bearer ') else None
+
+def stream_preamble(topic):
+    """First chunk of every stream: the reconnect delay and a 'ready' event.
+
+    Clients (re)load their state on 'ready' and 'resync' and apply the
+    deltas in between, so a reconnect never needs a replay buffer.
+    """
+    return f'retry: {SSE_RETRY_MS}\n\n'.encode() + sse_frame('ready', {"topic": topic})
+
+def event_stream_response(topic):
+    """text/event-stream response for WSGI workers; holds one thread per connection."""
+    ready = threading.Event()
+    subscription = event_bus.subscribe(topic, ready.set)
+
+    def generate():
+        yield stream_preamble(topic)
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        while time.monotonic() < deadline:
+            ready.wait(SSE_HEARTBEAT_SECONDS)
+            ready.clear()
+            yield event_bus.drain(subscription)
+
+    response = Response(generate(), headers=SSE_HEADERS)
+    # Runs when the server closes the body, even if it was never iterated
+    response.call_on_close(lambda: event_bus.unsubscribe(subscription))
+    return response
 
 # ========== ROUTES ==========
 @app.route('/')
@@ -236,15 +2729,20 @@ def serve_static(filename):
 # ========== API ENDPOINTS ==========
 @app.route('/api/health', methods=['GET'])
 def health_check():
+    return cached_json_response('health', HEALTH_CACHE_TTL, build_health)
+
+def build_health():
     db = get_db()
     
-    users_count = db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+    totals = get_platform_totals(db)
+    withdrawals = sum_daily_stats(db)
+    users_count = totals['users']
     tasks_count = db.execute('SELECT COUNT(*) FROM tasks WHERE status="active"').fetchone()[0]
-    total_balance = db.execute('SELECT SUM(balance) FROM users').fetchone()[0] or 0
-    total_withdrawals = db.execute('SELECT SUM(amount) FROM withdrawals WHERE status="approved"').fetchone()[0] or 0
-    pending_withdrawals = db.execute('SELECT SUM(amount) FROM withdrawals WHERE status="pending"').fetchone()[0] or 0
+    total_balance = totals['total_balance']
+    total_withdrawals = withdrawals['approved_amount']
+    pending_withdrawals = pending_amount(withdrawals)
     
-    return jsonify({
+    return {
         "status": "healthy",
         "app": "Watch & Earn - KaamKaro Pro",
         "version": "4.0.0",
@@ -257,28 +2755,29 @@ def health_check():
             "pending_withdrawals": pending_withdrawals,
             "uptime": "100%"
         }
-    })
+    }
 
 @app.route('/api/dashboard/stats', methods=['GET'])
 def dashboard_stats():
     db = get_db()
     
     # Total stats
-    total_users = db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
-    active_users = db.execute('SELECT COUNT(*) FROM users WHERE status="active"').fetchone()[0]
+    totals = get_platform_totals(db)
+    total_users = totals['users']
+    active_users = totals['active_users']
     total_tasks = db.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
     active_tasks = db.execute('SELECT COUNT(*) FROM tasks WHERE status="active"').fetchone()[0]
     
     # Earnings stats
-    total_earned = db.execute('SELECT SUM(total_earned) FROM users').fetchone()[0] or 0
-    total_withdrawn = db.execute('SELECT SUM(amount) FROM withdrawals WHERE status="approved"').fetchone()[0] or 0
+    total_earned = totals['total_earned']
+    total_withdrawn = sum_daily_stats(db)['approved_amount']
     platform_balance = total_earned - total_withdrawn
     
     # Today's stats
-    today = datetime.now().strftime('%Y-%m-%d')
-    today_earnings = db.execute('SELECT SUM(amount) FROM transactions WHERE DATE(timestamp) = ? AND type="task_completion"', (today,)).fetchone()[0] or 0
-    today_users = db.execute('SELECT COUNT(*) FROM users WHERE DATE(created_at) = ?', (today,)).fetchone()[0]
-    today_withdrawals = db.execute('SELECT SUM(amount) FROM withdrawals WHERE DATE(requested_at) = ?', (today,)).fetchone()[0] or 0
+    today = get_daily_stats(db, business_today())
+    today_earnings = today['task_earnings']
+    today_users = today['signups']
+    today_withdrawals = today['withdrawal_amount']
     
     # Recent activities
     recent_transactions = db.execute('''
@@ -316,26 +2815,37 @@ def dashboard_stats():
 
 @app.route('/api/tasks', methods=['GET'])
 def get_all_tasks():
+    return cached_json_response('tasks:all', TASKS_CACHE_TTL, build_all_tasks)
+
+def build_all_tasks():
     db = get_db()
     cursor = db.execute('SELECT * FROM tasks WHERE status="active" ORDER BY reward DESC')
-    tasks = [row_to_dict(row) for row in cursor.fetchall()]
+    tasks = with_pending_completions([row_to_dict(row) for row in cursor.fetchall()])
     
-    return jsonify({
+    return {
         "success": True,
         "tasks": tasks,
         "count": len(tasks),
         "message": "Tasks loaded successfully"
-    })
+    }
 
 @app.route('/api/tasks/<int:task_id>', methods=['GET'])
 def get_single_task(task_id):
+    response = cached_json_response(f'tasks:{task_id}', TASKS_CACHE_TTL,
+                                    lambda: build_single_task(task_id))
+    if response is not None:
+        return response
+    return jsonify({"success": False, "error": "Task not found"}), 404
+
+def build_single_task(task_id):
     db = get_db()
     cursor = db.execute('SELECT * FROM tasks WHERE id = ?', (task_id,))
     task = row_to_dict(cursor.fetchone())
     
     if task:
-        return jsonify({"success": True, "task": task})
-    return jsonify({"success": False, "error": "Task not found"}), 404
+        with_pending_completions([task])
+        return {"success": True, "task": task}
+    return None
 
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -374,6 +2884,8 @@ def register():
         ''', (email, hashed_password, name, 50.0, user_referral_code, phone))
         
         user_id = db.execute('SELECT last_insert_rowid()').fetchone()[0]
+        referrer_id = None
+        postings = [(user_id, 50.0, 'signup_bonus', 'signup')]
         
         # Process referral if provided
         if referral_code:
@@ -383,27 +2895,28 @@ def register():
                 referrer_id = referrer[0]
                 # Add referral record
                 db.execute('''
-                    INSERT INTO referrals (referrer_id, referred_id, referral_code)
-                    VALUES (?, ?, ?)
-                ''', (referrer_id, user_id, referral_code))
+                    INSERT INTO referrals (referrer_id, referred_id, referral_code, earned_amount)
+                    VALUES (?, ?, ?, ?)
+                ''', (referrer_id, user_id, referral_code, REFERRAL_BONUS))
                 
                 # Update referrer's stats
-                db.execute('''
+                cursor = db.execute('''
                     UPDATE users SET 
                     referrals_count = referrals_count + 1,
-                    referral_earnings = referral_earnings + 50.0,
-                    balance = balance + 50.0
+                    referral_earnings = referral_earnings + ?,
+                    balance = balance + ?
                     WHERE id = ?
-                ''', (referrer_id,))
+                    RETURNING balance, referrals_count
+                ''', (REFERRAL_BONUS, REFERRAL_BONUS, referrer_id))
+                referrer_update = cursor.fetchone()
+                postings.append((referrer_id, REFERRAL_BONUS, 'referral_bonus', f'referral:{user_id}'))
                 
                 # Add referral transaction
                 db.execute('''
                     INSERT INTO transactions 
                     (user_id, amount, type, description, balance_after)
-                    SELECT ?, 50.0, 'referral_bonus', 
-                    'Referral bonus from ' || email, balance + 50.0
-                    FROM users WHERE id = ?
-                ''', (referrer_id, referrer_id))
+                    VALUES (?, ?, 'referral_bonus', ?, ?)
+                ''', (referrer_id, REFERRAL_BONUS, f'Referral bonus from {email}', referrer_update[0]))
         
         # Welcome bonus transaction
         db.execute('''
@@ -411,12 +2924,24 @@ def register():
             (user_id, amount, type, description, balance_after)
             VALUES (?, ?, ?, ?, ?)
         ''', (user_id, 50.0, 'signup_bonus', 'Welcome bonus for new registration', 50.0))
+        post_ledger(db, postings)
         
         db.commit()
         
+        if referrer_id:
+            leaderboards.record(referrer_id, REFERRAL_BONUS)
+            publish_user_event(referrer_id, 'balance', {
+                "balance": referrer_update[0], "delta": REFERRAL_BONUS, "reason": "referral_bonus",
+                "referrals_count": referrer_update[1]
+            })
+        
         # Get user data
         cursor = db.execute('SELECT * FROM users WHERE id = ?', (user_id,))
         user = row_to_dict(cursor.fetchone())
+        publish_admin_event('user_registered', {
+            "user_id": user_id, "name": user['name'], "referrer_id": referrer_id,
+            "created_at": user['created_at']
+        })
         
         # Remove password
         user_response = {k: v for k, v in user.items() if k != 'password'}
@@ -425,10 +2950,12 @@ def register():
             "success": True,
             "message": "Account created successfully! ₹50 welcome bonus credited.",
             "user": user_response,
-            "token": f"token-{user_id}-{secrets.token_hex(8)}",
+            "token": issue_token(user_id),
             "bonus": 50.0
         })
         
+    except PasswordPoolBusy:
+        return jsonify({"success": False, "error": "Server busy, please try again"}), 503
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -451,54 +2978,64 @@ def login():
         user_dict = row_to_dict(user)
         
         # Verify password
-        if not verify_password(user_dict.get('password'), password):
-            return jsonify({"success": False, "error": "Invalid password"}), 401
-        
-        # Update last login
-        db.execute('UPDATE users SET last_login = ? WHERE id = ?', 
-                  (datetime.now().isoformat(), user_dict['id']))
+        try:
+            if not verify_password(user_dict.get('password'), password):
+                return jsonify({"success": False, "error": "Invalid password"}), 401
+            
+            # Upgrade legacy or outdated hashes now that we have the plaintext
+            if password_needs_rehash(user_dict['password']):
+                db.execute('UPDATE users SET password = ? WHERE id = ?',
+                           (hash_password(password), user_dict['id']))
+        except PasswordPoolBusy:
+            return jsonify({"success": False, "error": "Server busy, please try again"}), 503
         
-        # Check daily login bonus
-        today = datetime.now().strftime('%Y-%m-%d')
-        cursor = db.execute('SELECT * FROM daily_logins WHERE user_id = ? AND login_date = ?', 
-                           (user_dict['id'], today))
-        daily_login = cursor.fetchone()
+        # Claim today's bonus and advance the streak in one conditional
+        # update. A second login the same day (even a concurrent one) matches
+        # no row and only records last_login.
+        today = business_today().isoformat()
+        yesterday = (business_today() - timedelta(days=1)).isoformat()
+        streak = 'CASE WHEN last_login_date = ? THEN current_streak + 1 ELSE 1 END'
+        cursor = db.execute(f'''
+            UPDATE users SET
+            current_streak = {streak},
+            balance = balance + MIN(({streak}) * ?, ?),
+            last_login_date = ?,
+            last_login = ?
+            WHERE id = ? AND last_login_date IS NOT ?
+            RETURNING current_streak, balance
+        ''', (yesterday, yesterday, DAILY_BONUS_STEP, DAILY_BONUS_MAX, today,
+              datetime.now().isoformat(), user_dict['id'], today))
+        claimed = cursor.fetchone()
+        bonus_amount = 0
         
-        if not daily_login:
-            # Calculate streak
-            yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
-            cursor = db.execute('SELECT streak_count FROM daily_logins WHERE user_id = ? AND login_date = ?',
-                               (user_dict['id'], yesterday))
-            yesterday_login = cursor.fetchone()
-            
-            streak_count = 1
-            if yesterday_login:
-                streak_count = yesterday_login[0] + 1
-            
-            # Calculate bonus (₹10 per day of streak, max ₹70)
-            bonus_amount = min(streak_count * 10, 70)
+        if claimed:
+            streak_count, balance = claimed
+            bonus_amount = daily_bonus_for(streak_count)
+            user_dict.update(balance=balance, current_streak=streak_count, last_login_date=today)
             
-            # Add daily bonus
             db.execute('''
                 INSERT INTO daily_logins (user_id, login_date, streak_count, bonus_amount)
                 VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id, login_date) DO NOTHING
             ''', (user_dict['id'], today, streak_count, bonus_amount))
             
-            # Update user balance
-            db.execute('UPDATE users SET balance = balance + ? WHERE id = ?', 
-                      (bonus_amount, user_dict['id']))
-            
             # Add transaction
             db.execute('''
                 INSERT INTO transactions 
                 (user_id, amount, type, description, balance_after)
-                SELECT ?, ?, ?, ?, balance + ?
-                FROM users WHERE id = ?
-            ''', (user_dict['id'], bonus_amount, 'daily_bonus', 
-                  f'Daily login bonus (Day {streak_count})', bonus_amount, user_dict['id']))
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_dict['id'], bonus_amount, 'daily_bonus',
+                  f'Daily login bonus (Day {streak_count})', balance))
+            post_ledger(db, [(user_dict['id'], bonus_amount, 'daily_bonus', f'login:{today}')])
+        else:
+            db.execute('UPDATE users SET last_login = ? WHERE id = ?',
+                       (datetime.now().isoformat(), user_dict['id']))
         
         db.commit()
         
+        if claimed:
+            leaderboards.record(user_dict['id'], bonus_amount)
+        
         # Remove password from response
         user_response = {k: v for k, v in user_dict.items() if k != 'password'}
         
@@ -506,163 +3043,474 @@ def login():
             "success": True,
             "message": "Login successful",
             "user": user_response,
-            "token": f"token-{user_dict['id']}-{secrets.token_hex(8)}",
-            "daily_bonus": bonus_amount if 'bonus_amount' in locals() else 0
+            "token": issue_token(user_dict['id'], bool(user_dict.get('is_admin'))),
+            "daily_bonus": bonus_amount
         })
     
     return jsonify({"success": False, "error": "User not found"}), 404
 
+class TaskCompletionError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def record_task_completion(db, user_id, task_id, before_commit=None):
+    """Credit one completion of task_id to user_id in a single write transaction.
+
+    The per-(user, task, day) counter upsert only succeeds while the count is
+    below the task's daily limit, and balances are updated relatively, so
+    concurrent completions can neither exceed the limit nor lose a credit.
+    before_commit(user, task) runs inside the transaction just before it
+    commits. Returns (user, task) with the user row as of the commit.
+    """
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        cursor = db.execute('SELECT id, title, reward, status, daily_limit FROM tasks WHERE id = ?', (task_id,))
+        task = row_to_dict(cursor.fetchone())
+
+        if not task:
+            raise TaskCompletionError("Task not found", 404)
+
+        if task.get('status') != 'active':
+            raise TaskCompletionError("Task is not available")
+
+        daily_limit = task.get('daily_limit') or 0
+        if daily_limit <= 0:
+            raise TaskCompletionError(f"Daily limit reached for this task (Max: {daily_limit})")
+
+        cursor = db.execute('''
+            INSERT INTO task_daily_counts (user_id, task_id, day, count)
+            VALUES (?, ?, ?, 1)
+            ON CONFLICT (user_id, task_id, day) DO UPDATE SET count = count + 1
+            WHERE count < ?
+            RETURNING count
+        ''', (user_id, task_id, business_today().isoformat(), daily_limit))
+        if cursor.fetchone() is None:
+            raise TaskCompletionError(f"Daily limit reached for this task (Max: {daily_limit})")
+
+        reward = task.get('reward', 0)
+        cursor = db.execute('''
+            UPDATE users SET 
+            balance = balance + ?, 
+            tasks_done = tasks_done + 1, 
+            total_earned = total_earned + ?
+            WHERE id = ?
+            RETURNING *
+        ''', (reward, reward, user_id))
+        user = row_to_dict(cursor.fetchone())
+
+        if not user:
+            raise TaskCompletionError("User not found", 404)
+
+        db.execute('''
+            INSERT INTO transactions 
+            (user_id, task_id, task_title, amount, type, description, balance_after)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, task_id, task['title'], reward, 'task_completion',
+              f"Completed: {task['title']}", user['balance']))
+        post_ledger(db, [(user_id, reward, 'task_completion', f'task:{task_id}')])
+        if before_commit is not None:
+            before_commit(user, task)
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    task_completion_counter.add(task_id)
+    leaderboards.record(user['id'], reward, user['total_earned'])
+    return user, task
+
+class PendingCompletion:
+    __slots__ = ('user_id', 'task_id', 'title', 'reward', 'day', 'future', 'attempts')
+
+    def __init__(self, user_id, task_id, title, reward, day, future):
+        self.user_id = user_id
+        self.task_id = task_id
+        self.title = title
+        self.reward = reward
+        self.day = day
+        self.future = future
+        self.attempts = 0
+
+class CompletionWriter:
+    """Write-behind (group commit) path for task completions.
+
+    Enabled with COMPLETION_COMMIT_MODE=group. Completions are checked
+    against in-process daily counters, queued, and written by one flusher
+    thread: a single transaction per batch, executemany for the ledger rows
+    and aggregated relative updates for users, tasks and the daily counters.
+    A batch goes out after COMPLETION_FLUSH_MS or once COMPLETION_BATCH_SIZE
+    completions are waiting.
+
+    COMPLETION_DURABILITY=commit (default) makes each request wait for its
+    batch to commit; =async answers immediately and can lose the last batch
+    if the process is killed. The counters are authoritative only within one
+    process, so run group mode with a single worker and threads.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, mode, batch_size, interval, durability):
+        self.enabled = mode == 'group'
+        self.batch_size = batch_size
+        self.interval = interval
+        self.durability = durability
+        self._cond = threading.Condition()
+        self._queue = []
+        self._counters = {}
+        self._pending = {}
+        self._day = None
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        self._stats = {"submitted": 0, "batches": 0, "rows": 0, "max_batch": 0,
+                       "retries": 0, "failed": 0, "flush_seconds": 0.0}
+
+    def _ensure_thread(self):
+        # Called with self._cond held. Threads and queued work do not survive fork.
+        if self._pid != os.getpid():
+            self._queue, self._counters, self._pending = [], {}, {}
+            self._thread = None
+            self._pid = os.getpid()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='completion-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, db, user_id, task_id):
+        """Validate and queue one completion; returns (user, task, future) like record_task_completion.
+
+        The future resolves with the balance once the completion's batch
+        commits, or fails if the batch is dropped.
+        """
+        user_id, task_id = int(user_id), int(task_id)
+        cursor = db.execute('SELECT id, title, reward, status, daily_limit FROM tasks WHERE id = ?', (task_id,))
+        task = row_to_dict(cursor.fetchone())
+
+        if not task:
+            raise TaskCompletionError("Task not found", 404)
+
+        if task.get('status') != 'active':
+            raise TaskCompletionError("Task is not available")
+
+        daily_limit = task.get('daily_limit') or 0
+        reward = task.get('reward', 0)
+        day = business_today().isoformat()
+        future = Future()
+
+        with self._cond:
+            if self._closed:
+                raise TaskCompletionError("Server is shutting down, try again", 503)
+            self._ensure_thread()
+            if day != self._day:
+                self._counters = {key: count for key, count in self._counters.items() if key[2] == day}
+                self._day = day
+
+            cursor = db.execute('SELECT * FROM users WHERE id = ?', (user_id,))
+            user = row_to_dict(cursor.fetchone())
+            if not user:
+                raise TaskCompletionError("User not found", 404)
+
+            key = (user_id, task_id, day)
+            if key not in self._counters:
+                cursor = db.execute('SELECT count FROM task_daily_counts WHERE user_id = ? AND task_id = ? AND day = ?', key)
+                row = cursor.fetchone()
+                self._counters[key] = row[0] if row else 0
+            if self._counters[key] >= daily_limit:
+                raise TaskCompletionError(f"Daily limit reached for this task (Max: {daily_limit})")
+            self._counters[key] += 1
+
+            pending = self._pending.setdefault(user_id, [0, 0])
+            pending[0] += reward
+            pending[1] += 1
+            user['balance'] += pending[0]
+            user['total_earned'] += pending[0]
+            user['tasks_done'] += pending[1]
+
+            self._queue.append(PendingCompletion(user_id, task_id, task['title'], reward, day, future))
+            self._stats["submitted"] += 1
+            self._cond.notify()
+
+        if self.durability == 'commit':
+            try:
+                user['balance'] = future.result()
+            except Exception:
+                raise TaskCompletionError("Could not record completion, try again", 503)
+        return user, task, future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                deadline = time.monotonic() + self.interval
+                while len(self._queue) < self.batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._queue[:self.batch_size]
+                del self._queue[:self.batch_size]
+            self._flush(batch)
+
+    def _flush(self, batch):
+        started = time.perf_counter()
+        db = db_pool.acquire()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            user_ids = sorted({item.user_id for item in batch})
+            placeholders = ','.join('?' * len(user_ids))
+            rows = db.execute(f'SELECT id, balance, total_earned FROM users WHERE id IN ({placeholders})', user_ids).fetchall()
+            balances = {row[0]: row[1] for row in rows}
+            earned = {row[0]: row[2] for row in rows}
+
+            history, results = [], []
+            per_user, per_task, per_key = {}, {}, {}
+            for item in batch:
+                balances[item.user_id] += item.reward
+                results.append(balances[item.user_id])
+                history.append((item.user_id, item.task_id, item.title, item.reward, 'task_completion',
+                                f"Completed: {item.title}", balances[item.user_id]))
+                totals = per_user.setdefault(item.user_id, [0, 0])
+                totals[0] += item.reward
+                totals[1] += 1
+                per_task[item.task_id] = per_task.get(item.task_id, 0) + 1
+                key = (item.user_id, item.task_id, item.day)
+                per_key[key] = per_key.get(key, 0) + 1
+
+            db.executemany('''
+                INSERT INTO task_daily_counts (user_id, task_id, day, count) VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id, task_id, day) DO UPDATE SET count = count + excluded.count
+            ''', [key + (count,) for key, count in per_key.items()])
+            db.executemany('''
+                UPDATE users SET balance = balance + ?, tasks_done = tasks_done + ?, total_earned = total_earned + ?
+                WHERE id = ?
+            ''', [(credit, count, credit, uid) for uid, (credit, count) in per_user.items()])
+            db.executemany('''
+                INSERT INTO transactions
+                (user_id, task_id, task_title, amount, type, description, balance_after)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', history)
+            post_ledger(db, [(item.user_id, item.reward, 'task_completion', f'task:{item.task_id}') for item in batch])
+
+            # Commit and retire the pending credits together so submit() never
+            # sees a balance that both includes and still adds the same credit
+            with self._cond:
+                db.commit()
+                self._release_pending(per_user)
+                for task_id, count in per_task.items():
+                    task_completion_counter.add(task_id, count)
+                for uid, (credit, _) in per_user.items():
+                    leaderboards.record(uid, credit, earned[uid] + credit)
+                self._stats["batches"] += 1
+                self._stats["rows"] += len(batch)
+                self._stats["max_batch"] = max(self._stats["max_batch"], len(batch))
+                self._stats["flush_seconds"] += time.perf_counter() - started
+        except Exception as e:
+            if db.in_transaction:
+                db.rollback()
+            self._retry_or_fail(batch, e)
+            return
+
+        for item, balance in zip(batch, results):
+            item.future.set_result(balance)
+
+    def _release_pending(self, per_user):
+        for uid, (credit, count) in per_user.items():
+            pending = self._pending.get(uid)
+            if pending is None:
+                continue
+            pending[0] -= credit
+            pending[1] -= count
+            if pending[1] <= 0:
+                del self._pending[uid]
+
+    def _retry_or_fail(self, batch, error):
+        retry = [item for item in batch if item.attempts + 1 < self.MAX_ATTEMPTS]
+        failed = [item for item in batch if item.attempts + 1 >= self.MAX_ATTEMPTS]
+        with self._cond:
+            for item in retry:
+                item.attempts += 1
+            self._queue[:0] = retry
+            self._stats["retries"] += len(retry)
+            self._stats["failed"] += len(failed)
+            per_user = {}
+            for item in failed:
+                key = (item.user_id, item.task_id, item.day)
+                if key in self._counters:
+                    self._counters[key] -= 1
+                totals = per_user.setdefault(item.user_id, [0, 0])
+                totals[0] += item.reward
+                totals[1] += 1
+            self._release_pending(per_user)
+        if failed:
+            print(f"❌ Dropped {len(failed)} task completions after {self.MAX_ATTEMPTS} attempts: {error}")
+        for item in failed:
+            item.future.set_exception(error)
+        if retry:
+            time.sleep(self.interval)
+
+    def close(self, timeout=10):
+        """Stop accepting completions and flush whatever is queued."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is not None:
+            thread.join(timeout)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(queued=len(self._queue), pending_users=len(self._pending),
+                         tracked_counters=len(self._counters))
+        stats.update(enabled=self.enabled, batch_size=self.batch_size,
+                     flush_ms=self.interval * 1000, durability=self.durability)
+        return stats
+
+completion_writer = CompletionWriter(os.environ.get('COMPLETION_COMMIT_MODE', 'immediate'),
+                                     int(os.environ.get('COMPLETION_BATCH_SIZE', 256)),
+                                     int(os.environ.get('COMPLETION_FLUSH_MS', 5)) / 1000,
+                                     os.environ.get('COMPLETION_DURABILITY', 'commit'))
+atexit.register(completion_writer.close)
+
+@app.route('/api/logout', methods=['POST'])
+@require_auth
+def logout():
+    token_cache.revoke(g.auth_claims)
+    return jsonify({"success": True, "message": "Logged out"})
+
 @app.route('/api/tasks/complete', methods=['POST'])
+@require_auth
+@idempotent
 def complete_task():
     data = request.get_json()
-    user_id = data.get('user_id')
+    user_id = data.get('user_id') or g.auth_user_id
     task_id = data.get('task_id')
     
     if not user_id or not task_id:
         return jsonify({"success": False, "error": "User ID and Task ID required"}), 400
     
-    db = get_db()
-    
-    # Get user
-    cursor = db.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-    user = row_to_dict(cursor.fetchone())
-    
-    if not user:
-        return jsonify({"success": False, "error": "User not found"}), 404
+    if not can_access_user(user_id):
+        return jsonify({"success": False, "error": "Not allowed for this user"}), 403
     
-    # Get task
-    cursor = db.execute('SELECT * FROM tasks WHERE id = ?', (task_id,))
-    task = row_to_dict(cursor.fetchone())
-    
-    if not task:
-        return jsonify({"success": False, "error": "Task not found"}), 404
-    
-    if task.get('status') != 'active':
-        return jsonify({"success": False, "error": "Task is not available"}), 400
-    
-    # Check daily limit
-    today = datetime.now().strftime('%Y-%m-%d')
-    cursor = db.execute('''
-        SELECT COUNT(*) FROM transactions 
-        WHERE user_id = ? AND task_id = ? AND DATE(timestamp) = ?
-    ''', (user_id, task_id, today))
-    
-    daily_count = cursor.fetchone()[0]
-    daily_limit = task.get('daily_limit', 1)
+    db = get_db()
     
-    if daily_count >= daily_limit:
-        return jsonify({
-            "success": False, 
-            "error": f"Daily limit reached for this task (Max: {daily_limit})"
-        }), 400
+    try:
+        if completion_writer.enabled:
+            user, task, committed = completion_writer.submit(db, user_id, task_id)
+            idempotency.after(committed)
+        else:
+            user, task = record_task_completion(
+                db, user_id, task_id,
+                before_commit=lambda user, task: idempotency.stage(db, lambda: completion_response(user, task)))
+    except TaskCompletionError as e:
+        return jsonify({"success": False, "error": e.message}), e.status
     
-    # Process reward
     reward = task.get('reward', 0)
-    new_balance = user.get('balance', 0) + reward
-    
-    # Update user
-    db.execute('''
-        UPDATE users SET 
-        balance = ?, 
-        tasks_done = tasks_done + 1, 
-        total_earned = total_earned + ?
-        WHERE id = ?
-    ''', (new_balance, reward, user_id))
-    
-    # Update task completion count
-    db.execute('UPDATE tasks SET total_completions = total_completions + 1 WHERE id = ?', (task_id,))
-    
-    # Create transaction
-    db.execute('''
-        INSERT INTO transactions 
-        (user_id, task_id, task_title, amount, type, description, balance_after)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (user_id, task_id, task['title'], reward, 'task_completion',
-          f"Completed: {task['title']}", new_balance))
-    
-    db.commit()
-    
-    # Get updated user
-    cursor = db.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-    updated_user = row_to_dict(cursor.fetchone())
+    publish_user_event(user['id'], 'balance', {
+        "balance": user['balance'], "delta": reward, "reason": "task_completion",
+        "task_id": task['id'], "tasks_done": user['tasks_done']
+    })
+    publish_admin_event('task_completed', {"user_id": user['id'], "task_id": task['id'], "reward": reward})
     
+    return completion_response(user, task)
+
+def completion_response(user, task):
+    reward = task.get('reward', 0)
     # Remove password
-    user_response = {k: v for k, v in updated_user.items() if k != 'password'}
+    user_response = {k: v for k, v in user.items() if k != 'password'}
     
     return jsonify({
         "success": True,
         "message": f"Task completed! ₹{reward} credited to your account.",
         "reward": reward,
-        "new_balance": new_balance,
+        "new_balance": user['balance'],
         "user": user_response
     })
 
+PROFILE_SECTIONS = ('transactions', 'withdrawals', 'stats')
+PROFILE_STAT_COLUMNS = ('profile_version',)
+
 @app.route('/api/user/<int:user_id>', methods=['GET'])
+@require_auth
 def get_user_profile(user_id):
-    db = get_db()
-    
-    cursor = db.execute('SELECT * FROM users WHERE id = ?', (user_id,))
-    user = row_to_dict(cursor.fetchone())
+    if not can_access_user(user_id):
+        return jsonify({"success": False, "error": "Not allowed for this user"}), 403
     
-    if not user:
-        return jsonify({"success": False, "error": "User not found"}), 404
+    # ?include=transactions,withdrawals,stats picks sections; the user is always returned
+    include = request.args.get('include')
+    sections = PROFILE_SECTIONS if include is None else [part for part in include.split(',') if part]
+    unknown = [section for section in sections if section not in PROFILE_SECTIONS]
+    if unknown:
+        return jsonify({"success": False, "error": f"include must be a subset of: {', '.join(PROFILE_SECTIONS)}"}), 400
+    sections = [section for section in PROFILE_SECTIONS if section in sections]
     
-    # Remove password
-    user_response = {k: v for k, v in user.items() if k != 'password'}
-    
-    # Get user transactions (last 20)
-    cursor = db.execute('''
-        SELECT * FROM transactions 
-        WHERE user_id = ? 
-        ORDER BY timestamp DESC 
-        LIMIT 20
-    ''', (user_id,))
-    transactions = [row_to_dict(row) for row in cursor.fetchall()]
-    
-    # Get user withdrawals
-    cursor = db.execute('''
-        SELECT * FROM withdrawals 
-        WHERE user_id = ? 
-        ORDER BY requested_at DESC 
-        LIMIT 10
-    ''', (user_id,))
-    withdrawals = [row_to_dict(row) for row in cursor.fetchall()]
+    db = get_db()
     
-    # Get referral stats
-    cursor = db.execute('''
-        SELECT COUNT(*) as total_refs, SUM(earned_amount) as total_earned
-        FROM referrals WHERE referrer_id = ?
-    ''', (user_id,))
-    ref_stats = row_to_dict(cursor.fetchone())
+    # One round trip for the user, the stats and the version stamp. The
+    # version only moves when the profile may have changed, so a client
+    # holding the matching ETag gets 304 without the remaining queries.
+    cursor = db.execute(PROFILE_QUERY, (user_id,))
+    profile = row_to_dict(cursor.fetchone())
     
-    # Get daily login streak
-    cursor = db.execute('''
-        SELECT streak_count FROM daily_logins 
-        WHERE user_id = ? 
-        ORDER BY login_date DESC 
-        LIMIT 1
-    ''', (user_id,))
-    streak_row = cursor.fetchone()
-    streak_count = streak_row[0] if streak_row else 0
+    if not profile:
+        return jsonify({"success": False, "error": "User not found"}), 404
     
-    return jsonify({
-        "success": True,
-        "user": user_response,
-        "transactions": transactions,
-        "withdrawals": withdrawals,
-        "stats": {
-            "total_earned": user.get('total_earned', 0),
-            "tasks_completed": user.get('tasks_done', 0),
-            "referral_count": ref_stats.get('total_refs', 0) if ref_stats else 0,
-            "referral_earnings": ref_stats.get('total_earned', 0) if ref_stats else 0,
-            "daily_streak": streak_count
+    etag = f"u{user_id}-v{profile['profile_version']}-{'.'.join(sections) or 'user'}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    
+    # Remove password
+    user_response = {k: v for k, v in profile.items() if k != 'password' and k not in PROFILE_STAT_COLUMNS}
+    payload = {"success": True, "user": user_response}
+    
+    if 'transactions' in sections:
+        # Get user transactions (last 20)
+        cursor = db.execute('''
+            SELECT * FROM transactions 
+            WHERE user_id = ? 
+            ORDER BY timestamp DESC 
+            LIMIT 20
+        ''', (user_id,))
+        payload["transactions"] = [row_to_dict(row) for row in cursor.fetchall()]
+    
+    if 'withdrawals' in sections:
+        # Get user withdrawals
+        cursor = db.execute('''
+            SELECT * FROM withdrawals 
+            WHERE user_id = ? 
+            ORDER BY requested_at DESC 
+            LIMIT 10
+        ''', (user_id,))
+        payload["withdrawals"] = [row_to_dict(row) for row in cursor.fetchall()]
+    
+    if 'stats' in sections:
+        payload["stats"] = {
+            "total_earned": profile.get('total_earned', 0),
+            "tasks_completed": profile.get('tasks_done', 0),
+            "referral_count": profile['referrals_count'],
+            "referral_earnings": profile['referral_earnings'],
+            "daily_streak": profile['current_streak']
         }
-    })
+    
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 @app.route('/api/withdraw/request', methods=['POST'])
+@require_auth
+@idempotent
 def withdraw_request():
     data = request.get_json()
-    user_id = data.get('user_id')
+    user_id = data.get('user_id') or g.auth_user_id
     amount = float(data.get('amount', 0))
     upi_id = data.get('upi_id', '').strip()
     method = data.get('method', 'upi')
@@ -679,6 +3527,9 @@ def withdraw_request():
     if method == 'upi' and '@' not in upi_id:
         return jsonify({"success": False, "error": "Invalid UPI ID format"}), 400
     
+    if not can_access_user(user_id):
+        return jsonify({"success": False, "error": "Not allowed for this user"}), 403
+    
     db = get_db()
     
     # Get user
@@ -688,23 +3539,36 @@ def withdraw_request():
     if not user:
         return jsonify({"success": False, "error": "User not found"}), 404
     
+    risk = db.execute('SELECT score, flagged FROM risk_scores WHERE user_id = ?', (user_id,)).fetchone()
+    if risk and risk['flagged'] and risk['score'] >= RISK_HOLD_SCORE:
+        return jsonify({"success": False, "error": "Withdrawals are on hold while this account is reviewed"}), 403
+    
     if user['balance'] < amount:
         return jsonify({"success": False, "error": "Insufficient balance"}), 400
     
-    # Check daily withdrawal limit
-    today = datetime.now().strftime('%Y-%m-%d')
+    # Check daily withdrawal limit under the write lock, so a concurrent
+    # request cannot add its withdrawal between this sum and the insert
+    db.execute('BEGIN IMMEDIATE')
+    day_start, day_end = day_window()
     cursor = db.execute('''
         SELECT SUM(amount) FROM withdrawals 
-        WHERE user_id = ? AND DATE(requested_at) = ? AND status IN ('pending', 'approved')
-    ''', (user_id, today))
+        WHERE user_id = ? AND requested_at >= ? AND requested_at < ? AND status IN ('pending', 'approved')
+    ''', (user_id, day_start, day_end))
     today_withdrawals = cursor.fetchone()[0] or 0
     
     if today_withdrawals + amount > 5000:
+        db.rollback()
         return jsonify({"success": False, "error": "Daily withdrawal limit exceeded (Max: ₹5000)"}), 400
     
-    # Deduct amount
-    new_balance = user['balance'] - amount
-    db.execute('UPDATE users SET balance = ? WHERE id = ?', (new_balance, user_id))
+    # Deduct amount relative to the current row; a concurrent debit that
+    # already spent the balance leaves no row to update
+    cursor = db.execute('UPDATE users SET balance = balance - ? WHERE id = ? AND balance >= ? RETURNING balance',
+                        (amount, user_id, amount))
+    deducted = cursor.fetchone()
+    if deducted is None:
+        db.rollback()
+        return jsonify({"success": False, "error": "Insufficient balance"}), 400
+    new_balance = deducted[0]
     
     # Create withdrawal record
     transaction_id = f"WT{datetime.now().strftime('%Y%m%d')}{secrets.token_hex(4).upper()}"
@@ -724,22 +3588,32 @@ def withdraw_request():
         VALUES (?, ?, ?, ?, ?, ?)
     ''', (user_id, amount, 'withdrawal_request', 
           f"Withdrawal request to {upi_id} ({method.upper()})", new_balance, withdrawal_id))
-    
-    db.commit()
+    post_ledger(db, [(user_id, -amount, 'withdrawal', f'withdrawal:{withdrawal_id}')])
     
     # Get withdrawal record
     cursor = db.execute('SELECT * FROM withdrawals WHERE id = ?', (withdrawal_id,))
     withdrawal = row_to_dict(cursor.fetchone())
-    
-    return jsonify({
+    response = jsonify({
         "success": True,
         "message": f"Withdrawal request for ₹{amount} submitted successfully",
         "withdrawal": withdrawal,
         "new_balance": new_balance
     })
+    idempotency.stage(db, lambda: response)
+    
+    db.commit()
+    
+    publish_withdrawal_event(withdrawal)
+    publish_user_event(user_id, 'balance', {"balance": new_balance, "delta": -amount, "reason": "withdrawal_request"})
+    
+    return response
 
 @app.route('/api/referral/stats/<int:user_id>', methods=['GET'])
+@require_auth
 def referral_stats(user_id):
+    if not can_access_user(user_id):
+        return jsonify({"success": False, "error": "Not allowed for this user"}), 403
+    
     db = get_db()
     
     # Get referral list
@@ -757,10 +3631,10 @@ def referral_stats(user_id):
         SELECT 
             COUNT(*) as total_referrals,
             SUM(earned_amount) as total_earnings,
-            COUNT(CASE WHEN DATE(r.created_at) = DATE('now') THEN 1 END) as today_referrals
+            COUNT(CASE WHEN r.created_at >= ? AND r.created_at < ? THEN 1 END) as today_referrals
         FROM referrals r
         WHERE r.referrer_id = ?
-    ''', (user_id,))
+    ''', (*day_window(), user_id))
     summary = row_to_dict(cursor.fetchone())
     
     return jsonify({
@@ -769,27 +3643,73 @@ def referral_stats(user_id):
         "summary": summary
     })
 
+@app.route('/api/leaderboard', methods=['GET'])
+def get_leaderboard():
+    board = request.args.get('board', 'week')
+    if board not in Leaderboards.BOARDS:
+        return jsonify({"success": False, "error": f"board must be one of: {', '.join(Leaderboards.BOARDS)}"}), 400
+
+    try:
+        limit = int(request.args.get('limit', LEADERBOARD_K))
+    except ValueError:
+        return jsonify({"success": False, "error": "limit must be an integer"}), 400
+    if limit < 1:
+        return jsonify({"success": False, "error": "limit must be at least 1"}), 400
+
+    db = get_db()
+    period_start, ranked = leaderboards.top(db, board, limit)
+
+    # Names only: this endpoint is public, so no emails or balances
+    user_ids = [user_id for user_id, _ in ranked]
+    cursor = db.execute(f'SELECT id, name FROM users WHERE id IN ({",".join("?" * len(user_ids))})', user_ids)
+    names = dict(cursor.fetchall())
+
+    entries = [{
+        "rank": rank,
+        "user_id": user_id,
+        "name": names.get(user_id),
+        "amount": round(amount, 2)
+    } for rank, (user_id, amount) in enumerate(ranked, start=1)]
+
+    return jsonify({
+        "success": True,
+        "board": board,
+        "period_start": period_start.isoformat() if period_start else None,
+        "entries": entries,
+        "count": len(entries)
+    })
+
+@app.route('/api/stream/user/<int:user_id>', methods=['GET'])
+def stream_user_events(user_id):
+    token = bearer_token(request.headers.get('Authorization')) or request.args.get('token')
+    try:
+        return event_stream_response(stream_topic('user', user_id, token))
+    except StreamError as e:
+        return jsonify({"success": False, "error": e.message}), e.status
+
 # ========== ADMIN ENDPOINTS ==========
 @app.route('/api/admin/dashboard', methods=['GET'])
 def admin_dashboard():
     db = get_db()
     
     # Overall stats
-    total_users = db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
-    total_balance = db.execute('SELECT SUM(balance) FROM users').fetchone()[0] or 0
-    total_withdrawn = db.execute('SELECT SUM(amount) FROM withdrawals WHERE status="approved"').fetchone()[0] or 0
-    pending_withdrawals = db.execute('SELECT SUM(amount) FROM withdrawals WHERE status="pending"').fetchone()[0] or 0
+    totals = get_platform_totals(db)
+    withdrawals = sum_daily_stats(db)
+    total_users = totals['users']
+    total_balance = totals['total_balance']
+    total_withdrawn = withdrawals['approved_amount']
+    pending_withdrawals = pending_amount(withdrawals)
     
     # Today's stats
-    today = datetime.now().strftime('%Y-%m-%d')
-    today_signups = db.execute('SELECT COUNT(*) FROM users WHERE DATE(created_at) = ?', (today,)).fetchone()[0]
-    today_earnings = db.execute('SELECT SUM(amount) FROM transactions WHERE DATE(timestamp) = ? AND type="task_completion"', (today,)).fetchone()[0] or 0
-    today_withdrawals = db.execute('SELECT SUM(amount) FROM withdrawals WHERE DATE(requested_at) = ? AND status="approved"', (today,)).fetchone()[0] or 0
+    today = get_daily_stats(db, business_today())
+    today_signups = today['signups']
+    today_earnings = today['task_earnings']
+    today_withdrawals = today['approved_amount']
     
     # Weekly stats
-    week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
-    weekly_signups = db.execute('SELECT COUNT(*) FROM users WHERE DATE(created_at) >= ?', (week_ago,)).fetchone()[0]
-    weekly_earnings = db.execute('SELECT SUM(amount) FROM transactions WHERE DATE(timestamp) >= ? AND type="task_completion"', (week_ago,)).fetchone()[0] or 0
+    weekly = sum_daily_stats(db, start=business_today() - timedelta(days=7))
+    weekly_signups = weekly['signups']
+    weekly_earnings = weekly['task_earnings']
     
     # Recent activities
     recent_users = db.execute('SELECT id, name, email, balance, created_at FROM users ORDER BY id DESC LIMIT 5')
@@ -809,23 +3729,29 @@ def admin_dashboard():
     ''')
     recent_withdrawals = [row_to_dict(row) for row in recent_withdrawals.fetchall()]
     
-    # Top earners
-    top_earners = db.execute('''
+    # Top earners, ranked by the in-memory all-time board
+    _, ranked = leaderboards.top(db, 'all_time', 5)
+    top_ids = [user_id for user_id, _ in ranked]
+    top_earners = db.execute(f'''
         SELECT id, name, email, total_earned, balance, tasks_done 
         FROM users 
-        ORDER BY total_earned DESC 
-        LIMIT 5
-    ''')
-    top_earners = [row_to_dict(row) for row in top_earners.fetchall()]
-    
-    # Popular tasks
-    popular_tasks = db.execute('''
+        WHERE id IN ({','.join('?' * len(top_ids))})
+    ''', top_ids)
+    top_earners = {row['id']: row_to_dict(row) for row in top_earners.fetchall()}
+    top_earners = [top_earners[user_id] for user_id in top_ids if user_id in top_earners]
+    
+    # Popular tasks (stored totals plus unfolded completions; any task with
+    # pending completions may overtake the stored top 5, so fetch those too)
+    pending = task_completion_counter.pending()
+    placeholders = ','.join('?' * len(pending))
+    popular_tasks = db.execute(f'''
         SELECT id, title, reward, total_completions, daily_limit
         FROM tasks 
-        ORDER BY total_completions DESC 
-        LIMIT 5
-    ''')
-    popular_tasks = [row_to_dict(row) for row in popular_tasks.fetchall()]
+        WHERE id IN (SELECT id FROM tasks ORDER BY total_completions DESC LIMIT 5)
+        {f'OR id IN ({placeholders})' if pending else ''}
+    ''', list(pending))
+    popular_tasks = with_pending_completions([row_to_dict(row) for row in popular_tasks.fetchall()])
+    popular_tasks = sorted(popular_tasks, key=lambda task: task['total_completions'] or 0, reverse=True)[:5]
     
     return jsonify({
         "success": True,
@@ -851,17 +3777,30 @@ def admin_dashboard():
         }
     })
 
+@app.route('/api/stream/admin', methods=['GET'])
+def stream_admin_events():
+    try:
+        return event_stream_response(stream_topic('admin'))
+    except StreamError as e:
+        return jsonify({"success": False, "error": e.message}), e.status
+
 @app.route('/api/admin/users', methods=['GET'])
 def admin_get_users():
     db = get_db()
-    cursor = db.execute('SELECT * FROM users ORDER BY id DESC')
-    users = [row_to_dict(row) for row in cursor.fetchall()]
+    
+    try:
+        where, params = user_filters()
+        page = keyset_page(db, '*', 'users', where, params, 'created_at', 'id')
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
+    users = page.pop('items')
     
     # Remove passwords
     for user in users:
         user.pop('password', None)
     
-    return jsonify({"success": True, "users": users, "count": len(users)})
+    return jsonify({"success": True, "users": users, **page})
 
 @app.route('/api/admin/users/<int:user_id>', methods=['GET'])
 def admin_get_user(user_id):
@@ -893,19 +3832,57 @@ def admin_get_user(user_id):
     return jsonify({
         "success": True,
         "user": user,
+        "ledger": ledger_balance(db, user_id),
         "transactions": transactions,
         "withdrawals": withdrawals
     })
 
+@app.route('/api/admin/users/<int:user_id>/ledger', methods=['GET'])
+def admin_get_user_ledger(user_id):
+    """Newest-first ledger entries for a user; page back with ?before=<seq>."""
+    db = get_db()
+    limit = min(max(request.args.get('limit', LEDGER_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    before = request.args.get('before', type=int)
+    
+    query = 'SELECT seq, account, amount, reference, created_at FROM ledger_entries WHERE user_id = ?'
+    params = [user_id]
+    if before is not None:
+        query += ' AND seq < ?'
+        params.append(before)
+    cursor = db.execute(query + ' ORDER BY seq DESC LIMIT ?', params + [limit])
+    entries = [dict(row_to_dict(row), amount=row['amount'] / 100) for row in cursor]
+    
+    return jsonify({
+        "success": True,
+        "balance": ledger_balance(db, user_id),
+        "entries": entries,
+        "next_before": entries[-1]['seq'] if len(entries) == limit and entries[-1]['seq'] > 1 else None
+    })
+
 @app.route('/api/admin/users/<int:user_id>/update', methods=['POST'])
 def admin_update_user(user_id):
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"success": False, "error": "Request body must be a JSON object"}), 400
+    
+    # Validate before taking the write lock
+    if 'balance' in data:
+        try:
+            balance = float(data['balance'])
+        except (TypeError, ValueError):
+            balance = math.nan
+        if not math.isfinite(balance):
+            return jsonify({"success": False, "error": "balance must be a number"}), 400
     
     db = get_db()
     
-    # Check if user exists
-    cursor = db.execute('SELECT id FROM users WHERE id = ?', (user_id,))
-    if not cursor.fetchone():
+    # Check if user exists; the write lock keeps the balance read below
+    # current until the adjustment is posted
+    db.execute('BEGIN IMMEDIATE')
+    cursor = db.execute('SELECT id, balance FROM users WHERE id = ?', (user_id,))
+    current = cursor.fetchone()
+    if not current:
+        db.rollback()
         return jsonify({"success": False, "error": "User not found"}), 404
     
     # Update fields
@@ -914,7 +3891,9 @@ def admin_update_user(user_id):
     
     if 'balance' in data:
         update_fields.append('balance = ?')
-        update_values.append(float(data['balance']))
+        update_values.append(balance)
+        adjustment = to_paise(balance) - to_paise(current['balance'])
+        post_ledger(db, [(user_id, adjustment / 100, 'adjustment', 'admin')])
     
     if 'status' in data:
         update_fields.append('status = ?')
@@ -928,7 +3907,7 @@ def admin_update_user(user_id):
         update_values.append(user_id)
         query = f'UPDATE users SET {", ".join(update_fields)} WHERE id = ?'
         db.execute(query, update_values)
-        db.commit()
+    db.commit()
     
     return jsonify({"success": True, "message": "User updated successfully"})
 
@@ -936,7 +3915,7 @@ def admin_update_user(user_id):
 def admin_get_tasks():
     db = get_db()
     cursor = db.execute('SELECT * FROM tasks ORDER BY id DESC')
-    tasks = [row_to_dict(row) for row in cursor.fetchall()]
+    tasks = with_pending_completions([row_to_dict(row) for row in cursor.fetchall()])
     return jsonify({"success": True, "tasks": tasks, "count": len(tasks)})
 
 @app.route('/api/admin/tasks/create', methods=['POST'])
@@ -966,6 +3945,7 @@ def admin_create_task():
     ))
     
     db.commit()
+    invalidate_task_cache()
     return jsonify({"success": True, "message": "Task created successfully"})
 
 @app.route('/api/admin/tasks/<int:task_id>/update', methods=['POST'])
@@ -997,54 +3977,55 @@ def admin_update_task(task_id):
         query = f'UPDATE tasks SET {", ".join(update_fields)} WHERE id = ?'
         db.execute(query, update_values)
         db.commit()
+        invalidate_task_cache()
     
     return jsonify({"success": True, "message": "Task updated successfully"})
 
 @app.route('/api/admin/withdrawals', methods=['GET'])
 def admin_get_withdrawals():
     db = get_db()
-    cursor = db.execute('''
-        SELECT w.*, u.name as user_name, u.email as user_email 
-        FROM withdrawals w
-        JOIN users u ON w.user_id = u.id
-        ORDER BY w.requested_at DESC
-    ''')
-    withdrawals = [row_to_dict(row) for row in cursor.fetchall()]
-    return jsonify({"success": True, "withdrawals": withdrawals, "count": len(withdrawals)})
+    
+    try:
+        where, params = withdrawal_filters()
+        page = keyset_page(db, '''w.*, u.name as user_name, u.email as user_email,
+                           r.score as risk_score, r.flagged as risk_flagged, r.reasons as risk_reasons''',
+                           'withdrawals w JOIN users u ON w.user_id = u.id LEFT JOIN risk_scores r ON r.user_id = w.user_id',
+                           where, params, 'w.requested_at', 'w.id')
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
+    for item in page['items']:
+        item['risk_reasons'] = json.loads(item['risk_reasons']) if item['risk_reasons'] else []
+    return jsonify({"success": True, "withdrawals": page.pop('items'), **page})
 
 @app.route('/api/admin/withdrawals/stats', methods=['GET'])
 def admin_withdrawal_stats():
+    try:
+        start, end = parse_report_range(7)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
     db = get_db()
     
     # Status counts
-    cursor = db.execute('''
-        SELECT 
-            COUNT(*) as total,
-            SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END) as pending,
-            SUM(CASE WHEN status = 'approved' THEN 1 ELSE 0 END) as approved,
-            SUM(CASE WHEN status = 'rejected' THEN 1 ELSE 0 END) as rejected,
-            SUM(amount) as total_amount,
-            SUM(CASE WHEN status = 'approved' THEN amount ELSE 0 END) as approved_amount,
-            SUM(CASE WHEN status = 'pending' THEN amount ELSE 0 END) as pending_amount
-        FROM withdrawals
-    ''')
-    stats = row_to_dict(cursor.fetchone())
-    
-    # Daily stats (last 7 days)
-    daily_stats = []
-    for i in range(7):
-        date = (datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d')
-        cursor = db.execute('''
-            SELECT 
-                COUNT(*) as count,
-                SUM(amount) as amount,
-                SUM(CASE WHEN status = 'approved' THEN amount ELSE 0 END) as approved_amount
-            FROM withdrawals 
-            WHERE DATE(requested_at) = ?
-        ''', (date,))
-        day_stats = row_to_dict(cursor.fetchone())
-        day_stats['date'] = date
-        daily_stats.append(day_stats)
+    totals = sum_daily_stats(db)
+    stats = {
+        "total": totals['withdrawal_count'],
+        "pending": totals['withdrawal_count'] - totals['approved_count'] - totals['rejected_count'],
+        "approved": totals['approved_count'],
+        "rejected": totals['rejected_count'],
+        "total_amount": totals['withdrawal_amount'],
+        "approved_amount": totals['approved_amount'],
+        "pending_amount": pending_amount(totals)
+    }
+    
+    # Daily stats (last 7 days unless a range is requested), newest first
+    daily_stats = [{
+        "date": day['day'],
+        "count": day['withdrawal_count'],
+        "amount": day['withdrawal_amount'],
+        "approved_amount": day['approved_amount']
+    } for day in reversed(daily_series(db, start, end))]
     
     return jsonify({
         "success": True,
@@ -1052,204 +4033,933 @@ def admin_withdrawal_stats():
         "daily_stats": daily_stats
     })
 
+# ========== WITHDRAWAL PROCESSING ==========
+BULK_WITHDRAWAL_LIMIT = int(os.environ.get('BULK_WITHDRAWAL_LIMIT', 10000))
+SQL_IN_CHUNK = 500
+WITHDRAWAL_ACTIONS = {'approve': 'approved', 'reject': 'rejected'}
+WITHDRAWAL_EVENT_COLUMNS = 'id, user_id, amount, status, method, requested_at, processed_at, rejection_reason'
+
+def chunked(values, size=SQL_IN_CHUNK):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def bulk_withdrawal_filter(spec):
+    """WHERE clauses selecting pending withdrawals for a bulk filter; raises ValueError.
+
+    Accepts min_amount / max_amount (inclusive), user_id, from / to
+    (inclusive business days on requested_at), and flagged (true for only,
+    false for no risk-flagged accounts).
+    """
+    if not isinstance(spec, dict):
+        raise ValueError("filter must be an object")
+    unknown = set(spec) - {'min_amount', 'max_amount', 'user_id', 'from', 'to', 'flagged'}
+    if unknown:
+        raise ValueError(f"Unknown filter fields: {', '.join(sorted(unknown))}")
+    where, params = ["status = 'pending'"], []
+    try:
+        if spec.get('min_amount') is not None:
+            where.append('amount >= ?')
+            params.append(float(spec['min_amount']))
+        if spec.get('max_amount') is not None:
+            where.append('amount <= ?')
+            params.append(float(spec['max_amount']))
+        if spec.get('user_id') is not None:
+            where.append('user_id = ?')
+            params.append(int(spec['user_id']))
+    except (TypeError, ValueError):
+        raise ValueError("min_amount, max_amount and user_id must be numbers")
+    if spec.get('flagged') is not None:
+        if not isinstance(spec['flagged'], bool):
+            raise ValueError("flagged must be true or false")
+        negate = '' if spec['flagged'] else 'NOT '
+        where.append(f'user_id {negate}IN (SELECT user_id FROM risk_scores WHERE flagged = 1)')
+    try:
+        if spec.get('from'):
+            where.append('requested_at >= ?')
+            params.append(day_window(spec['from'])[0])
+        if spec.get('to'):
+            where.append('requested_at < ?')
+            params.append(day_window(spec['to'])[1])
+    except ValueError:
+        raise ValueError("Dates must be in YYYY-MM-DD format")
+    return where, params
+
+def process_withdrawals(db, status, note, ids=None, where=(), params=(), limit=BULK_WITHDRAWAL_LIMIT):
+    """Move pending withdrawals to 'approved' or 'rejected' in one write transaction.
+
+    Targets are the given ids (in order, duplicates dropped) or the pending
+    withdrawals matching `where`, oldest first, up to `limit`. Status
+    changes, ledger updates and (for rejections) refunds are applied with
+    executemany; refunds update balances relatively. Retrying is safe: a
+    withdrawal already in the target status is reported 'unchanged' and
+    touched no further. Returns one result per target:
+    {"id", "result": <status>|'unchanged'|'conflict'|'not_found', "status"}.
+    """
+    now = datetime.now().isoformat()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        if ids is not None:
+            targets = list(dict.fromkeys(ids))
+            rows = {}
+            for chunk in chunked(targets):
+                cursor = db.execute(f'SELECT {WITHDRAWAL_EVENT_COLUMNS} FROM withdrawals WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+                rows.update((row['id'], row_to_dict(row)) for row in cursor)
+        else:
+            cursor = db.execute(f'''
+                SELECT {WITHDRAWAL_EVENT_COLUMNS} FROM withdrawals
+                WHERE {' AND '.join(where)}
+                ORDER BY requested_at, id LIMIT ?
+            ''', (*params, limit))
+            rows = {row['id']: row_to_dict(row) for row in cursor}
+            targets = list(rows)
+
+        results, pending = [], []
+        for withdrawal_id in targets:
+            row = rows.get(withdrawal_id)
+            if row is None:
+                results.append({"id": withdrawal_id, "result": "not_found", "status": None})
+            elif row['status'] == 'pending':
+                row.update(status=status, processed_at=now, rejection_reason=note)
+                pending.append(row)
+                results.append({"id": withdrawal_id, "result": status, "status": status})
+            elif row['status'] == status:
+                results.append({"id": withdrawal_id, "result": "unchanged", "status": status})
+            else:
+                results.append({"id": withdrawal_id, "result": "conflict", "status": row['status']})
+
+        db.executemany('''
+            UPDATE withdrawals SET status = ?, processed_at = ?, rejection_reason = ?
+            WHERE id = ? AND status = 'pending'
+        ''', [(status, now, note, row['id']) for row in pending])
+
+        refunds = {}
+        if status == 'approved':
+            db.executemany('UPDATE transactions SET description = ? WHERE withdrawal_id = ?',
+                           [(f"Withdrawal approved - {note}", row['id']) for row in pending])
+        else:
+            # The request row keeps its amount; the refund row below reverses it
+            db.executemany('UPDATE transactions SET description = ? WHERE withdrawal_id = ?',
+                           [(f"Withdrawal rejected - {note}", row['id']) for row in pending])
+            user_ids = sorted({row['user_id'] for row in pending})
+            balances = {}
+            for chunk in chunked(user_ids):
+                cursor = db.execute(f'SELECT id, balance FROM users WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+                balances.update(cursor.fetchall())
+            history = []
+            for row in pending:
+                balances[row['user_id']] += row['amount']
+                refunds[row['user_id']] = refunds.get(row['user_id'], 0) + row['amount']
+                history.append((row['user_id'], row['amount'], 'withdrawal_refund',
+                                f"Withdrawal #{row['id']} refunded: {note}", balances[row['user_id']], row['id']))
+            db.executemany('UPDATE users SET balance = balance + ? WHERE id = ?',
+                           [(amount, user_id) for user_id, amount in refunds.items()])
+            db.executemany('''
+                INSERT INTO transactions 
+                (user_id, amount, type, description, balance_after, withdrawal_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', history)
+            post_ledger(db, [(row['user_id'], row['amount'], 'withdrawal', f"withdrawal:{row['id']}") for row in pending])
+
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    for row in pending:
+        publish_withdrawal_event(row)
+    for user_id, amount in refunds.items():
+        publish_user_event(user_id, 'balance', {
+            "balance": balances[user_id], "delta": amount, "reason": "withdrawal_refund"
+        })
+    return results
+
 @app.route('/api/admin/withdrawals/<int:withdrawal_id>/approve', methods=['POST'])
 def approve_withdrawal(withdrawal_id):
     data = request.get_json()
     admin_notes = data.get('notes', 'Approved by admin')
-    
+    return process_single_withdrawal(withdrawal_id, 'approved', admin_notes,
+                                     f"Withdrawal #{withdrawal_id} approved successfully")
+
+@app.route('/api/admin/withdrawals/<int:withdrawal_id>/reject', methods=['POST'])
+def reject_withdrawal(withdrawal_id):
+    data = request.get_json()
+    reason = data.get('reason', 'No reason provided')
+    return process_single_withdrawal(withdrawal_id, 'rejected', reason,
+                                     f"Withdrawal #{withdrawal_id} rejected")
+
+def process_single_withdrawal(withdrawal_id, status, note, message):
     db = get_db()
     
-    cursor = db.execute('SELECT * FROM withdrawals WHERE id = ?', (withdrawal_id,))
-    withdrawal = row_to_dict(cursor.fetchone())
+    result = process_withdrawals(db, status, note, ids=[withdrawal_id])[0]
     
-    if not withdrawal:
+    if result['result'] == 'not_found':
         return jsonify({"success": False, "error": "Withdrawal not found"}), 404
     
-    if withdrawal['status'] != 'pending':
+    if result['result'] != status:
         return jsonify({"success": False, "error": "Withdrawal already processed"}), 400
     
-    # Update status
-    db.execute('''
-        UPDATE withdrawals SET 
-        status = 'approved', 
-        processed_at = ?,
-        rejection_reason = ?
-        WHERE id = ?
-    ''', (datetime.now().isoformat(), admin_notes, withdrawal_id))
-    
-    # Update transaction description
-    db.execute('''
-        UPDATE transactions SET 
-        description = ?
-        WHERE withdrawal_id = ?
-    ''', (f"Withdrawal approved - {admin_notes}", withdrawal_id))
-    
-    db.commit()
-    
     cursor = db.execute('SELECT * FROM withdrawals WHERE id = ?', (withdrawal_id,))
     updated_withdrawal = row_to_dict(cursor.fetchone())
     
     return jsonify({
         "success": True,
-        "message": f"Withdrawal #{withdrawal_id} approved successfully",
+        "message": message,
         "withdrawal": updated_withdrawal
     })
 
-@app.route('/api/admin/withdrawals/<int:withdrawal_id>/reject', methods=['POST'])
-def reject_withdrawal(withdrawal_id):
-    data = request.get_json()
-    reason = data.get('reason', 'No reason provided')
-    
-    db = get_db()
-    
-    cursor = db.execute('SELECT * FROM withdrawals WHERE id = ?', (withdrawal_id,))
-    withdrawal = row_to_dict(cursor.fetchone())
-    
-    if not withdrawal:
-        return jsonify({"success": False, "error": "Withdrawal not found"}), 404
-    
-    if withdrawal['status'] != 'pending':
-        return jsonify({"success": False, "error": "Withdrawal already processed"}), 400
-    
-    # Return money to user
-    cursor = db.execute('SELECT balance FROM users WHERE id = ?', (withdrawal['user_id'],))
-    user_balance = cursor.fetchone()[0]
-    new_balance = user_balance + withdrawal['amount']
-    
-    db.execute('UPDATE users SET balance = ? WHERE id = ?', 
-              (new_balance, withdrawal['user_id']))
+@app.route('/api/admin/withdrawals/bulk/<action>', methods=['POST'])
+def bulk_process_withdrawals(action):
+    """Approve or reject many withdrawals in one transaction.
+
+    Body: {"ids": [...]} or {"filter": {"max_amount": 500, ...}, "limit": N},
+    plus "notes" (approve) or "reason" (reject).
+    """
+    if action not in WITHDRAWAL_ACTIONS:
+        return jsonify({"success": False, "error": "action must be 'approve' or 'reject'"}), 404
+    status = WITHDRAWAL_ACTIONS[action]
     
-    # Update withdrawal status
-    db.execute('''
-        UPDATE withdrawals SET 
-        status = 'rejected', 
-        rejection_reason = ?,
-        processed_at = ?
-        WHERE id = ?
-    ''', (reason, datetime.now().isoformat(), withdrawal_id))
-    
-    # Update transaction
-    db.execute('''
-        UPDATE transactions SET 
-        description = ?,
-        amount = -amount
-        WHERE withdrawal_id = ?
-    ''', (f"Withdrawal rejected - {reason}", withdrawal_id))
+    data = request.get_json() or {}
+    note = data.get('notes', 'Approved by admin') if status == 'approved' else data.get('reason', 'No reason provided')
+    ids = data.get('ids')
     
-    # Add refund transaction
-    db.execute('''
-        INSERT INTO transactions 
-        (user_id, amount, type, description, balance_after, withdrawal_id)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (withdrawal['user_id'], withdrawal['amount'], 'withdrawal_refund',
-          f"Withdrawal #{withdrawal_id} refunded: {reason}", new_balance, withdrawal_id))
+    try:
+        if (ids is None) == ('filter' not in data):
+            raise ValueError("Provide either 'ids' or 'filter'")
+        limit = int(data.get('limit', BULK_WITHDRAWAL_LIMIT))
+        if not 1 <= limit <= BULK_WITHDRAWAL_LIMIT:
+            raise ValueError(f"limit must be between 1 and {BULK_WITHDRAWAL_LIMIT}")
+        if ids is not None:
+            if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+                raise ValueError("ids must be a list of integers")
+            if len(ids) > BULK_WITHDRAWAL_LIMIT:
+                raise ValueError(f"Too many ids (Max: {BULK_WITHDRAWAL_LIMIT})")
+            where, params = (), ()
+        else:
+            where, params = bulk_withdrawal_filter(data['filter'])
+            ids = None
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
+    results = process_withdrawals(get_db(), status, note, ids=ids, where=where, params=params, limit=limit)
+    
+    summary = {result: 0 for result in (status, 'unchanged', 'conflict', 'not_found')}
+    for result in results:
+        summary[result['result']] += 1
     
-    db.commit()
+    return jsonify({
+        "success": True,
+        "message": f"{summary[status]} withdrawals {status}",
+        "summary": summary,
+        "results": results
+    })
+
+# ========== PAYOUTS ==========
+# Approved withdrawals are paid out in settlement batches. Creating a batch
+# claims every approved, unbatched withdrawal (payout_status NULL -> 'sent')
+# with one UPDATE; the bank file is streamed straight off the batch's index
+# range; the processor's result file is applied in chunks, marking items
+# 'paid' (with the bank reference) or 'failed'. Failed items keep their
+# money deducted and can be sent again in a later batch with retry_failed.
+PAYOUT_BATCH_LIMIT = int(os.environ.get('PAYOUT_BATCH_LIMIT', 5000))
+PAYOUT_FILE_QUERY = '''
+    SELECT transaction_id AS reference, user_name AS beneficiary_name, upi_id AS vpa,
+           printf('%.2f', amount) AS amount, 'INR' AS currency, UPPER(method) AS mode,
+           'KaamKaro withdrawal #' || id AS narration, payout_batch_id AS batch_id
+    FROM withdrawals WHERE payout_batch_id = ? ORDER BY id
+'''
+SETTLEMENT_STATUSES = {'paid': 'paid', 'success': 'paid', 'failed': 'failed', 'failure': 'failed'}
+
+def create_payout_batch(db, limit=PAYOUT_BATCH_LIMIT, retry_failed=False):
+    """Claim up to `limit` approved withdrawals awaiting payout into a new batch.
+
+    With retry_failed, previously failed payouts are batched instead of new
+    ones. Returns the batch row, or None if nothing was waiting.
+    """
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        cursor = db.execute('INSERT INTO payout_batches DEFAULT VALUES')
+        batch_id = cursor.lastrowid
+        queue = "payout_status = 'failed'" if retry_failed else 'payout_status IS NULL'
+        db.execute(f'''
+            UPDATE withdrawals SET payout_batch_id = ?, payout_status = 'sent', payout_note = NULL
+            WHERE id IN (
+                SELECT id FROM withdrawals WHERE status = 'approved' AND {queue} ORDER BY id LIMIT ?
+            )
+        ''', (batch_id, limit))
+        cursor = db.execute('''
+            UPDATE payout_batches SET
+            item_count = (SELECT COUNT(*) FROM withdrawals WHERE payout_batch_id = ?),
+            total_amount = (SELECT COALESCE(SUM(amount), 0) FROM withdrawals WHERE payout_batch_id = ?)
+            WHERE id = ?
+            RETURNING *
+        ''', (batch_id, batch_id, batch_id))
+        batch = row_to_dict(cursor.fetchone())
+        if not batch['item_count']:
+            db.rollback()
+            return None
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return batch
+
+def iter_payout_file(db, batch_id, export_format):
+    """Yield the bank file for one batch in `export_format` ('csv' or 'ndjson')."""
+    encode, _ = EXPORT_FORMATS[export_format]
+    return encode(iter_export_rows(db, PAYOUT_FILE_QUERY, (batch_id,)))
+
+def read_records(lines, export_format):
+    """Lazily parse a CSV or NDJSON file, given as an iterable of lines, into dicts."""
+    text = (line.decode('utf-8-sig') if isinstance(line, bytes) else line for line in lines)
+    if export_format == 'csv':
+        yield from csv.DictReader(text)
+    else:
+        for line in text:
+            if line.strip():
+                yield json.loads(line)
+
+def apply_settlement(db, records):
+    """Apply processor result records in chunks inside one write transaction.
+
+    Each record needs 'reference' (the withdrawal's transaction_id) and
+    'status' (paid/success or failed/failure); 'utr', 'reason' and 'batch_id'
+    are optional. With batch_id, a line from an older batch's file cannot
+    settle a payout that has since been re-sent in a newer batch.
+
+    Only items in a sent batch change: 'sent' -> 'paid'/'failed'. Re-importing
+    the same file reports them 'unchanged', so imports are safe to retry.
+    Returns counts per outcome and up to 100 examples of rejected lines.
+    """
+    summary = {"paid": 0, "failed": 0, "unchanged": 0, "conflict": 0, "not_found": 0, "invalid": 0}
+    errors = []
+    events = []
+    now = datetime.now().isoformat()
+
+    def reject(outcome, line_no, reference, message):
+        summary[outcome] += 1
+        if len(errors) < 100:
+            errors.append({"line": line_no, "reference": reference, "error": message})
+
+    def flush(chunk):
+        references = list({record['reference'] for _, record in chunk})
+        cursor = db.execute(f'''
+            SELECT id, user_id, amount, transaction_id, payout_batch_id, payout_status FROM withdrawals
+            WHERE transaction_id IN ({','.join('?' * len(references))})
+        ''', references)
+        by_reference = {row['transaction_id']: row_to_dict(row) for row in cursor}
+
+        updates, batches = [], {}
+        for line_no, record in chunk:
+            item = by_reference.get(record['reference'])
+            if item is None:
+                reject('not_found', line_no, record['reference'], "Unknown reference")
+            elif record['batch_id'] not in (None, item['payout_batch_id']):
+                reject('conflict', line_no, record['reference'], f"Payout is in batch {item['payout_batch_id']}")
+            elif item['payout_status'] == record['status']:
+                summary['unchanged'] += 1
+            elif item['payout_status'] != 'sent':
+                reject('conflict', line_no, record['reference'], f"Payout is {item['payout_status'] or 'not batched'}")
+            else:
+                item['payout_status'] = record['status']
+                summary[record['status']] += 1
+                updates.append((record['status'], record['utr'], record['reason'], now, item['id']))
+                counts = batches.setdefault(item['payout_batch_id'], [0, 0, 0, 0])
+                offset = 0 if record['status'] == 'paid' else 2
+                counts[offset] += 1
+                counts[offset + 1] += item['amount']
+                if event_bus.listening(f"user:{item['user_id']}"):
+                    events.append((item, record))
+
+        db.executemany('''
+            UPDATE withdrawals SET payout_status = ?, payout_reference = ?, payout_note = ?, settled_at = ?
+            WHERE id = ? AND payout_status = 'sent'
+        ''', updates)
+        db.executemany('''
+            UPDATE payout_batches SET
+            paid_count = paid_count + ?, paid_amount = paid_amount + ?,
+            failed_count = failed_count + ?, failed_amount = failed_amount + ?
+            WHERE id = ?
+        ''', [(*counts, batch_id) for batch_id, counts in batches.items()])
+        db.executemany('''
+            UPDATE payout_batches SET status = 'settled', settled_at = ?
+            WHERE id = ? AND paid_count + failed_count >= item_count
+        ''', [(now, batch_id) for batch_id in batches])
+
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        chunk = []
+        for line_no, record in enumerate(records, start=1):
+            if not isinstance(record, dict):
+                reject('invalid', line_no, None, "Each line must be a JSON object")
+                continue
+            reference = str(record.get('reference') or '').strip()
+            status = SETTLEMENT_STATUSES.get(str(record.get('status') or '').strip().lower())
+            try:
+                batch_id = int(record['batch_id']) if record.get('batch_id') not in (None, '') else None
+            except (TypeError, ValueError):
+                batch_id = status = None
+            if not reference or status is None:
+                reject('invalid', line_no, reference or None,
+                       "Needs a reference, a status of paid or failed and a numeric batch_id if any")
+                continue
+            chunk.append((line_no, {"reference": reference, "status": status, "batch_id": batch_id,
+                                    "utr": (record.get('utr') or None), "reason": (record.get('reason') or None)}))
+            if len(chunk) >= SQL_IN_CHUNK:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    for item, record in events:
+        publish_user_event(item['user_id'], 'payout', {
+            "withdrawal_id": item['id'], "payout_status": record['status'], "utr": record['utr']
+        })
+    return {"summary": summary, "errors": errors}
+
+@app.route('/api/admin/payouts/batches', methods=['POST'])
+def admin_create_payout_batch():
+    data = request.get_json(silent=True) or {}
+    try:
+        limit = int(data.get('limit', PAYOUT_BATCH_LIMIT))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "limit must be an integer"}), 400
+    if not 1 <= limit <= PAYOUT_BATCH_LIMIT:
+        return jsonify({"success": False, "error": f"limit must be between 1 and {PAYOUT_BATCH_LIMIT}"}), 400
     
-    cursor = db.execute('SELECT * FROM withdrawals WHERE id = ?', (withdrawal_id,))
-    updated_withdrawal = row_to_dict(cursor.fetchone())
+    batch = create_payout_batch(get_db(), limit, bool(data.get('retry_failed')))
+    if batch is None:
+        return jsonify({"success": True, "message": "No approved withdrawals awaiting payout", "batch": None})
     
     return jsonify({
         "success": True,
-        "message": f"Withdrawal #{withdrawal_id} rejected",
-        "withdrawal": updated_withdrawal
+        "message": f"Payout batch #{batch['id']} created with {batch['item_count']} withdrawals",
+        "batch": batch
     })
 
-@app.route('/api/admin/transactions', methods=['GET'])
-def admin_get_transactions():
+@app.route('/api/admin/payouts/batches', methods=['GET'])
+def admin_get_payout_batches():
     db = get_db()
     
-    # Get query parameters
-    limit = request.args.get('limit', 50, type=int)
-    offset = request.args.get('offset', 0, type=int)
-    user_id = request.args.get('user_id', type=int)
+    try:
+        where, params = date_range_filter('created_at')
+        if request.args.get('status'):
+            where.append('status = ?')
+            params.append(request.args['status'])
+        page = keyset_page(db, '*', 'payout_batches', where, params, 'created_at', 'id')
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
+    return jsonify({"success": True, "batches": page.pop('items'), **page})
+
+@app.route('/api/admin/payouts/batches/<int:batch_id>/file', methods=['GET'])
+def admin_payout_batch_file(batch_id):
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"success": False, "error": "format must be 'csv' or 'ndjson'"}), 400
     
-    query = '''
-        SELECT t.*, u.name as user_name, u.email as user_email 
-        FROM transactions t
-        JOIN users u ON t.user_id = u.id
-    '''
-    params = []
+    db = get_db()
+    if not db.execute('SELECT 1 FROM payout_batches WHERE id = ?', (batch_id,)).fetchone():
+        return jsonify({"success": False, "error": "Payout batch not found"}), 404
     
-    if user_id:
-        query += ' WHERE t.user_id = ?'
-        params.append(user_id)
+    _, mimetype = EXPORT_FORMATS[export_format]
+    filename = f"payout-batch-{batch_id}.{export_format}"
+    return Response(stream_with_context(iter_payout_file(db, batch_id, export_format)), mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.route('/api/admin/payouts/settlements', methods=['POST'])
+def admin_import_settlement():
+    """Apply a processor result file sent as the raw request body (CSV or NDJSON)."""
+    export_format = request.args.get('format') or ('ndjson' if 'json' in (request.mimetype or '') else 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"success": False, "error": "format must be 'csv' or 'ndjson'"}), 400
     
-    query += ' ORDER BY t.timestamp DESC LIMIT ? OFFSET ?'
-    params.extend([limit, offset])
+    try:
+        result = apply_settlement(get_db(), read_records(request.stream, export_format))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        return jsonify({"success": False, "error": f"Could not read settlement file: {e}"}), 400
     
-    cursor = db.execute(query, params)
-    transactions = [row_to_dict(row) for row in cursor.fetchall()]
+    return jsonify({"success": True, **result})
+
+@app.cli.command('payouts-create')
+@click.option('--limit', default=PAYOUT_BATCH_LIMIT, show_default=True)
+@click.option('--retry-failed', is_flag=True, help='Batch failed payouts instead of new ones.')
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)), default='csv', show_default=True)
+@click.option('--out', type=click.Path(dir_okay=False), help='Defaults to payout-batch-<id>.<format>.')
+def payouts_create_command(limit, retry_failed, export_format, out):
+    """Batch approved withdrawals and write the bank file."""
+    db = get_db()
+    batch = create_payout_batch(db, limit, retry_failed)
+    if batch is None:
+        print("✅ No approved withdrawals awaiting payout")
+        return
+    out = out or f"payout-batch-{batch['id']}.{export_format}"
+    with open(out, 'w', newline='', encoding='utf-8') as f:
+        for chunk in iter_payout_file(db, batch['id'], export_format):
+            f.write(chunk)
+    print(f"✅ Batch #{batch['id']}: {batch['item_count']} payouts, ₹{batch['total_amount']:.2f} -> {out}")
+
+@app.cli.command('payouts-import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def payouts_import_command(path):
+    """Apply a settlement result file (CSV, or NDJSON for *.ndjson / *.json)."""
+    export_format = 'ndjson' if path.endswith(('.ndjson', '.json')) else 'csv'
+    with open(path, 'rb') as f:
+        result = apply_settlement(get_db(), read_records(f, export_format))
+    for error in result['errors']:
+        print(f"❌ {error}")
+    print(f"✅ Settlement applied: {result['summary']}")
+
+@app.cli.command('payouts-simulate')
+@click.argument('batch_file', type=click.Path(exists=True, dir_okay=False))
+@click.argument('result_file', type=click.Path(dir_okay=False))
+@click.option('--fail-rate', default=0.02, show_default=True, help='Fraction of payouts to fail.')
+def payouts_simulate_command(batch_file, result_file, fail_rate):
+    """Stand-in payment processor: turn a bank file into a settlement result file."""
+    export_format = 'ndjson' if batch_file.endswith(('.ndjson', '.json')) else 'csv'
+    counts = {"paid": 0, "failed": 0}
+    with open(batch_file, 'rb') as source, open(result_file, 'w', newline='', encoding='utf-8') as target:
+        writer = csv.writer(target)
+        writer.writerow(['reference', 'status', 'utr', 'reason', 'batch_id'])
+        for record in read_records(source, export_format):
+            # Deterministic per reference, so re-running gives the same file
+            digest = hashlib.sha256(record['reference'].encode()).digest()
+            if int.from_bytes(digest[:4], 'big') / 2 ** 32 < fail_rate:
+                writer.writerow([record['reference'], 'failed', '', 'Beneficiary VPA not reachable', record['batch_id']])
+                counts["failed"] += 1
+            else:
+                writer.writerow([record['reference'], 'paid', f"UTR{digest[4:10].hex().upper()}", '', record['batch_id']])
+                counts["paid"] += 1
+    print(f"✅ Simulated settlement {counts} -> {result_file}")
+
+# ========== RISK SCORING ==========
+# A background pipeline reads new users, withdrawals, referrals and task
+# completions in id order from a per-stream cursor, one chunk per write
+# transaction, and keeps per-user features in risk_scores: peak task
+# completions within a minute, peak referrals within a day, and how many
+# other accounts share the user's phone or UPI ID (risk_identities).
+# Sliding windows are stored with the features, so a run picks up exactly
+# where the last one stopped and a backlog of any size streams through in
+# bounded memory. Scores add up RISK_SIGNALS; flagged accounts appear in the
+# admin withdrawal queue, and withdraw_request holds them at RISK_HOLD_SCORE.
+RISK_PIPELINE_INTERVAL = float(os.environ.get('RISK_PIPELINE_INTERVAL', 30))
+RISK_CHUNK = int(os.environ.get('RISK_CHUNK', 5000))
+RISK_FLAG_SCORE = 50
+RISK_HOLD_SCORE = 80
+RISK_COMPLETION_WINDOW = 60
+RISK_REFERRAL_WINDOW = 86400
+RISK_WINDOW_CAP = 1000
+
+# (feature, threshold, points, reason)
+RISK_SIGNALS = [
+    ('peak_completions_per_minute', 10, 50, '{} task completions within a minute'),
+    ('peak_referrals_per_day', 10, 50, '{} referrals within a day'),
+    ('shared_upi_accounts', 1, 50, 'UPI ID shared with {} other accounts'),
+    ('shared_phone_accounts', 2, 30, 'Phone number shared with {} other accounts'),
+]
+RISK_FEATURES = {
+    'completions': 0, 'peak_completions_per_minute': 0, 'completion_window': '',
+    'referrals': 0, 'peak_referrals_per_day': 0, 'referral_window': '',
+    'shared_phone_accounts': 0, 'shared_upi_accounts': 0,
+}
+
+# (stream, table, query); each query takes (after_id, up_to_id, limit).
+# '+type' keeps SQLite on the rowid range instead of the type index.
+RISK_STREAMS = [
+    ('users', 'users',
+     "SELECT id, id, phone FROM users WHERE id > ? AND id <= ? AND phone != '' ORDER BY id LIMIT ?"),
+    ('withdrawals', 'withdrawals',
+     'SELECT id, user_id, upi_id FROM withdrawals WHERE id > ? AND id <= ? ORDER BY id LIMIT ?'),
+    ('referrals', 'referrals',
+     "SELECT id, referrer_id, CAST(strftime('%s', created_at) AS INTEGER) FROM referrals "
+     "WHERE id > ? AND id <= ? ORDER BY id LIMIT ?"),
+    ('transactions', 'transactions',
+     "SELECT id, user_id, CAST(strftime('%s', timestamp) AS INTEGER) FROM transactions "
+     "WHERE id > ? AND id <= ? AND +type = 'task_completion' ORDER BY id LIMIT ?"),
+]
+
+RISK_SAVE = f'''
+    INSERT INTO risk_scores (user_id, score, flagged, reasons, {', '.join(RISK_FEATURES)}, updated_at)
+    VALUES (?, ?, ?, ?, {', '.join('?' * len(RISK_FEATURES))}, CURRENT_TIMESTAMP)
+    ON CONFLICT (user_id) DO UPDATE SET
+    score = excluded.score, flagged = excluded.flagged, reasons = excluded.reasons,
+    {', '.join(f'{name} = excluded.{name}' for name in RISK_FEATURES)},
+    updated_at = excluded.updated_at
+'''
+
+def score_risk(features):
+    """(score, reasons) for a features dict, capped at 100."""
+    score, reasons = 0, []
+    for feature, threshold, points, reason in RISK_SIGNALS:
+        if features[feature] >= threshold:
+            score += points
+            reasons.append(reason.format(features[feature]))
+    return min(score, 100), reasons
+
+def normalize_phone(phone):
+    digits = ''.join(ch for ch in phone or '' if ch.isdigit())
+    return digits[-10:] if len(digits) >= 10 else None
+
+def normalize_upi(upi_id):
+    upi_id = (upi_id or '').strip().lower()
+    return upi_id if '@' in upi_id else None
+
+# Windows are stored as comma-separated epoch seconds, decoded only by the
+# stream that updates them
+def encode_window(window):
+    return ','.join(map(str, window))
+
+def decode_window(text):
+    return [int(value) for value in text.split(',')] if text else []
+
+def slide(window, timestamp, span):
+    """Insert timestamp into a sorted window; returns how many fall in the span ending at it.
+
+    Rows arrive in id order, which is only roughly time order, so late
+    timestamps are inserted in place rather than appended.
+    """
+    bisect.insort(window, timestamp)
+    del window[:bisect.bisect_right(window, window[-1] - span)]
+    del window[:-RISK_WINDOW_CAP]
+    return bisect.bisect_right(window, timestamp) - bisect.bisect_right(window, timestamp - span)
+
+class RiskPipeline:
+    def __init__(self, interval, chunk):
+        self.interval = interval
+        self.chunk = chunk
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        self._stats = {"runs": 0, "rows": 0, "flagged": 0, "errors": 0, "last_error": None,
+                       "last_run_seconds": None}
+
+    # ---- feature state ----
+    def _load(self, db, user_ids):
+        features = {}
+        for chunk in chunked(sorted(user_ids)):
+            cursor = db.execute(f'''
+                SELECT user_id, flagged, cleared_score, {', '.join(RISK_FEATURES)}
+                FROM risk_scores WHERE user_id IN ({",".join("?" * len(chunk))})
+            ''', chunk)
+            features.update((row['user_id'], row_to_dict(row)) for row in cursor)
+        for user_id in user_ids:
+            features.setdefault(user_id, dict(RISK_FEATURES, user_id=user_id, flagged=0, cleared_score=0))
+        return features
+
+    def _save(self, db, features):
+        """Score and write features; returns [(user_id, score, reasons)] for newly flagged users."""
+        rows, flagged = [], []
+        for user_id, state in features.items():
+            score, reasons = score_risk(state)
+            is_flagged = score >= RISK_FLAG_SCORE and score > state['cleared_score']
+            if is_flagged and not state['flagged']:
+                flagged.append((user_id, score, reasons))
+            for window in ('completion_window', 'referral_window'):
+                if isinstance(state[window], list):
+                    state[window] = encode_window(state[window])
+            rows.append((user_id, score, int(is_flagged), json.dumps(reasons) if reasons else '[]',
+                         *(state[name] for name in RISK_FEATURES)))
+        db.executemany(RISK_SAVE, rows)
+        return flagged
+
+    # ---- stream consumers: rows are (id, user_id, value) ----
+    def _consume_transactions(self, db, rows):
+        features = self._load(db, {user_id for _, user_id, _ in rows})
+        for state in features.values():
+            state['completion_window'] = decode_window(state['completion_window'])
+        for _, user_id, timestamp in rows:
+            if timestamp is None:
+                continue
+            state = features[user_id]
+            state['completions'] += 1
+            count = slide(state['completion_window'], timestamp, RISK_COMPLETION_WINDOW)
+            if count > state['peak_completions_per_minute']:
+                state['peak_completions_per_minute'] = count
+        return self._save(db, features)
+
+    def _consume_referrals(self, db, rows):
+        features = self._load(db, {user_id for _, user_id, _ in rows if user_id is not None})
+        for state in features.values():
+            state['referral_window'] = decode_window(state['referral_window'])
+        for _, user_id, timestamp in rows:
+            if user_id is None or timestamp is None:
+                continue
+            state = features[user_id]
+            state['referrals'] += 1
+            count = slide(state['referral_window'], timestamp, RISK_REFERRAL_WINDOW)
+            if count > state['peak_referrals_per_day']:
+                state['peak_referrals_per_day'] = count
+        return self._save(db, features)
+
+    def _consume_users(self, db, rows):
+        return self._share(db, 'phone', {(normalize_phone(phone), user_id) for _, user_id, phone in rows})
+
+    def _consume_withdrawals(self, db, rows):
+        return self._share(db, 'upi', {(normalize_upi(upi_id), user_id) for _, user_id, upi_id in rows})
+
+    def _share(self, db, kind, pairs):
+        pairs = [(value, user_id) for value, user_id in pairs if value]
+        db.executemany('INSERT OR IGNORE INTO risk_identities (kind, value, user_id) VALUES (?, ?, ?)',
+                       [(kind, value, user_id) for value, user_id in pairs])
+        # Every account holding one of these values needs its count refreshed
+        affected = set()
+        for chunk in chunked(sorted({value for value, _ in pairs})):
+            cursor = db.execute(f'SELECT user_id FROM risk_identities WHERE kind = ? AND value IN ({",".join("?" * len(chunk))})',
+                                (kind, *chunk))
+            affected.update(row[0] for row in cursor)
+        shared = {}
+        for chunk in chunked(sorted(affected)):
+            cursor = db.execute(f'''
+                SELECT i.user_id, MAX((SELECT COUNT(*) FROM risk_identities o WHERE o.kind = i.kind AND o.value = i.value)) - 1
+                FROM risk_identities i WHERE i.kind = ? AND i.user_id IN ({",".join("?" * len(chunk))})
+                GROUP BY i.user_id
+            ''', (kind, *chunk))
+            shared.update((row[0], row[1]) for row in cursor)
+        features = self._load(db, affected)
+        for user_id, state in features.items():
+            state[f'shared_{kind}_accounts'] = shared.get(user_id, 0)
+        return self._save(db, features)
+
+    # ---- driver ----
+    def run(self, db):
+        """Consume every stream up to its current end; returns per-stream counts."""
+        started = time.perf_counter()
+        summary, flagged = {}, []
+        for stream, table, query in RISK_STREAMS:
+            consume = getattr(self, f'_consume_{stream}')
+            high = db.execute(f'SELECT COALESCE(MAX(id), 0) FROM {table}').fetchone()[0]
+            summary[stream] = 0
+            while True:
+                # Re-read the cursor under the write lock so concurrent
+                # workers never consume the same chunk twice
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    row = db.execute('SELECT last_id FROM risk_cursors WHERE stream = ?', (stream,)).fetchone()
+                    last = row[0] if row else 0
+                    if last >= high:
+                        db.rollback()
+                        break
+                    rows = db.execute(query, (last, high, self.chunk)).fetchall()
+                    if rows:
+                        flagged += consume(db, rows)
+                    done = len(rows) < self.chunk
+                    db.execute('''
+                        INSERT INTO risk_cursors (stream, last_id) VALUES (?, ?)
+                        ON CONFLICT (stream) DO UPDATE SET last_id = excluded.last_id
+                    ''', (stream, high if done else rows[-1][0]))
+                    db.commit()
+                except Exception:
+                    db.rollback()
+                    raise
+                summary[stream] += len(rows)
+                if done:
+                    break
+
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["rows"] += sum(summary.values())
+            self._stats["flagged"] += len(flagged)
+            self._stats["last_run_seconds"] = round(elapsed, 3)
+        if event_bus.listening('admin'):
+            for user_id, score, reasons in flagged:
+                publish_admin_event('risk_flagged', {"user_id": user_id, "score": score, "reasons": reasons})
+        return {"rows": summary, "flagged": len(flagged), "seconds": round(elapsed, 3)}
+
+    def start(self):
+        """Start the background loop once per process (after any fork)."""
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._loop, name='risk-pipeline', daemon=True).start()
+
+    def _loop(self):
+        while not self._wake.wait(self.interval):
+            db = db_pool.acquire()
+            try:
+                self.run(db)
+            except Exception as e:
+                # Cursors only move on commit, so the next run retries the chunk
+                if db.in_transaction:
+                    db.rollback()
+                with self._lock:
+                    self._stats["errors"] += 1
+                    self._stats["last_error"] = str(e)
+                print(f"❌ Risk scoring failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(interval=self.interval, chunk=self.chunk, running=self._pid == os.getpid())
+        return stats
+
+risk_pipeline = RiskPipeline(RISK_PIPELINE_INTERVAL, RISK_CHUNK)
+
+@app.before_request
+def start_risk_pipeline():
+    risk_pipeline.start()
+
+def risk_row(row):
+    risk = row_to_dict(row)
+    risk['reasons'] = json.loads(risk['reasons'])
+    return risk
+
+@app.route('/api/admin/risk', methods=['GET'])
+def admin_get_risk():
+    """Scored accounts, highest score first; ?flagged=0 lists unflagged ones."""
+    db = get_db()
+    flagged = 0 if request.args.get('flagged') == '0' else 1
+    try:
+        page = keyset_page(db, '''r.user_id, r.score, r.flagged, r.reasons, r.cleared_score,
+                           r.peak_completions_per_minute, r.peak_referrals_per_day, r.shared_phone_accounts,
+                           r.shared_upi_accounts, r.updated_at, u.name, u.email''',
+                           'risk_scores r JOIN users u ON u.id = r.user_id',
+                           ['r.flagged = ?'], [flagged], 'r.score', 'r.user_id')
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
+    page['items'] = [dict(item, reasons=json.loads(item['reasons'])) for item in page['items']]
+    return jsonify({"success": True, "accounts": page.pop('items'), **page})
+
+@app.route('/api/admin/risk/<int:user_id>', methods=['GET'])
+def admin_get_user_risk(user_id):
+    row = get_db().execute('SELECT * FROM risk_scores WHERE user_id = ?', (user_id,)).fetchone()
+    if row is None:
+        return jsonify({"success": False, "error": "No risk score for this user yet"}), 404
+    return jsonify({"success": True, "risk": risk_row(row)})
+
+@app.route('/api/admin/risk/<int:user_id>/clear', methods=['POST'])
+def admin_clear_risk(user_id):
+    """Mark a flag as reviewed; the account is flagged again only if its score rises."""
+    db = get_db()
+    cursor = db.execute('UPDATE risk_scores SET flagged = 0, cleared_score = score WHERE user_id = ? RETURNING *', (user_id,))
+    row = cursor.fetchone()
+    db.commit()
+    if row is None:
+        return jsonify({"success": False, "error": "No risk score for this user yet"}), 404
+    return jsonify({"success": True, "risk": risk_row(row)})
+
+@app.cli.command('risk-score')
+@click.option('--reset', is_flag=True, help='Forget all features and rescore from the first row.')
+def risk_score_command(reset):
+    """Bring risk scores up to date with every stream."""
+    db = get_db()
+    if reset:
+        db.execute('BEGIN IMMEDIATE')
+        for table in ('risk_scores', 'risk_identities', 'risk_cursors'):
+            db.execute(f'DELETE FROM {table}')
+        db.commit()
+    result = risk_pipeline.run(db)
+    print(f"✅ Scored {sum(result['rows'].values())} rows {result['rows']} in {result['seconds']}s; "
+          f"{result['flagged']} accounts newly flagged")
+
+@app.route('/api/admin/transactions', methods=['GET'])
+def admin_get_transactions():
+    db = get_db()
     
-    # Total count
-    count_query = 'SELECT COUNT(*) FROM transactions'
-    if user_id:
-        count_query += ' WHERE user_id = ?'
-        cursor = db.execute(count_query, [user_id] if user_id else [])
-    else:
-        cursor = db.execute(count_query)
+    try:
+        where, params = transaction_filters()
+        page = keyset_page(db, 't.*, u.name as user_name, u.email as user_email',
+                           'transactions t JOIN users u ON t.user_id = u.id',
+                           where, params, 't.timestamp', 't.id')
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
+    return jsonify({"success": True, "transactions": page.pop('items'), **page})
+
+@app.route('/api/admin/referrals', methods=['GET'])
+def admin_get_referrals():
+    db = get_db()
     
-    total = cursor.fetchone()[0]
+    try:
+        where, params = date_range_filter('r.created_at')
+        if request.args.get('referrer_id'):
+            where.append('r.referrer_id = ?')
+            params.append(int_arg('referrer_id'))
+        page = keyset_page(db, '''r.*, referrer.name as referrer_name, referrer.email as referrer_email,
+                                  referred.name as referred_name, referred.email as referred_email''',
+                           '''referrals r
+                              JOIN users referrer ON r.referrer_id = referrer.id
+                              JOIN users referred ON r.referred_id = referred.id''',
+                           where, params, 'r.created_at', 'r.id')
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
+    return jsonify({"success": True, "referrals": page.pop('items'), **page})
+
+@app.route('/api/admin/export/<kind>', methods=['GET'])
+def admin_export(kind):
+    if kind not in EXPORTS:
+        return jsonify({"success": False, "error": f"Unknown export '{kind}'"}), 404
     
-    return jsonify({
-        "success": True,
-        "transactions": transactions,
-        "total": total,
-        "limit": limit,
-        "offset": offset
-    })
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"success": False, "error": "format must be 'csv' or 'ndjson'"}), 400
+    
+    columns, from_sql, filters, order_by = EXPORTS[kind]
+    try:
+        where, params = filters()
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
+    query = f'SELECT {columns} FROM {from_sql}'
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += f' ORDER BY {order_by}'
+    
+    encode, mimetype = EXPORT_FORMATS[export_format]
+    rows = iter_export_rows(get_db(), query, params)
+    filename = f"{kind}-{business_today().strftime('%Y%m%d')}.{export_format}"
+    return Response(stream_with_context(encode(rows)), mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 @app.route('/api/admin/analytics', methods=['GET'])
 def admin_analytics():
+    # Without an explicit range, user growth covers 30 days and earnings 7
+    ranged = any(arg in request.args for arg in ('days', 'from', 'to'))
+    try:
+        start, end = parse_report_range(30)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    
     db = get_db()
+    series = daily_series(db, start, end)
     
-    # User growth (last 30 days)
-    user_growth = []
-    for i in range(30):
-        date = (datetime.now() - timedelta(days=29-i)).strftime('%Y-%m-%d')
-        cursor = db.execute('SELECT COUNT(*) FROM users WHERE DATE(created_at) <= ?', (date,))
-        total_users = cursor.fetchone()[0]
-        user_growth.append({"date": date, "users": total_users})
-    
-    # Earnings by day (last 7 days)
-    daily_earnings = []
-    for i in range(7):
-        date = (datetime.now() - timedelta(days=6-i)).strftime('%Y-%m-%d')
-        cursor = db.execute('''
-            SELECT 
-                SUM(CASE WHEN type = 'task_completion' THEN amount ELSE 0 END) as task_earnings,
-                SUM(CASE WHEN type = 'signup_bonus' THEN amount ELSE 0 END) as signup_bonus,
-                SUM(CASE WHEN type = 'referral_bonus' THEN amount ELSE 0 END) as referral_bonus,
-                SUM(CASE WHEN type = 'daily_bonus' THEN amount ELSE 0 END) as daily_bonus
-            FROM transactions 
-            WHERE DATE(timestamp) = ?
-        ''', (date,))
-        earnings = row_to_dict(cursor.fetchone())
-        earnings['date'] = date
-        daily_earnings.append(earnings)
+    # User growth
+    user_growth = [{"date": day['day'], "users": day['total_users']} for day in series]
+    
+    # Earnings by day
+    daily_earnings = [{
+        "date": day['day'],
+        "task_earnings": day['task_earnings'],
+        "signup_bonus": day['signup_bonus'],
+        "referral_bonus": day['referral_bonus'],
+        "daily_bonus": day['daily_bonus']
+    } for day in (series if ranged else series[-7:])]
+    
+    totals = sum_daily_stats(db)
     
     # Task completion stats
-    task_stats = db.execute('''
-        SELECT 
-            COUNT(*) as total_completions,
-            SUM(amount) as total_earnings,
-            AVG(amount) as avg_earning
-        FROM transactions 
-        WHERE type = 'task_completion'
-    ''')
-    task_stats = row_to_dict(task_stats.fetchone())
+    task_stats = {
+        "total_completions": totals['task_completions'],
+        "total_earnings": totals['task_earnings'],
+        "avg_earning": totals['task_earnings'] / totals['task_completions'] if totals['task_completions'] else None
+    }
     
     # Withdrawal stats
-    withdrawal_stats = db.execute('''
-        SELECT 
-            COUNT(*) as total_withdrawals,
-            SUM(amount) as total_amount,
-            AVG(amount) as avg_amount,
-            SUM(CASE WHEN status = 'pending' THEN amount ELSE 0 END) as pending_amount,
-            SUM(CASE WHEN status = 'approved' THEN amount ELSE 0 END) as approved_amount
-        FROM withdrawals
-    ''')
-    withdrawal_stats = row_to_dict(withdrawal_stats.fetchone())
+    withdrawal_stats = {
+        "total_withdrawals": totals['withdrawal_count'],
+        "total_amount": totals['withdrawal_amount'],
+        "avg_amount": totals['withdrawal_amount'] / totals['withdrawal_count'] if totals['withdrawal_count'] else None,
+        "pending_amount": pending_amount(totals),
+        "approved_amount": totals['approved_amount']
+    }
     
     return jsonify({
         "success": True,
@@ -1261,6 +4971,43 @@ def admin_analytics():
         }
     })
 
+@app.route('/api/admin/db/stats', methods=['GET'])
+def admin_db_stats():
+    return jsonify({
+        "success": True,
+        "pool": db_pool.stats(),
+        "cache": response_cache.stats(),
+        "password_pool": password_pool.stats(),
+        "tokens": token_cache.stats(),
+        "completion_writer": completion_writer.stats(),
+        "task_counters": task_completion_counter.stats(),
+        "leaderboards": leaderboards.stats(),
+        "event_stream": event_bus.stats(),
+        "idempotency": idempotency.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "risk_pipeline": risk_pipeline.stats()
+    })
+
+@app.route('/api/admin/rollups/check', methods=['GET'])
+def admin_rollups_check():
+    mismatches = check_rollups(get_db())
+    return jsonify({"success": not mismatches, "mismatches": mismatches})
+
+@app.route('/api/admin/ledger/reconcile', methods=['GET'])
+def admin_ledger_reconcile():
+    report = reconcile_ledger(get_db())
+    return jsonify({"success": report.pop('ok'), **report})
+
+@app.route('/api/admin/db/query-plans', methods=['GET'])
+def admin_query_plans():
+    db = get_db()
+    report = explain_hot_queries(db)
+    return jsonify({
+        "success": all(entry["uses_index"] for entry in report.values()),
+        "schema_version": schema_version(db),
+        "queries": report
+    })
+
 # ========== ERROR HANDLERS ==========
 @app.errorhandler(404)
 def not_found(error):
@@ -1273,6 +5020,7 @@ def server_error(error):
 # ========== APPLICATION START ==========
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
+    init_db()
     print("\n" + "="*70)
     print("🚀 KAM KARO PRO - PRODUCTION SERVER")
     print("="*70)
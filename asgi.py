@@ -0,0 +1,112 @@
+"""ASGI entry point for SERVER_MODE=async (see gunicorn.conf.py).
+
+The Flask routes stay synchronous: each request is handed to a bounded
+thread pool (ASGI_THREADS) while the event loop keeps accepting and holding
+connections, so slow or idle clients no longer pin a worker each.
+
+Event streams (/api/stream/*) are served on the loop itself rather than the
+pool, so an idle subscriber costs a coroutine instead of a thread.
+"""
+import asyncio
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+try:
+    from asgiref.sync import sync_to_async
+    from asgiref.wsgi import WsgiToAsgiInstance
+except ImportError as e:
+    raise RuntimeError("SERVER_MODE=async needs asgiref and uvicorn (pip install -r requirements.txt)") from e
+
+from app import (SSE_HEADERS, SSE_HEARTBEAT_SECONDS, SSE_MAX_SECONDS, StreamError, bearer_token,
+                 create_app, event_bus, stream_preamble, stream_topic)
+
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+
+# Threads start lazily, so importing this before fork (--preload) is safe
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi')
+
+class PooledWsgiInstance(WsgiToAsgiInstance):
+    # asgiref's default runs every request on one shared thread; re-wrap the
+    # undecorated method so requests spread over the pool instead
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func,
+                                 thread_sensitive=False, executor=executor)
+
+STREAM_PATH = re.compile(r'/api/stream/(?:(?P<admin>admin)|user/(?P<user_id>\d+))')
+
+# Flask-CORS never sees these responses, so allow any origin here as it does
+STREAM_HEADERS = [(name.lower().encode(), value.encode()) for name, value in SSE_HEADERS.items()]
+STREAM_HEADERS.append((b'access-control-allow-origin', b'*'))
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def send_json(send, status, payload):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'access-control-allow-origin', b'*')]})
+    await send({'type': 'http.response.body', 'body': json.dumps(payload).encode()})
+
+class FlaskAsgi:
+    def __init__(self, wsgi_application):
+        self.wsgi_application = wsgi_application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            match = STREAM_PATH.fullmatch(scope['path'])
+            if match:
+                await self.event_stream(scope, receive, send, match)
+                return
+        await PooledWsgiInstance(self.wsgi_application)(scope, receive, send)
+
+    async def event_stream(self, scope, receive, send, match):
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+        token = bearer_token(headers.get('authorization')) or query.get('token', [None])[0]
+        kind, user_id = ('admin', None) if match['admin'] else ('user', int(match['user_id']))
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        try:
+            topic = stream_topic(kind, user_id, token)
+            subscription = event_bus.subscribe(topic, lambda: loop.call_soon_threadsafe(ready.set))
+        except StreamError as e:
+            await send_json(send, e.status, {"success": False, "error": e.message})
+            return
+
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': STREAM_HEADERS})
+            await send({'type': 'http.response.body', 'body': stream_preamble(topic), 'more_body': True})
+            deadline = loop.time() + SSE_MAX_SECONDS
+            while not disconnected.done() and loop.time() < deadline:
+                woken = asyncio.ensure_future(ready.wait())
+                await asyncio.wait({woken, disconnected}, timeout=SSE_HEARTBEAT_SECONDS,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                woken.cancel()
+                ready.clear()
+                if disconnected.done():
+                    break
+                await send({'type': 'http.response.body', 'body': event_bus.drain(subscription), 'more_body': True})
+            else:
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            disconnected.cancel()
+            event_bus.unsubscribe(subscription)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+application = FlaskAsgi(create_app())
@@ -0,0 +1,76 @@
+"""Benchmark for concurrent task completions with and without the connection pool.
+
+    python bench_connections.py --threads 8 --completions 3200
+
+Fires --completions POST /api/tasks/complete requests from --threads
+threads through the Flask test client, twice:
+
+    per-request  what get_db() used to do: a new sqlite3.connect() for each
+                 request, default pragmas, rollback journal, closed on
+                 teardown
+    pooled       ConnectionPool: one reused connection per thread with WAL
+                 and SQLITE_PRAGMAS
+
+Each run uses fresh users and a task whose limit is high enough that every
+completion is credited, and reports throughput, latency percentiles and
+any non-200 responses.
+"""
+import argparse
+import sqlite3
+
+import stress_completions
+
+class PerRequestConnections:
+    """Stand-in for db_pool that opens and closes a plain connection per request."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def acquire(self):
+        conn = sqlite3.connect(self.database)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def release(self, conn):
+        conn.close()
+
+    def discard(self):
+        pass
+
+def set_journal_mode(database, mode):
+    with sqlite3.connect(database) as conn:
+        return conn.execute(f'PRAGMA journal_mode = {mode}').fetchone()[0]
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--completions', type=int, default=3200)
+    parser.add_argument('--users', type=int, default=200)
+    args = parser.parse_args()
+
+    kaamkaro = stress_completions.load_app()
+    stress_completions.use_writer(kaamkaro, 'immediate')
+    pool = kaamkaro.db_pool
+    # Close this thread's pooled connection so the journal mode can change
+    pool.discard()
+
+    print(f"{args.threads} threads x {args.completions // args.threads} completions")
+    print(f"{'connections':<13}{'journal':>8}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'non-200':>9}")
+    for label, db_pool, journal in (('per-request', PerRequestConnections(kaamkaro.DATABASE), 'DELETE'),
+                                    ('pooled', pool, 'WAL')):
+        journal = set_journal_mode(kaamkaro.DATABASE, journal)
+        kaamkaro.db_pool = db_pool
+        tokens, task_ids = stress_completions.seed(kaamkaro, args.users, 1, args.completions)
+        results, seconds = stress_completions.fire(kaamkaro, tokens, task_ids, args.threads, args.completions)
+        latencies = [result[4] for result in results]
+        failed = sum(1 for result in results if result[2] != 200)
+        print(f"{label:<13}{journal:>8}{len(results) / seconds:>9.0f}{percentile(latencies, 0.5) * 1000:>9.1f}"
+              f"{percentile(latencies, 0.99) * 1000:>9.1f}{failed:>9}")
+        kaamkaro.db_pool = pool
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Benchmark for streaming exports: a million transactions at flat memory.
+
+    python bench_export.py --rows 1000000
+    python bench_export.py --mmap-size 0
+
+Seeds a scratch database with --rows task_completion transactions over
+--users users, then exports them from GET /api/admin/export/transactions
+as CSV and as NDJSON. Each export runs in a fresh interpreter that reads
+the streamed body chunk by chunk, and reports rows, bytes, time and peak
+RSS (ru_maxrss) next to its RSS before the request. Peak RSS also counts
+the connection's page cache (SQLITE_CACHE_SIZE, 64 MB) and any database
+pages read through memory-mapped I/O (SQLITE_MMAP_SIZE, 256 MB); both are
+capped however many rows are exported, and --mmap-size 0 turns off the
+latter.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SEED_CHUNK = 50000
+
+CHILD = '''
+import json, resource, sys, time
+import app as kaamkaro
+client = kaamkaro.create_app().test_client()
+client.get('/api/health')
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+started = time.perf_counter()
+response = client.get('/api/admin/export/transactions?format=' + sys.argv[1])
+size = lines = 0
+for chunk in response.iter_encoded():
+    size += len(chunk)
+    lines += chunk.count(b'\\n')
+response.close()
+print(json.dumps({"status": response.status_code, "bytes": size, "lines": lines,
+                  "seconds": time.perf_counter() - started, "rss_before_kb": before,
+                  "rss_peak_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+'''
+
+def seed(workdir, users, rows):
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import app as kaamkaro
+    kaamkaro.init_db()
+
+    rng = random.Random(5)
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        db.execute('BEGIN IMMEDIATE')
+        db.executemany('INSERT INTO users (email, password, name, referral_code) VALUES (?, ?, ?, ?)',
+                       [(f'export{i}@example.com', 'x', f'Export {i}', f'EXPORT{i}') for i in range(users)])
+        user_ids = [row[0] for row in db.execute('SELECT id FROM users')]
+        db.commit()
+        start = int(time.time()) - 30 * 86400
+        for offset in range(0, rows, SEED_CHUNK):
+            count = min(SEED_CHUNK, rows - offset)
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany('''
+                INSERT INTO transactions (user_id, task_id, task_title, amount, type, description, timestamp)
+                VALUES (?, 1, 'Watch video', 5, 'task_completion', 'Completed: Watch video', datetime(?, 'unixepoch'))
+            ''', [(rng.choice(user_ids), start + (offset + i) * 2) for i in range(count)])
+            db.commit()
+
+def export(workdir, export_format, mmap_size):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    if mmap_size is not None:
+        env['SQLITE_MMAP_SIZE'] = str(mmap_size)
+    output = subprocess.run([sys.executable, '-c', CHILD, export_format], cwd=workdir, env=env,
+                            check=True, capture_output=True, text=True)
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    assert result['status'] == 200, result
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--mmap-size', type=int, help='SQLITE_MMAP_SIZE for the exporting process')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    started = time.perf_counter()
+    # ru_maxrss survives fork and exec on Linux, so seed in a separate process
+    # to keep this one, and the export processes it starts, small
+    seeder = multiprocessing.get_context('spawn').Process(target=seed, args=(workdir, args.users, args.rows))
+    seeder.start()
+    seeder.join()
+    assert seeder.exitcode == 0, seeder.exitcode
+    print(f"seeded {args.rows} transactions in {time.perf_counter() - started:.1f}s")
+
+    print(f"{'format':<8}{'rows':>9}{'MB':>8}{'seconds':>9}{'RSS before MB':>15}{'peak RSS MB':>13}")
+    for export_format in ('csv', 'ndjson'):
+        result = export(workdir, export_format, args.mmap_size)
+        # CSV has a header line; NDJSON is one line per row
+        rows = result['lines'] - (1 if export_format == 'csv' else 0)
+        assert rows == args.rows, (export_format, rows)
+        print(f"{export_format:<8}{rows:>9}{result['bytes'] / 1e6:>8.0f}{result['seconds']:>9.1f}"
+              f"{result['rss_before_kb'] / 1024:>15.0f}{result['rss_peak_kb'] / 1024:>13.0f}")
+
+if __name__ == '__main__':
+    main()
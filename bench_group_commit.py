@@ -0,0 +1,57 @@
+"""Benchmark for per-request commit against group commit of task completions.
+
+    python bench_group_commit.py --threads 16 --completions 8000
+    python bench_group_commit.py --synchronous FULL
+
+Fires --completions POST /api/tasks/complete requests from --threads
+threads through the Flask test client, once per write path:
+
+    immediate    one BEGIN IMMEDIATE transaction and commit per request
+    group        queued and written in batches; each request waits for its
+                 batch to commit (COMPLETION_DURABILITY=commit)
+    group-async  batched, answered before the batch is written
+
+Each run uses fresh users and tasks with limits high enough that every
+completion is credited, reports throughput and latency percentiles, and
+checks balances and counters are exact (see stress_completions.py).
+"""
+import argparse
+
+import stress_completions
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--completions', type=int, default=8000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--flush-ms', type=int, default=5)
+    parser.add_argument('--synchronous', choices=['NORMAL', 'FULL'], default='NORMAL')
+    parser.add_argument('--modes', nargs='+', default=['immediate', 'group', 'group-async'],
+                        choices=['immediate', *stress_completions.WRITER_MODES])
+    args = parser.parse_args()
+
+    kaamkaro = stress_completions.load_app()
+    # Request threads open their connections after this, so they all use it
+    kaamkaro.SQLITE_PRAGMAS[:] = [(name, args.synchronous if name == 'synchronous' else value)
+                                  for name, value in kaamkaro.SQLITE_PRAGMAS]
+
+    print(f"synchronous={args.synchronous}, {args.threads} threads x {args.completions // args.threads} completions")
+    print(f"{'mode':<13}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'batches':>9}")
+    for mode in args.modes:
+        stress_completions.use_writer(kaamkaro, mode, args.batch_size, args.flush_ms)
+        tokens, task_ids = stress_completions.seed(kaamkaro, args.users, 1, args.completions)
+        results, seconds = stress_completions.fire(kaamkaro, tokens, task_ids, args.threads, args.completions)
+        credited = stress_completions.check(kaamkaro, results, args.completions)
+        assert credited == args.completions, credited
+        latencies = [result[4] for result in results]
+        batches = kaamkaro.completion_writer.stats()['batches'] if mode != 'immediate' else '-'
+        print(f"{mode:<13}{len(results) / seconds:>9.0f}{percentile(latencies, 0.5) * 1000:>9.1f}"
+              f"{percentile(latencies, 0.99) * 1000:>9.1f}{batches:>9}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Benchmark for ledger balance reads and full reconciliation.
+
+    python bench_ledger.py --entries 2000000 --users 10000
+
+Seeds a scratch database with --entries ledger entries spread over --users
+users, with one user holding --heavy of them, and keeps users.balance in
+step. Times ledger_balance() for a light and the heavy user against summing
+the user's whole history, then runs reconcile_ledger() over everything and
+checks it finds no issues. Finally nudges one users.balance by a paisa and
+checks the reconciler reports exactly that user.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SEED_CHUNK = 50000
+
+def seed(kaamkaro, db, users, entries, heavy):
+    db.execute('BEGIN IMMEDIATE')
+    first = db.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM users').fetchone()[0]
+    db.executemany('INSERT INTO users (email, password, name, referral_code) VALUES (?, ?, ?, ?)',
+                   [(f'bench{first + i}@example.com', 'x', 'Bench', f'BENCH{first + i}') for i in range(users)])
+    db.commit()
+    user_ids = list(range(first, first + users))
+    heavy_id, light_ids = user_ids[0], user_ids[1:]
+
+    rng = random.Random(7)
+    totals = {}
+    remaining, heavy_left = entries, heavy
+    while remaining:
+        batch = []
+        for _ in range(min(SEED_CHUNK, remaining)):
+            if heavy_left:
+                user_id, heavy_left = heavy_id, heavy_left - 1
+            else:
+                user_id = rng.choice(light_ids)
+            amount = rng.choice((5, 6, 8, 10, 12, 15, 20, 25, 50))
+            totals[user_id] = totals.get(user_id, 0) + amount
+            batch.append((user_id, amount, 'task_completion', 'bench'))
+        db.execute('BEGIN IMMEDIATE')
+        kaamkaro.post_ledger(db, batch)
+        db.commit()
+        remaining -= len(batch)
+
+    db.execute('BEGIN IMMEDIATE')
+    db.executemany('UPDATE users SET balance = balance + ? WHERE id = ?', [(t, u) for u, t in totals.items()])
+    db.commit()
+    return heavy_id, user_ids[-1]
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - started) / repeat, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=int, default=2000000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--heavy', type=int, default=200000, help='entries owned by the single heavy user')
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import app as kaamkaro
+    kaamkaro.init_db()
+
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        started = time.perf_counter()
+        heavy_id, light_id = seed(kaamkaro, db, args.users, args.entries, min(args.heavy, args.entries))
+        print(f"seeded {args.entries} entries in {time.perf_counter() - started:.1f}s")
+
+        full_sum = 'SELECT COALESCE(SUM(amount), 0) FROM ledger_entries WHERE user_id = ?'
+        print(f"{'user':<7}{'entries':>9}{'snapshot+tail us':>18}{'full sum us':>13}{'tail':>6}")
+        for label, user_id in (('light', light_id), ('heavy', heavy_id)):
+            count = db.execute('SELECT COUNT(*) FROM ledger_entries WHERE user_id = ?', (user_id,)).fetchone()[0]
+            fast, balance = timed(lambda: kaamkaro.ledger_balance(db, user_id), args.repeat)
+            slow, total = timed(lambda: db.execute(full_sum, (user_id,)).fetchone()[0], max(args.repeat // 20, 1))
+            assert kaamkaro.to_paise(balance['balance']) == total, (balance, total)
+            print(f"{label:<7}{count:>9}{fast * 1e6:>18.1f}{slow * 1e6:>13.1f}{balance['tail']:>6}")
+
+        report = kaamkaro.reconcile_ledger(db)
+        print(f"reconcile: {report['entries']} entries, {report['users']} users, "
+              f"{report['snapshots_checked']} snapshots in {report['seconds']}s "
+              f"= {report['entries_per_minute'] / 1e6:.1f}M entries/min, issues: {report['issues'] or 'none'}")
+        assert report['ok'], report['samples']
+
+        db.execute('UPDATE users SET balance = balance + 0.01 WHERE id = ?', (light_id,))
+        db.commit()
+        report = kaamkaro.reconcile_ledger(db)
+        assert report['issues'] == {'balance': 1} and report['samples'][0]['user_id'] == light_id, report
+        print(f"drift check: reported user {light_id} after a one-paisa change")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Benchmark for login latency under a login storm at several KDF costs.
+
+    python bench_login.py --hasher scrypt --costs 4096 16384 32768
+    python bench_login.py --hasher pbkdf2_sha256 --costs 100000 260000
+
+For each cost (scrypt N, or PBKDF2 iterations) installs that hasher,
+stores every benchmark user's password at that cost so no login rehashes,
+then has --threads threads each log in --logins times through the Flask
+test client with PASSWORD_HASH_WORKERS=--workers. Reports logins/sec and
+p50/p99 latency, and any non-200 responses (503 means the pool's waiting
+room, --max-pending, overflowed).
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'bench-password'
+
+def make_hasher(kaamkaro, scheme, cost):
+    if scheme == 'scrypt':
+        return kaamkaro.ScryptHasher(cost, 8, 1)
+    return kaamkaro.Pbkdf2Hasher(cost)
+
+def storm(kaamkaro, emails, logins):
+    latencies, statuses, lock = [], [], threading.Lock()
+    start = threading.Barrier(len(emails) + 1)
+
+    def worker(email):
+        client = kaamkaro.app.test_client()
+        local = []
+        start.wait()
+        for _ in range(logins):
+            started = time.perf_counter()
+            status = client.post('/api/login', json={'email': email, 'password': PASSWORD}).status_code
+            local.append((time.perf_counter() - started, status))
+        with lock:
+            latencies.extend(latency for latency, _ in local)
+            statuses.extend(status for _, status in local)
+
+    threads = [threading.Thread(target=worker, args=(email,)) for email in emails]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), statuses, time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hasher', choices=['scrypt', 'pbkdf2_sha256'], default='scrypt')
+    parser.add_argument('--costs', type=int, nargs='+', help='scrypt N or PBKDF2 iterations')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--logins', type=int, default=25, help='logins per thread')
+    parser.add_argument('--workers', type=int, default=4, help='PASSWORD_HASH_WORKERS')
+    parser.add_argument('--max-pending', type=int, default=64, help='PASSWORD_HASH_MAX_PENDING')
+    args = parser.parse_args()
+    costs = args.costs or ([4096, 16384, 32768] if args.hasher == 'scrypt' else [100000, 260000])
+
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, ROOT)
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    import app as kaamkaro
+    kaamkaro.init_db(seed=False)
+    kaamkaro.password_pool = kaamkaro.PasswordWorkPool(args.workers, args.max_pending, 60)
+
+    emails = [f'login{i}@example.com' for i in range(args.threads)]
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        db.executemany('INSERT INTO users (email, password, name, referral_code) VALUES (?, ?, ?, ?)',
+                       [(email, '', 'Login', f'LOGIN{i}') for i, email in enumerate(emails)])
+        db.commit()
+
+    print(f"{args.threads} threads x {args.logins} logins, {args.workers} hash workers")
+    print(f"{'hasher':<15}{'cost':>8}{'logins/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'non-200':>9}")
+    for cost in costs:
+        hasher = make_hasher(kaamkaro, args.hasher, cost)
+        kaamkaro.PASSWORD_HASHERS[hasher.scheme] = kaamkaro.password_hasher = hasher
+        with kaamkaro.app.app_context():
+            db = kaamkaro.get_db()
+            db.executemany('UPDATE users SET password = ? WHERE email = ?',
+                           [(hasher.hash(PASSWORD), email) for email in emails])
+            db.commit()
+        latencies, statuses, seconds = storm(kaamkaro, emails, args.logins)
+        failed = sum(1 for status in statuses if status != 200)
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+        print(f"{args.hasher:<15}{cost:>8}{len(latencies) / seconds:>10.1f}{p50 * 1000:>9.0f}{p99 * 1000:>9.0f}{failed:>9}")
+
+if __name__ == '__main__':
+    main()
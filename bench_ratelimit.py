@@ -0,0 +1,92 @@
+"""Benchmark for the per-request cost of rate limiting.
+
+    python bench_ratelimit.py --calls 200000
+
+Times the before_request rate-limit hook on its own, inside a request
+context, for a route without rules, /api/login (one per-IP bucket) and
+/api/tasks/complete with a session token (per-user and per-IP buckets),
+spreading calls over --keys client addresses. Runs with the local
+backend, the shared SQLite backend written on every request, and the
+shared backend behind per-process buckets synced every --sync-ms (the
+default for RATE_LIMIT_BACKEND=sqlite). Then compares a login
+attempt that reaches the database with one rejected by the limiter,
+through the Flask test client.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def hook_cost(kaamkaro, path, headers, calls, keys):
+    addresses = [f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}' for i in range(keys)]
+    with kaamkaro.app.test_request_context(path, method='POST', headers=headers):
+        environ = kaamkaro.request.environ
+        kaamkaro.enforce_rate_limits()
+        started = time.perf_counter()
+        for i in range(calls):
+            environ['REMOTE_ADDR'] = addresses[i % keys]
+            denied = kaamkaro.enforce_rate_limits()
+        elapsed = time.perf_counter() - started
+    assert denied is None, "benchmark limits are too low"
+    return elapsed / calls
+
+def request_cost(client, calls, remote_addr):
+    body = {'email': 'nobody@example.com', 'password': 'wrong-password'}
+    started = time.perf_counter()
+    for _ in range(calls):
+        status = client.post('/api/login', json=body, environ_base={'REMOTE_ADDR': remote_addr}).status_code
+    return (time.perf_counter() - started) / calls, status
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--calls', type=int, default=200000)
+    parser.add_argument('--keys', type=int, default=10000, help='distinct client addresses')
+    parser.add_argument('--sync-ms', type=int, default=20, help='RATE_LIMIT_SYNC_MS for the synced backend')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    # High limits so every timed call takes the allow path
+    os.environ.update(RATE_LIMIT_LOGIN_IP='1000000/second', RATE_LIMIT_COMPLETE_TASK_IP='1000000/second',
+                      RATE_LIMIT_COMPLETE_TASK_USER='1000000/second')
+    import app as kaamkaro
+    kaamkaro.init_db()
+
+    token = kaamkaro.issue_token(2)
+    scenarios = [
+        ('no rules (/api/health)', '/api/health', {}),
+        ('login: ip', '/api/login', {}),
+        ('complete: user + ip', '/api/tasks/complete', {'Authorization': f'Bearer {token}'}),
+    ]
+    rules = kaamkaro.load_rate_rules()
+    backends = [
+        ('local', kaamkaro.LocalBuckets(kaamkaro.RATE_LIMIT_MAX_KEYS)),
+        ('sqlite', kaamkaro.SqliteBuckets(os.path.join(workdir, 'ratelimit.db'), 3600)),
+        ('synced', kaamkaro.SyncedBuckets(kaamkaro.SqliteBuckets(os.path.join(workdir, 'synced.db'), 3600),
+                                          args.sync_ms / 1000, kaamkaro.RATE_LIMIT_MAX_KEYS)),
+    ]
+
+    print(f"{'backend':<9}{'scenario':<26}{'us/request':>11}")
+    for name, backend in backends:
+        kaamkaro.rate_limiter = kaamkaro.RateLimiter(rules, backend)
+        calls = args.calls // 10 if name == 'sqlite' else args.calls
+        for label, path, headers in scenarios:
+            print(f"{name:<9}{label:<26}{hook_cost(kaamkaro, path, headers, calls, args.keys) * 1e6:>11.2f}")
+
+    os.environ['RATE_LIMIT_LOGIN_IP'] = '5/hour'
+    kaamkaro.rate_limiter = kaamkaro.RateLimiter(kaamkaro.load_rate_rules(), kaamkaro.LocalBuckets(1000))
+    client = kaamkaro.app.test_client()
+    calls = max(args.calls // 100, 10)
+    for addr in range(calls):
+        client.post('/api/login', json={}, environ_base={'REMOTE_ADDR': f'192.0.2.{addr % 250}'})
+    reached, status = request_cost(client, 5, '198.51.100.1')
+    rejected, denied_status = request_cost(client, calls, '198.51.100.1')
+    print(f"login attempt reaching the database: {reached * 1e6:.0f}us ({status}); "
+          f"rejected by the limiter: {rejected * 1e6:.0f}us ({denied_status})")
+
+if __name__ == '__main__':
+    main()
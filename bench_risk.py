@@ -0,0 +1,104 @@
+"""Benchmark for the risk scoring pipeline over a large backlog.
+
+    python bench_risk.py --completions 2000000 --users 50000
+
+Seeds a scratch database with --users users, --completions task completions
+spread evenly over a month, --referrals referrals and --withdrawals
+withdrawals, then plants bots: accounts completing tasks in bursts, accounts
+running referral farms, and a ring of accounts paying out to one UPI ID.
+Times one pass of the pipeline over the whole backlog, reporting throughput
+and peak RSS, and checks that exactly the planted accounts are flagged. Then
+appends a small tail of rows and checks the next run reads only those.
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SEED_CHUNK = 50000
+MONTH = 30 * 86400
+
+def insert(db, query, rows):
+    db.execute('BEGIN IMMEDIATE')
+    db.executemany(query, rows)
+    db.commit()
+
+def seed(db, args, rng):
+    first = db.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM users').fetchone()[0]
+    insert(db, 'INSERT INTO users (email, password, name, referral_code, phone) VALUES (?, ?, ?, ?, ?)',
+           [(f'bench{first + i}@example.com', 'x', 'Bench', f'BENCH{first + i}', f'7{first + i:09d}')
+            for i in range(args.users)])
+    user_ids = list(range(first, first + args.users))
+    bursts, farms, ring = user_ids[:args.bots], user_ids[args.bots:2 * args.bots], user_ids[2 * args.bots:3 * args.bots]
+    honest = user_ids[3 * args.bots:]
+    start = int(time.time()) - MONTH
+
+    # Honest completions arrive uniformly, a few per user per day
+    remaining = args.completions
+    while remaining:
+        batch = [(rng.choice(honest), start + rng.randrange(MONTH)) for _ in range(min(SEED_CHUNK, remaining))]
+        insert(db, "INSERT INTO transactions (user_id, type, amount, description, timestamp) "
+                   "VALUES (?, 'task_completion', 1, 'bench', datetime(?, 'unixepoch'))", batch)
+        remaining -= len(batch)
+    insert(db, "INSERT INTO transactions (user_id, type, amount, description, timestamp) "
+               "VALUES (?, 'task_completion', 1, 'bench', datetime(?, 'unixepoch'))",
+           [(user_id, start + 3600 + second * 2) for user_id in bursts for second in range(20)])
+
+    referrals = [(rng.choice(honest), rng.choice(honest), start + rng.randrange(MONTH)) for _ in range(args.referrals)]
+    referrals += [(user_id, rng.choice(honest), start + 7200 + n * 60) for user_id in farms for n in range(15)]
+    insert(db, "INSERT INTO referrals (referrer_id, referred_id, created_at) VALUES (?, ?, datetime(?, 'unixepoch'))",
+           referrals)
+
+    withdrawals = [(user_id, 100, f'{user_id}@upi') for user_id in rng.sample(honest, min(args.withdrawals, len(honest)))]
+    withdrawals += [(user_id, 100, 'ring@upi') for user_id in ring]
+    insert(db, 'INSERT INTO withdrawals (user_id, amount, upi_id) VALUES (?, ?, ?)', withdrawals)
+    return set(bursts) | set(farms) | set(ring), honest, start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--completions', type=int, default=2000000)
+    parser.add_argument('--referrals', type=int, default=100000)
+    parser.add_argument('--withdrawals', type=int, default=20000)
+    parser.add_argument('--bots', type=int, default=20, help='planted accounts of each kind')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    os.environ['RISK_PIPELINE_INTERVAL'] = '0'
+    import app as kaamkaro
+    kaamkaro.init_db()
+
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        rng = random.Random(11)
+        started = time.perf_counter()
+        planted, honest, start = seed(db, args, rng)
+        print(f"seeded {args.completions} completions in {time.perf_counter() - started:.1f}s")
+
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = kaamkaro.risk_pipeline.run(db)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        rows = sum(result['rows'].values())
+        print(f"backlog: {rows} rows {result['rows']} in {result['seconds']}s "
+              f"= {rows / result['seconds'] / 1e6 * 60:.1f}M rows/min, peak RSS {peak / 1024:.0f} MB "
+              f"(+{(peak - before) / 1024:.0f} MB during the run)")
+
+        flagged = {row[0] for row in db.execute('SELECT user_id FROM risk_scores WHERE flagged = 1')}
+        assert flagged == planted, (len(flagged - planted), len(planted - flagged))
+        print(f"flagged exactly the {len(planted)} planted accounts")
+
+        tail = [(rng.choice(honest), start + MONTH - rng.randrange(3600)) for _ in range(1000)]
+        insert(db, "INSERT INTO transactions (user_id, type, amount, description, timestamp) "
+                   "VALUES (?, 'task_completion', 1, 'bench', datetime(?, 'unixepoch'))", tail)
+        result = kaamkaro.risk_pipeline.run(db)
+        assert result['rows'] == {'users': 0, 'withdrawals': 0, 'referrals': 0, 'transactions': 1000}, result
+        print(f"incremental: {result['rows']['transactions']} new completions in {result['seconds'] * 1000:.0f}ms")
+
+if __name__ == '__main__':
+    main()
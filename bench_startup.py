@@ -0,0 +1,93 @@
+"""Benchmark for cold worker start: import to first response.
+
+    python bench_startup.py --users 1000000 --repeat 5
+
+Creates a scratch database with `flask db init --seed` plus --users extra
+users, then starts --repeat fresh interpreters per scenario, each timing
+`import app`, create_app() and a first GET /api/tasks through the test
+client, and prints the median of each phase:
+
+    worker   what a gunicorn worker does now (schema version check only)
+    legacy   the same plus init_db(), which every worker used to run at
+             import (CREATE TABLE IF NOT EXISTS for every table, migration
+             checks and the demo-data probes)
+
+Also times `flask db init` itself against the populated database, the step
+that now runs once per deploy instead of once per worker.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SEED_CHUNK = 100000
+
+CHILD = '''
+import json, sys, time
+started = time.perf_counter()
+import app as kaamkaro
+imported = time.perf_counter()
+if sys.argv[1] == 'legacy':
+    kaamkaro.init_db()
+application = kaamkaro.create_app()
+ready = time.perf_counter()
+status = application.test_client().get('/api/tasks').status_code
+served = time.perf_counter()
+print(json.dumps({"status": status, "import": imported - started, "create_app": ready - imported,
+                  "first_request": served - ready, "total": served - started}))
+'''
+
+def flask_cli(workdir, *args):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', *args], cwd=workdir, check=True,
+                   env=dict(os.environ, PYTHONPATH=ROOT), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+def seed_users(path, users):
+    with sqlite3.connect(path) as conn:
+        first = conn.execute('SELECT MAX(id) + 1 FROM users').fetchone()[0]
+        for offset in range(0, users, SEED_CHUNK):
+            conn.executemany('INSERT INTO users (email, password, name, referral_code) VALUES (?, ?, ?, ?)',
+                             [(f'bench{first + i}@example.com', 'x', 'Bench', f'BENCH{first + i}')
+                              for i in range(offset, min(offset + SEED_CHUNK, users))])
+            conn.commit()
+
+def start_worker(workdir, scenario):
+    output = subprocess.run([sys.executable, '-c', CHILD, scenario], cwd=workdir, check=True,
+                            capture_output=True, text=True, env=dict(os.environ, PYTHONPATH=ROOT))
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    assert result['status'] == 200, result
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    print(f"db init on an empty database: {flask_cli(workdir, 'db', 'init', '--seed') * 1000:.0f}ms")
+    seed_users(os.path.join(workdir, 'kaamkaro.db'), args.users)
+    print(f"db init with {args.users} users: {flask_cli(workdir, 'db', 'init', '--seed') * 1000:.0f}ms")
+
+    phases = ('import', 'create_app', 'first_request', 'total')
+    print(f"{'scenario':<10}" + ''.join(f"{phase + ' ms':>18}" for phase in phases))
+    for scenario in ('worker', 'legacy'):
+        runs = [start_worker(workdir, scenario) for _ in range(args.repeat)]
+        print(f"{scenario:<10}" + ''.join(f"{statistics.median(run[phase] for run in runs) * 1000:>18.1f}"
+                                          for phase in phases))
+
+    os.remove(os.path.join(workdir, 'kaamkaro.db'))
+    try:
+        start_worker(workdir, 'worker')
+    except subprocess.CalledProcessError as e:
+        print("worker against a missing database refuses to start: " + e.stderr.strip().splitlines()[-1])
+
+if __name__ == '__main__':
+    main()
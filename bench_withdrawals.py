@@ -0,0 +1,79 @@
+"""Benchmark for processing pending withdrawals one by one versus in bulk.
+
+    python bench_withdrawals.py --count 10000
+
+Seeds --count pending withdrawals per run into a scratch database (spread
+over --users users), then times approving (and, with --reject, rejecting)
+them through the Flask test client: once with one POST per withdrawal and
+once with a single POST to /api/admin/withdrawals/bulk/<action>. Checks that
+every withdrawal ended up processed and that refunds match the ledger.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def seed(db, users, count):
+    user_ids = [row[0] for row in db.execute('SELECT id FROM users ORDER BY id LIMIT ?', (users,))]
+    db.execute('BEGIN IMMEDIATE')
+    for i in range(count):
+        user_id = user_ids[i % len(user_ids)]
+        amount = 100 + i % 400
+        cursor = db.execute('''
+            INSERT INTO withdrawals (user_id, user_email, user_name, amount, upi_id, transaction_id)
+            VALUES (?, 'bench@example.com', 'Bench', ?, 'bench@upi', ?)
+        ''', (user_id, amount, f'BENCH{time.monotonic_ns()}{i}'))
+        db.execute('''
+            INSERT INTO transactions (user_id, amount, type, description, balance_after, withdrawal_id)
+            VALUES (?, ?, 'withdrawal_request', 'Withdrawal request (bench)', 0, ?)
+        ''', (user_id, amount, cursor.lastrowid))
+    db.commit()
+    return [row[0] for row in db.execute("SELECT id FROM withdrawals WHERE status = 'pending' ORDER BY id")]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--reject', action='store_true', help='also benchmark rejections (with refunds)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import app as kaamkaro
+    kaamkaro.init_db()
+
+    client = kaamkaro.app.test_client()
+    body = {'approve': {'notes': 'bench'}, 'reject': {'reason': 'bench'}}
+    actions = ['approve', 'reject'] if args.reject else ['approve']
+
+    print(f"{'action':<9}{'mode':<8}{'count':>8}{'seconds':>10}{'per item ms':>13}")
+    for action in actions:
+        for mode in ('single', 'bulk'):
+            with kaamkaro.app.app_context():
+                ids = seed(kaamkaro.get_db(), args.users, args.count)
+            started = time.perf_counter()
+            if mode == 'single':
+                for withdrawal_id in ids:
+                    response = client.post(f'/api/admin/withdrawals/{withdrawal_id}/{action}', json=body[action])
+                    assert response.status_code == 200, response.get_json()
+            else:
+                response = client.post(f'/api/admin/withdrawals/bulk/{action}', json={'ids': ids, **body[action]})
+                summary = response.get_json()['summary']
+                assert summary[kaamkaro.WITHDRAWAL_ACTIONS[action]] == len(ids), summary
+            elapsed = time.perf_counter() - started
+            print(f"{action:<9}{mode:<8}{len(ids):>8}{elapsed:>10.2f}{elapsed / len(ids) * 1000:>13.3f}")
+
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        pending = db.execute("SELECT COUNT(*) FROM withdrawals WHERE status = 'pending'").fetchone()[0]
+        refunds = db.execute("SELECT COUNT(*) FROM transactions WHERE type = 'withdrawal_refund'").fetchone()[0]
+        rejected = db.execute("SELECT COUNT(*) FROM withdrawals WHERE status = 'rejected'").fetchone()[0]
+        mismatches = kaamkaro.check_rollups(db)
+    print(f"pending left: {pending}, rejected: {rejected}, refund rows: {refunds}, rollup mismatches: {len(mismatches)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Gunicorn settings, read from the environment.
+
+    gunicorn -c gunicorn.conf.py
+
+SERVER_MODE picks a preset:
+
+    sync      one request at a time per worker process (gunicorn's default)
+    threaded  gthread workers serving GUNICORN_THREADS requests per process
+    async     uvicorn workers serving asgi:application; an idle or slow
+              client costs a socket instead of a worker, and the Flask
+              routes run on a pool of ASGI_THREADS threads
+
+Each setting can be overridden on its own:
+
+    GUNICORN_WORKER_CLASS  worker class (default from SERVER_MODE)
+    WEB_CONCURRENCY        worker processes (default 1)
+    GUNICORN_THREADS       threads per gthread worker (default 8 when threaded)
+    GUNICORN_TIMEOUT       seconds before a silent worker is restarted (default 30)
+    GUNICORN_KEEPALIVE     seconds to hold idle keep-alive connections (default 5)
+    GUNICORN_PRELOAD       1 to import the app once in the master and fork workers from it
+    PORT                   listen port (default 8000)
+
+In-process state (response cache, counters, leaderboards, group commit,
+event streams, rate-limit buckets unless RATE_LIMIT_BACKEND=sqlite) is per
+worker, so prefer threads or async over more processes where possible. An open /api/stream/* connection holds a whole
+sync worker and a thread under threaded, but only a coroutine under async.
+
+Workers never create or migrate the schema: run `flask --app app db init`
+first (the procfile does). create_app() only checks the schema version and
+refuses to start against an unmigrated database.
+"""
+import os
+
+SERVER_MODES = {
+    'sync': ('sync', 'app:create_app()'),
+    'threaded': ('gthread', 'app:create_app()'),
+    'async': ('uvicorn.workers.UvicornWorker', 'asgi:application'),
+}
+
+server_mode = os.environ.get('SERVER_MODE', 'sync')
+if server_mode not in SERVER_MODES:
+    raise RuntimeError(f"SERVER_MODE must be one of: {', '.join(SERVER_MODES)}")
+
+default_worker_class, wsgi_app = SERVER_MODES[server_mode]
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', default_worker_class)
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8 if server_mode == 'threaded' else 1))
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '0') == '1'
@@ -0,0 +1,149 @@
+"""Load-test harness comparing the gunicorn server modes.
+
+    python loadtest.py --modes sync threaded async --clients 32 --duration 15
+
+For each mode a fresh gunicorn (configured by gunicorn.conf.py) is started
+against a scratch database, a demo user logs in, and --clients keep-alive
+clients poll --path the way Index.html polls the profile endpoint.
+--slow opens extra connections that send half a request and stall, like
+clients on bad mobile networks. Prints requests/sec and latency percentiles.
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(mode, port, args, workdir):
+    env = dict(os.environ, SERVER_MODE=mode, PORT=str(port), WEB_CONCURRENCY=str(args.workers),
+               SECRET_KEY='loadtest', PYTHONPATH=ROOT)
+    if args.threads:
+        env['GUNICORN_THREADS'] = str(args.threads)
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'db', 'init', '--seed'],
+                   cwd=workdir, env=env, check=True, stdout=subprocess.DEVNULL)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+                               '--chdir', workdir, '--bind', f'127.0.0.1:{port}'],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/api/health')
+            if conn.getresponse().status == 200:
+                return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"{mode} server did not start")
+
+def login(port):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    conn.request('POST', '/api/login', json.dumps({'email': 'demo@kaamkaro.com', 'password': 'demo123'}),
+                 {'Content-Type': 'application/json'})
+    body = json.loads(conn.getresponse().read())
+    return body['user']['id'], body['token']
+
+def stall(port, stop):
+    """Hold a connection open with an unfinished request."""
+    try:
+        sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        sock.sendall(b'GET /api/health HTTP/1.1\r\nHost: loadtest\r\n')
+        stop.wait()
+        sock.close()
+    except OSError:
+        pass
+
+def client(port, path, headers, stop, latencies, errors):
+    conn = None
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            if conn is None:
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+            latencies.append(time.perf_counter() - started)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            conn = None
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def run_mode(mode, args):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as workdir:
+        server = start_server(mode, port, args, workdir)
+        try:
+            user_id, token = login(port)
+            path = args.path.format(user_id=user_id)
+            headers = {'Authorization': f'Bearer {token}'}
+            stop = threading.Event()
+            stallers = [threading.Thread(target=stall, args=(port, stop)) for _ in range(args.slow)]
+            for thread in stallers:
+                thread.start()
+            time.sleep(0.5 if args.slow else 0)
+
+            latencies, errors = [], []
+            clients = [threading.Thread(target=client, args=(port, path, headers, stop, latencies, errors))
+                       for _ in range(args.clients)]
+            started = time.perf_counter()
+            for thread in clients:
+                thread.start()
+            time.sleep(args.duration)
+            stop.set()
+            for thread in clients + stallers:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies.sort()
+    return {
+        'mode': mode,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--modes', nargs='+', default=['sync', 'threaded', 'async'])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--slow', type=int, default=0, help='stalled connections held open during the run')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=0, help='GUNICORN_THREADS for threaded mode')
+    parser.add_argument('--path', default='/api/user/{user_id}')
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for mode in args.modes:
+        result = run_mode(mode, args)
+        print(f"{result['mode']:<10}{result['requests']:>10}{result['errors']:>8}{result['rps']:>10.0f}"
+              f"{result['p50']:>10.1f}{result['p95']:>10.1f}{result['p99']:>10.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Stress test for concurrent task completions.
+
+    python stress_completions.py --threads 16 --completions 4000
+    python stress_completions.py --mode group
+
+Fires --completions POST /api/tasks/complete requests from --threads
+threads at --users users and --tasks tasks whose daily limit is --limit,
+so most (user, task) pairs are hammered well past their limit. Afterwards
+asserts, exactly:
+
+  - each (user, task) pair succeeded min(attempts, limit) times, and every
+    other attempt was refused with the daily-limit error
+  - users.balance, tasks_done and total_earned match the successes
+  - tasks.total_completions and task_daily_counts match the successes
+  - one task_completion transaction row per success
+  - the wallet ledger reconciles
+
+--mode picks the write path: immediate (per-request transactions, the
+default), group (group commit, each request waits for its batch) or
+group-async (group commit answering before the batch is written).
+Exits non-zero on the first mismatch.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+REWARD = 5
+WRITER_MODES = {'group': 'commit', 'group-async': 'async'}
+
+def load_app():
+    """Import app against a scratch database in a fresh working directory."""
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, ROOT)
+    # Completions per user per minute are rate limited; the test is about the write path
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    import app as kaamkaro
+    kaamkaro.init_db(seed=False)
+    return kaamkaro
+
+def use_writer(kaamkaro, mode, batch_size=256, flush_ms=5):
+    """Switch complete_task to the write path named by mode."""
+    if mode == 'immediate':
+        kaamkaro.completion_writer = kaamkaro.CompletionWriter('immediate', batch_size, flush_ms / 1000, 'commit')
+    else:
+        kaamkaro.completion_writer = kaamkaro.CompletionWriter('group', batch_size, flush_ms / 1000, WRITER_MODES[mode])
+
+def seed(kaamkaro, users, tasks, limit):
+    """Create fresh users and tasks; returns ({user_id: token}, [task_id])."""
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        db.execute('BEGIN IMMEDIATE')
+        first = db.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM users').fetchone()[0]
+        db.executemany('INSERT INTO users (email, password, name, referral_code) VALUES (?, ?, ?, ?)',
+                       [(f'stress{first + i}@example.com', 'x', 'Stress', f'STRESS{first + i}') for i in range(users)])
+        first_task = db.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM tasks').fetchone()[0]
+        db.executemany("INSERT INTO tasks (title, reward, status, daily_limit) VALUES (?, ?, 'active', ?)",
+                       [(f'Stress task {first_task + i}', REWARD, limit) for i in range(tasks)])
+        db.commit()
+    user_ids = range(first, first + users)
+    return {user_id: kaamkaro.issue_token(user_id) for user_id in user_ids}, list(range(first_task, first_task + tasks))
+
+def fire(kaamkaro, tokens, task_ids, threads, completions, seed_value=3):
+    """Run completions across threads; returns (results, seconds).
+
+    results is a list of (user_id, task_id, status, error, latency_seconds).
+    """
+    rng = random.Random(seed_value)
+    work = [(rng.choice(list(tokens)), rng.choice(task_ids)) for _ in range(completions)]
+    shares = [work[i::threads] for i in range(threads)]
+    results, lock = [], threading.Lock()
+    start = threading.Barrier(threads + 1)
+
+    def worker(share):
+        client = kaamkaro.app.test_client()
+        local = []
+        start.wait()
+        for user_id, task_id in share:
+            started = time.perf_counter()
+            response = client.post('/api/tasks/complete', json={'task_id': task_id},
+                                   headers={'Authorization': f'Bearer {tokens[user_id]}'})
+            body = response.get_json(silent=True) or {}
+            local.append((user_id, task_id, response.status_code, body.get('error'), time.perf_counter() - started))
+        with lock:
+            results.extend(local)
+
+    pool = [threading.Thread(target=worker, args=(share,)) for share in shares]
+    for thread in pool:
+        thread.start()
+    start.wait()
+    started = time.perf_counter()
+    for thread in pool:
+        thread.join()
+    return results, time.perf_counter() - started
+
+def check(kaamkaro, results, limit):
+    """Assert the database matches the responses exactly; returns the success count."""
+    attempts, successes = {}, {}
+    for user_id, task_id, status, error, _ in results:
+        pair = (user_id, task_id)
+        attempts[pair] = attempts.get(pair, 0) + 1
+        if status == 200:
+            successes[pair] = successes.get(pair, 0) + 1
+        else:
+            assert status == 400 and error.startswith('Daily limit reached'), (pair, status, error)
+    for pair, count in attempts.items():
+        assert successes.get(pair, 0) == min(count, limit), (pair, count, successes.get(pair, 0))
+
+    # Group commit answers async requests before writing; wait for the queue
+    kaamkaro.completion_writer.close()
+    kaamkaro.task_completion_counter.fold()
+
+    user_ids = sorted({user_id for user_id, _ in attempts})
+    task_ids = sorted({task_id for _, task_id in attempts})
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        for user_id in user_ids:
+            done = sum(count for (uid, _), count in successes.items() if uid == user_id)
+            row = db.execute('SELECT balance, tasks_done, total_earned FROM users WHERE id = ?', (user_id,)).fetchone()
+            assert tuple(row) == (done * REWARD, done, done * REWARD), (user_id, tuple(row), done)
+        for task_id in task_ids:
+            done = sum(count for (_, tid), count in successes.items() if tid == task_id)
+            total = db.execute('SELECT total_completions FROM tasks WHERE id = ?', (task_id,)).fetchone()[0]
+            assert total == done, (task_id, total, done)
+        for (user_id, task_id), done in successes.items():
+            counted = db.execute('SELECT SUM(count) FROM task_daily_counts WHERE user_id = ? AND task_id = ?',
+                                 (user_id, task_id)).fetchone()[0]
+            rows = db.execute("SELECT COUNT(*) FROM transactions WHERE user_id = ? AND task_id = ? "
+                              "AND type = 'task_completion'", (user_id, task_id)).fetchone()[0]
+            assert counted == rows == done, ((user_id, task_id), counted, rows, done)
+        report = kaamkaro.reconcile_ledger(db)
+        assert report['ok'], report['samples']
+    return sum(successes.values())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--completions', type=int, default=4000)
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--tasks', type=int, default=2)
+    parser.add_argument('--limit', type=int, default=50, help='daily limit of every task')
+    parser.add_argument('--mode', choices=['immediate', *WRITER_MODES], default='immediate')
+    args = parser.parse_args()
+
+    kaamkaro = load_app()
+    use_writer(kaamkaro, args.mode)
+    tokens, task_ids = seed(kaamkaro, args.users, args.tasks, args.limit)
+    results, seconds = fire(kaamkaro, tokens, task_ids, args.threads, args.completions)
+    succeeded = check(kaamkaro, results, args.limit)
+    print(f"{args.mode}: {len(results)} completions from {args.threads} threads in {seconds:.1f}s, "
+          f"{succeeded} credited; balances, counters, daily limits, ledger rows and ledger all exact")
+
+if __name__ == '__main__':
+    main()
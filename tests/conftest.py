@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture(scope='session')
+def kaamkaro(tmp_path_factory):
+    """The app module, imported against a scratch database with the schema applied."""
+    os.chdir(tmp_path_factory.mktemp('app'))
+    sys.path.insert(0, ROOT)
+    # Tests fire many requests per user; limits are tested on their own
+    os.environ['RATE_LIMIT_ENABLED'] = '0'
+    import app as kaamkaro
+    kaamkaro.init_db(seed=False)
+    return kaamkaro
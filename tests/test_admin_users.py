@@ -0,0 +1,34 @@
+import itertools
+
+import pytest
+
+USER_NUMBERS = itertools.count(1)
+
+@pytest.fixture
+def user_id(kaamkaro):
+    number = next(USER_NUMBERS)
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        user_id = db.execute('INSERT INTO users (email, password, name, referral_code) VALUES (?, ?, ?, ?) RETURNING id',
+                             (f'admin-update{number}@example.com', 'x', 'Admin Update', f'ADMINUPD{number}')).fetchone()[0]
+        db.commit()
+    return user_id
+
+@pytest.mark.parametrize('body', ['{"balance": "abc"}', '{"balance": null}', '{"balance": 1e400}', '[1]', 'null'])
+def test_bad_balance_update_is_rejected_before_locking(kaamkaro, user_id, body):
+    client = kaamkaro.app.test_client()
+    response = client.post(f'/api/admin/users/{user_id}/update', data=body, content_type='application/json')
+    assert response.status_code == 400
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        assert not db.in_transaction
+        assert db.execute('SELECT balance FROM users WHERE id = ?', (user_id,)).fetchone()[0] == 0
+
+def test_balance_update_posts_a_ledger_adjustment(kaamkaro, user_id):
+    client = kaamkaro.app.test_client()
+    response = client.post(f'/api/admin/users/{user_id}/update', json={"balance": "12.5"})
+    assert response.status_code == 200
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        assert db.execute('SELECT balance FROM users WHERE id = ?', (user_id,)).fetchone()[0] == 12.5
+        assert kaamkaro.reconcile_ledger(db)['ok']
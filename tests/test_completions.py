@@ -0,0 +1,12 @@
+import pytest
+
+import stress_completions
+
+@pytest.mark.parametrize('mode', ['immediate', 'group'])
+def test_concurrent_completions_stay_exact(kaamkaro, monkeypatch, mode):
+    monkeypatch.setattr(kaamkaro, 'completion_writer', kaamkaro.completion_writer)
+    stress_completions.use_writer(kaamkaro, mode)
+    tokens, task_ids = stress_completions.seed(kaamkaro, users=4, tasks=2, limit=50)
+    results, _ = stress_completions.fire(kaamkaro, tokens, task_ids, threads=16, completions=1600)
+    # Hammered well past the limit: 4 users x 2 tasks x 50
+    assert stress_completions.check(kaamkaro, results, limit=50) == 400
@@ -0,0 +1,11 @@
+import sqlite3
+from contextlib import closing
+
+def test_hot_queries_use_an_index(kaamkaro, tmp_path):
+    with closing(sqlite3.connect(tmp_path / 'plans.db')) as db:
+        db.row_factory = sqlite3.Row
+        kaamkaro.create_schema(db)
+        kaamkaro.run_migrations(db)
+        report = kaamkaro.explain_hot_queries(db)
+    scans = {name: entry['plan'] for name, entry in report.items() if not entry['uses_index']}
+    assert not scans
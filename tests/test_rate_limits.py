@@ -0,0 +1,19 @@
+def synced_workers(kaamkaro, path, interval, count=2):
+    return [kaamkaro.SyncedBuckets(kaamkaro.SqliteBuckets(str(path), 3600), interval, 1000) for _ in range(count)]
+
+def test_synced_workers_share_one_budget(kaamkaro, tmp_path):
+    workers = synced_workers(kaamkaro, tmp_path / 'ratelimit.db', 0)
+    allowed = sum(not workers[i % 2].take('login:ip:1', 10, 0.001) for i in range(40))
+    # Each worker may spend one token the other spent since its last sync
+    assert 10 <= allowed <= 11
+    assert all(worker.take('login:ip:1', 10, 0.001) for worker in workers)
+
+def test_tokens_spent_between_syncs_are_owed(kaamkaro, tmp_path):
+    workers = synced_workers(kaamkaro, tmp_path / 'ratelimit.db', 3600)
+    for worker in workers:
+        assert not any(worker.take('login:ip:1', 10, 0.001) for _ in range(10))
+    for worker in workers:
+        worker.sync()
+    assert all(worker.take('login:ip:1', 10, 0.001) for worker in workers)
+    # 20 spent against a capacity of 10: the last to sync sees the debt of 10
+    assert workers[1].take('login:ip:1', 10, 0.001) > 10 / 0.001
@@ -0,0 +1,15 @@
+def test_non_object_ndjson_lines_are_rejected_as_invalid(kaamkaro):
+    client = kaamkaro.app.test_client()
+    body = '[1, 2]\n"x"\n5\n{"reference": "WT-missing", "status": "paid"}\n'
+    response = client.post('/api/admin/payouts/settlements?format=ndjson', data=body,
+                           content_type='application/x-ndjson')
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result['summary']['invalid'] == 3
+    assert result['summary']['not_found'] == 1
+    assert [error['line'] for error in result['errors']] == [1, 2, 3, 4]
+    # The import committed, so the write lock is free again
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        db.execute('BEGIN IMMEDIATE')
+        db.rollback()
@@ -0,0 +1,33 @@
+import threading
+
+def test_concurrent_requests_stay_within_the_daily_limit(kaamkaro):
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        user_id = db.execute("INSERT INTO users (email, password, name, referral_code, balance) "
+                             "VALUES ('daily-limit@example.com', 'x', 'Daily Limit', 'DAILYLIMIT', 20000) "
+                             "RETURNING id").fetchone()[0]
+        db.commit()
+    headers = {'Authorization': f'Bearer {kaamkaro.issue_token(user_id)}'}
+    threads = 16
+    start = threading.Barrier(threads)
+    statuses = []
+
+    def withdraw():
+        client = kaamkaro.app.test_client()
+        start.wait()
+        response = client.post('/api/withdraw/request', json={'amount': 1000, 'upi_id': 'limit@upi'}, headers=headers)
+        statuses.append(response.status_code)
+
+    workers = [threading.Thread(target=withdraw) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert statuses.count(200) == 5
+    assert statuses.count(400) == threads - 5
+    with kaamkaro.app.app_context():
+        db = kaamkaro.get_db()
+        total = db.execute('SELECT SUM(amount) FROM withdrawals WHERE user_id = ?', (user_id,)).fetchone()[0]
+        balance = db.execute('SELECT balance FROM users WHERE id = ?', (user_id,)).fetchone()[0]
+    assert (total, balance) == (5000, 15000)